@@ -54,6 +54,7 @@ class GenText(object):
         ctx.gentexting = True
         ctx.gencount = 0
         ctx.genparams = {}
+        ctx.genhash = None
 
     @staticmethod
     def final_context(ctx):
@@ -63,6 +64,7 @@ class GenText(object):
         assert (ctx.gentexting)
         ctx.gencount = None
         ctx.genparams = None
+        ctx.genhash = None
         ctx.gentexting = False
 
     @tornado.gen.coroutine
@@ -114,13 +116,19 @@ class GenNodeClass(object):
         distribution.
 
         I'm not sure this is speedy. But I don't know a good alternative
-        either.
+        either. We at least keep the hash state after ctx.genseed around
+        (in ctx.genhash), so that only the short tail gets hashed per call.
         """
         count = str(ctx.gencount).encode()
         ctx.gencount += 1
-        
-        hash = hashlib.md5()
-        hash.update(ctx.genseed)
+
+        # The seed can be changed mid-generation (display(seed=...)),
+        # so check that the stashed hash state matches it.
+        genhash = ctx.genhash
+        if genhash is None or genhash[0] != ctx.genseed:
+            genhash = (ctx.genseed, hashlib.md5(ctx.genseed))
+            ctx.genhash = genhash
+        hash = genhash[1].copy()
         hash.update(count)
         hash.update(propname)
         hash.update(self.prefix)
@@ -545,3 +553,17 @@ def parse(text, originlabel='<gentext>'):
 
     return GenText(res)
 
+# Cache of parse() results, keyed by source text. The GenText trees
+# (and their node prefixes) are never modified after parsing, so they
+# can be shared among all evaluations.
+parse_cache = twcommon.misc.LRUCache(1000, name='gentext_parse_cache')
+
+def parse_cached(text, originlabel='<gentext>'):
+    """Same as parse(), but the result is cached. Syntax errors are not
+    cached; they are raised every time.
+    """
+    res = parse_cache.get(text)
+    if res is None:
+        res = parse(text, originlabel=originlabel)
+        parse_cache.set(text, res)
+    return res
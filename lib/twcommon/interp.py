@@ -339,9 +339,25 @@ def parse(text):
         
     return res
 
+def parse_cached(text):
+    """Same as parse(), but the result is cached. The result is a
+    tuple, since it is shared among all callers. The InterpNodes in it
+    must not be modified either.
+    (Errors are not cached; they are raised every time.)
+    """
+    res = parse_cache.get(text)
+    if res is None:
+        res = tuple(parse(text))
+        parse_cache.set(text, res)
+    return res
+
 
 # Late imports
-from twcommon.misc import sluggify
+from twcommon.misc import sluggify, LRUCache
+
+# Cache of parse() results, keyed by text. Descriptions get re-rendered
+# constantly and rarely change, so this saves a lot of rescanning.
+parse_cache = LRUCache(4000, name='interp_parse_cache')
 
 
 import unittest
@@ -411,6 +427,14 @@ class TestInterpModule(unittest.TestCase):
         self.assertRaises(ValueError, parse, '[[bar')
         self.assertRaises(ValueError, parse, '[ [x] ]')
 
+    def test_parse_cached(self):
+        ls = parse_cached('One [two] three.')
+        self.assertIsInstance(ls, tuple)
+        self.assertEqual(ls, ('One ', Link('two'), 'two', EndLink(), ' three.'))
+        self.assertIs(parse_cached('One [two] three.'), ls)
+        self.assertEqual(list(ls), parse('One [two] three.'))
+        self.assertRaises(ValueError, parse_cached, '[bar')
+
 
 if __name__ == '__main__':
     unittest.main()
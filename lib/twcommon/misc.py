@@ -1,6 +1,7 @@
 import datetime
 import re
 import unicodedata
+import collections
 
 # The maximum length of an editable description, such as a player desc
 # or editstr line.
@@ -107,7 +108,7 @@ def timedelta_two_units(delta):
 def is_typed_dict(obj, typ):
     """Returns true if obj is a dict and has a field 'type'=typ.
     """
-    return (type(obj) is dict and obj.get('type', None) == typ)
+    return (isinstance(obj, dict) and obj.get('type', None) == typ)
 
 # Regexps for sluggify
 re_nonidentchars = re.compile('[^a-z0-9_ ]+')
@@ -135,6 +136,52 @@ def sluggify(text):
         text = '_' + text
     return text
 
+class LRUCache(object):
+    """A dict-ish cache with a bounded number of entries. When it's full,
+    the least-recently-used entry is dropped. We count hits and misses,
+    so that you can tell whether the cache is doing any good.
+
+    Cached values are shared among all callers, so they should be
+    treated as immutable.
+    """
+    def __init__(self, maxsize, name='LRUCache'):
+        self.maxsize = maxsize
+        self.name = name
+        self.map = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<%s: %d/%d entries; %d hits, %d misses>' % (self.name, len(self.map), self.maxsize, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it's not
+        cached.
+        """
+        try:
+            val = self.map[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.map.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def set(self, key, val):
+        self.map[key] = val
+        self.map.move_to_end(key)
+        while len(self.map) > self.maxsize:
+            self.map.popitem(last=False)
+
+    def discard(self, key):
+        self.map.pop(key, None)
+
+    def clear(self):
+        self.map.clear()
+
 
 import unittest
 
@@ -192,6 +239,29 @@ class TestInterpModule(unittest.TestCase):
         for (val, res) in tests:
             self.assertEqual(sluggify(val), res)
 
+    def test_lrucache(self):
+        cache = LRUCache(3)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 0), 0)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used.
+        cache.set('d', 4)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.get('d'), 4)
+        self.assertEqual(cache.hits, 4)
+        self.assertEqual(cache.misses, 3)
+        cache.discard('a')
+        cache.discard('a')
+        self.assertEqual(cache.get('a'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -183,6 +183,12 @@ class AdminPlayerHandler(AdminBaseHandler):
             yield motor.Op(self.application.mongodb.players.update,
                            { '_id':uid },
                            { '$set':{'build':newflag} })
+            # Tell tworld, which caches player flags.
+            try:
+                msg = { 'cmd':'notifyentitychange', 'collection':'players', 'id':str(uid) }
+                self.application.twservermgr.tworld_write(0, msg)
+            except Exception as ex:
+                self.application.twlog.warning('Unable to notify tworld of player change: %s', ex)
         
             self.redirect(self.request.path)
             return
@@ -80,6 +80,12 @@ class NoBuildHandler(tweblib.handlers.MyRequestHandler):
                            { '_id':self.twsession['uid'] },
                            { '$set':{'build':True} })
             self.twisbuild = True
+            # Tell tworld, which caches player flags.
+            try:
+                msg = { 'cmd':'notifyentitychange', 'collection':'players', 'id':str(self.twsession['uid']) }
+                self.application.twservermgr.tworld_write(0, msg)
+            except Exception as ex:
+                self.application.twlog.warning('Unable to notify tworld of player change: %s', ex)
             self.application.twlog.info('Player requested build permission: %s', self.twsession['email'])
             
         self.render('nobuild.html',
@@ -116,6 +122,16 @@ class BuildBaseHandler(tweblib.handlers.MyRequestHandler):
         map['xsrf_token'] = tornado.escape.xhtml_escape(self.xsrf_token)
         return map
 
+    def notify_entity_change(self, collection, id):
+        """Tell tworld that a world, location, or portlist document has changed, so
+        that it can drop its cached copy.
+        """
+        try:
+            msg = { 'cmd':'notifyentitychange', 'collection':collection, 'id':str(id) }
+            self.application.twservermgr.tworld_write(0, msg)
+        except Exception as ex:
+            self.application.twlog.warning('Unable to notify tworld of entity change: %s', ex)
+
     @tornado.gen.coroutine
     def find_build_world(self, wid):
         """Given the ObjectId of a world, look up the world and make sure
@@ -945,6 +961,7 @@ class BuildDelPortListHandler(BuildBaseHandler):
             # Then the list itself.
             yield motor.Op(self.application.mongodb.portlists.remove,
                            { '_id':plistid })
+            self.notify_entity_change('portlists', plistid)
 
             try:
                 dependency = ('portlist', plistid, None)
@@ -1159,6 +1176,7 @@ class BuildSetDataHandler(BuildBaseHandler):
                 yield motor.Op(self.application.mongodb.locations.update,
                                { '_id':locid },
                                { '$set':{'key':value} })
+                self.notify_entity_change('locations', locid)
                 self.write( { 'val':value } )
                 return
 
@@ -1168,6 +1186,7 @@ class BuildSetDataHandler(BuildBaseHandler):
                 yield motor.Op(self.application.mongodb.locations.update,
                                { '_id':locid },
                                { '$set':{'name':value} })
+                self.notify_entity_change('locations', locid)
                 ### dependency change for location name?
                 self.write( { 'val':value } )
                 return
@@ -1176,6 +1195,7 @@ class BuildSetDataHandler(BuildBaseHandler):
                 yield motor.Op(self.application.mongodb.worlds.update,
                                { '_id':wid },
                                { '$set':{'name':value} })
+                self.notify_entity_change('worlds', wid)
                 ### dependency change for world name?
                 self.write( { 'val':value } )
                 return
@@ -1187,6 +1207,7 @@ class BuildSetDataHandler(BuildBaseHandler):
                 yield motor.Op(self.application.mongodb.worlds.update,
                                { '_id':wid },
                                { '$set':{'instancing':value} })
+                self.notify_entity_change('worlds', wid)
                 self.write( { 'val':value } )
                 return
             
@@ -1198,6 +1219,7 @@ class BuildSetDataHandler(BuildBaseHandler):
                 yield motor.Op(self.application.mongodb.worlds.update,
                                { '_id':wid },
                                { '$set':{'copyable':value} })
+                self.notify_entity_change('worlds', wid)
                 self.write( { 'val':value } )
                 return
             
@@ -1228,6 +1250,7 @@ class BuildSetDataHandler(BuildBaseHandler):
                 yield motor.Op(self.application.mongodb.portlists.update,
                                { '_id':plistid, 'wid':wid },
                                { '$set':{'key':value} })
+                self.notify_entity_change('portlists', plistid)
                 self.write( { 'val':value } )
                 return
 
@@ -1258,11 +1281,21 @@ class BuildDelLocHandler(BuildBaseHandler):
             yield motor.Op(self.application.mongodb.worldprop.remove,
                            { 'wid':wid, 'locid':locid })
 
+            # Send a dependency key covering every key in the location.
+            try:
+                dependency = ('worldprop', wid, locid, None)
+                encoder = JSONEncoderExtra()
+                depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                self.application.twservermgr.tworld_write(0, depmsg)
+            except Exception as ex:
+                self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
+
             ### And also instance properties?
 
             # Then the location itself.
             yield motor.Op(self.application.mongodb.locations.remove,
                            { '_id':locid })
+            self.notify_entity_change('locations', locid)
 
             # The result value isn't used for anything.
             self.write( { 'ok':True } )
@@ -7,21 +7,28 @@ need to connect to mongodb (in a test database), and mock up entries
 for the world, instance, player, etc.
 """
 
+import time
 import logging
 import unittest
 import ast
 
 from bson.objectid import ObjectId
+import tornado.gen
 import tornado.testing
 
 import twcommon.misc
+from twcommon.excepts import ExecRunawayException
 import two.execute
 import two.task
+import two.profiler
+import two.symbols
+import two.evalctx
 from two.execute import EvalPropContext
 
 class MockApplication:
     def __init__(self):
         self.log = logging.getLogger('tworld')
+        self.profiler = two.profiler.ScriptProfiler(self)
 
 class TestEval(unittest.TestCase):
     def test_optimize_accum(self):
@@ -176,6 +183,20 @@ class TestEval(unittest.TestCase):
         self.assertSpecResolvesRaise('*ls, x', 3)
         self.assertSpecResolvesRaise('*ls, x=0', x=4, z=5)
         
+    def test_pure_expressions(self):
+        compile_code = two.evalctx.compile_code
+        self.assertIsNotNone(compile_code('1 + 2 * 3').pure)
+        self.assertIsNotNone(compile_code('"a" < "b" <= "c" and not (1, 2)').pure)
+        self.assertIsNotNone(compile_code('-3.5 ** 2 % 4 in [1, 2.25]').pure)
+        # Properties, function calls, and temporary variables need the
+        # full treatment. So do statements and dicts.
+        self.assertIsNone(compile_code('x + 1').pure)
+        self.assertIsNone(compile_code('len([])').pure)
+        self.assertIsNone(compile_code('_x + 1').pure)
+        self.assertIsNone(compile_code('_x = 1').pure)
+        self.assertIsNone(compile_code('{"type":"text"}').pure)
+        self.assertIsNone(compile_code('1\n2').pure)
+        
 class TestEvalAsync(tornado.testing.AsyncTestCase):
     @tornado.testing.gen_test
     def test_simple_literals(self):
@@ -206,6 +227,170 @@ class TestEvalAsync(tornado.testing.AsyncTestCase):
         self.assertEqual(res, {'x':'yy', 'one':1})
         res = yield ctx.eval('{1, 2, 3}', evaltype=EVALTYPE_CODE)
         self.assertEqual(res, set([1, 2, 3]))
+
+    @tornado.testing.gen_test
+    def test_temporary_code(self):
+        app = MockApplication()
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+        loctx = two.task.LocContext(uid=ObjectId())
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+
+        def double(x):
+            # Make the caller wait a turn.
+            yield tornado.gen.Task(self.io_loop.add_callback)
+            return x * 2
+        locals = { '_ls':[1, 2, 3, 4], '_double':two.symbols.ScriptFunc('double', double, yieldy=True) }
+        
+        res = yield ctx.eval('_t = 0\nfor _x in _ls:\n  if _x == 3: break\n  _t += _x\n_t', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(res, 3)
+        res = yield ctx.eval('[_x * 10 for _x in _ls if _x % 2]', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(res, [10, 30])
+        res = yield ctx.eval('(_a, _b) = _ls[1:3]\n_a < _b < 4', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(res, True)
+        res = yield ctx.eval('_double(_ls[0]) + _double(5)', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(res, 12)
+        res = yield ctx.eval('[_double(_x) for _x in _ls]', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(res, [2, 4, 6, 8])
+
+        # Every expression node and statement ticks, whether or not it
+        # had to wait.
+        task.resetticks()
+        yield ctx.eval('_n = _ls[0] + 1', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(task.cputicks, 9)
+        task.resetticks()
+        yield ctx.eval('_n = _double(1) + 1', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(task.cputicks, 9)
+
+    @tornado.testing.gen_test
+    def test_current_context(self):
+        app = MockApplication()
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+
+        def whoami():
+            # Let the other evaluation run for a turn.
+            yield tornado.gen.Task(self.io_loop.add_callback)
+            return EvalPropContext.get_current_context()
+        locals = { '_whoami':two.symbols.ScriptFunc('whoami', whoami, yieldy=True) }
+        
+        ctx1 = EvalPropContext(task, loctx=two.task.LocContext(uid=ObjectId()), level=LEVEL_EXECUTE)
+        ctx2 = EvalPropContext(task, loctx=two.task.LocContext(uid=ObjectId()), level=LEVEL_EXECUTE)
+        # Two interleaved evaluations each see their own context.
+        (res1, res2) = yield [ ctx1.eval('[_whoami(), _whoami()]', evaltype=EVALTYPE_CODE, locals=locals),
+                               ctx2.eval('[_whoami(), _whoami()]', evaltype=EVALTYPE_CODE, locals=dict(locals)) ]
+        self.assertEqual(res1, [ctx1, ctx1])
+        self.assertEqual(res2, [ctx2, ctx2])
+        self.assertIsNone(EvalPropContext.current_context.get())
+
+    @tornado.testing.gen_test
+    def test_interpolate_pure(self):
+        app = MockApplication()
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+        loctx = two.task.LocContext(uid=ObjectId())
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_MESSAGE)
+
+        res = yield ctx.eval('[[$if 2 > 1]]yes[[$else]]no[[$end]] [[ 3 * 4 ]]', evaltype=EVALTYPE_TEXT)
+        self.assertEqual(res, 'yes 12')
+        res = yield ctx.eval('[[$if 0]]a[[$elif 1+1 == 2]]b[[$end]]', evaltype=EVALTYPE_TEXT)
+        self.assertEqual(res, 'b')
+        self.assertEqual(ctx.dependencies, set())
+        # The fast path ticks as often as the long way around did.
+        task.resetticks()
+        yield ctx.eval('[[ 1 + 2 ]]', evaltype=EVALTYPE_TEXT)
+        self.assertEqual(task.cputicks, 9)
+
+    @tornado.testing.gen_test
+    def test_runaway(self):
+        app = MockApplication()
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+        loctx = two.task.LocContext(uid=ObjectId())
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+
+        # Comprehension passes and big strings cost extra.
+        task.resetticks()
+        yield ctx.eval('_ls = [0 for _x in [1] * 3]', evaltype=EVALTYPE_CODE)
+        comprehension = task.cputicks
+        task.resetticks()
+        yield ctx.eval('_ls = [0 for _x in [1] * 4]', evaltype=EVALTYPE_CODE)
+        # One tick for the pass, one for the element.
+        self.assertEqual(task.cputicks, comprehension + 2)
+        task.resetticks()
+        yield ctx.eval('_s = "x" * 10', evaltype=EVALTYPE_CODE)
+        small = task.cputicks
+        task.resetticks()
+        yield ctx.eval('_s = "x" * 10000', evaltype=EVALTYPE_CODE)
+        self.assertEqual(task.cputicks, small + 10000 // task.TICK_SIZE_UNIT)
+
+        # String formatting is charged by the size of the values.
+        task.resetticks()
+        yield ctx.eval('_s = "%s%s" % ("x", "x")', evaltype=EVALTYPE_CODE)
+        small = task.cputicks
+        task.resetticks()
+        yield ctx.eval('_s = "%s%s" % ("x" * 5000, "x" * 5000)', evaltype=EVALTYPE_CODE)
+        self.assertEqual(task.cputicks, small + 2 * 2 + 2 * (5000 // task.TICK_SIZE_UNIT) + 10004 // task.TICK_SIZE_UNIT)
+
+        # So are str methods which build strings.
+        task.resetticks()
+        yield ctx.eval('_s = "x".ljust(10)', evaltype=EVALTYPE_CODE)
+        small = task.cputicks
+        task.resetticks()
+        yield ctx.eval('_s = "x".ljust(10000)', evaltype=EVALTYPE_CODE)
+        self.assertEqual(task.cputicks, small + 10000 // task.TICK_SIZE_UNIT)
+        task.resetticks()
+        yield ctx.eval('_s = "".join(["x"] * 10)', evaltype=EVALTYPE_CODE)
+        small = task.cputicks
+        task.resetticks()
+        yield ctx.eval('_s = "".join(["x"] * 10000)', evaltype=EVALTYPE_CODE)
+        self.assertEqual(task.cputicks, small + 2 * (10000 // task.TICK_SIZE_UNIT))
+        task.resetticks()
+        with self.assertRaises(ExecRunawayException):
+            yield ctx.eval('_s = "x".ljust(100000000)', evaltype=EVALTYPE_CODE)
+
+        # This runs out of ticks before it runs out of memory.
+        task.resetticks()
+        with self.assertRaises(ExecRunawayException):
+            yield ctx.eval('_s = "x" * 10**12', evaltype=EVALTYPE_CODE)
+
+        # Waiting counts against the wall-clock limit.
+        def wait():
+            yield tornado.gen.Task(self.io_loop.add_timeout, time.time() + 0.05)
+            return True
+        locals = { '_wait':two.symbols.ScriptFunc('wait', wait, yieldy=True) }
+        task.resetticks()
+        res = yield ctx.eval('_wait()', evaltype=EVALTYPE_CODE, locals=locals)
+        self.assertEqual(res, True)
+        task.resetticks()
+        task.timelimit = 0.01
+        with self.assertRaises(ExecRunawayException):
+            yield ctx.eval('_wait()', evaltype=EVALTYPE_CODE, locals=dict(locals))
+
+    @tornado.testing.gen_test
+    def test_profiler(self):
+        app = MockApplication()
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+        wid = ObjectId()
+        loctx = two.task.LocContext(uid=ObjectId(), wid=wid)
+
+        # Not profiled until the world is turned on.
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+        yield ctx.eval('_x = 1', evaltype=EVALTYPE_CODE)
+        self.assertEqual(app.profiler.entries(wid), [])
+
+        app.profiler.activate(wid)
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+        hook = {'type':'code', 'text':'_x = 1\n_y = _x + 1'}
+        yield ctx.eval(hook, evaltype=EVALTYPE_RAW, symbol='on_enter')
+        yield ctx.eval(hook, evaltype=EVALTYPE_RAW, symbol='on_enter')
+        yield ctx.eval('_x = 1', evaltype=EVALTYPE_CODE)
+        ls = app.profiler.entries(wid)
+        self.assertEqual([ ent.symbol for ent in ls ], ['on_enter', '[[_x = 1]]'])
+        self.assertEqual(ls[0].calls, 2)
+        self.assertEqual(ls[1].calls, 1)
+        self.assertGreater(ls[0].ticks, ls[1].ticks)
+        self.assertIsNone(ls[0].hitrate())
+        self.assertIn('"symbol": "on_enter"', app.profiler.dump_json(wid))
+
+        app.profiler.clear(wid)
+        self.assertEqual(app.profiler.entries(wid), [])
         
 
 from two.evalctx import LEVEL_EXECUTE, LEVEL_DISPSPECIAL, LEVEL_DISPLAY, LEVEL_MESSAGE, LEVEL_FLAT, LEVEL_RAW
@@ -0,0 +1,34 @@
+import logging
+import unittest
+
+from bson.objectid import ObjectId
+
+import two.occupancy
+
+class MockApplication:
+    def __init__(self):
+        self.log = logging.getLogger('tworld')
+
+class TestOccupancyIndex(unittest.TestCase):
+    def test_set_location(self):
+        index = two.occupancy.OccupancyIndex(MockApplication())
+        (uid1, uid2) = (ObjectId(), ObjectId())
+        (iid, loc1, loc2) = (ObjectId(), ObjectId(), ObjectId())
+
+        index.set_location(uid1, iid, loc1)
+        index.set_location(uid2, iid, loc1)
+        self.assertEqual(index.locmap, {(iid, loc1): set([uid1, uid2])})
+        self.assertEqual(index.instmap, {iid: set([uid1, uid2])})
+
+        index.set_location(uid1, iid, loc2)
+        self.assertEqual(index.locmap, {(iid, loc1): set([uid2]), (iid, loc2): set([uid1])})
+        self.assertEqual(index.instmap, {iid: set([uid1, uid2])})
+        self.assertEqual(index.uidmap[uid1][0:2], (iid, loc2))
+
+        # Moving to the void drops the player from the index.
+        index.set_location(uid2, None, None)
+        self.assertEqual(index.locmap, {(iid, loc2): set([uid1])})
+        index.set_location(uid1, None, None)
+        self.assertEqual(index.uidmap, {})
+        self.assertEqual(index.locmap, {})
+        self.assertEqual(index.instmap, {})
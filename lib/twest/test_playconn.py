@@ -0,0 +1,53 @@
+import logging
+import unittest
+
+from bson.objectid import ObjectId
+
+import two.execute
+import two.playconn
+from two.task import DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS
+
+class MockApplication:
+    def __init__(self):
+        self.log = logging.getLogger('tworld')
+
+class MockStream:
+    twwcid = 1
+    
+class TestDependencyIndex(unittest.TestCase):
+    def setUp(self):
+        self.table = two.playconn.PlayerConnectionTable(MockApplication())
+        self.stream = MockStream()
+        
+    def test_index(self):
+        table = self.table
+        conn1 = table.add(1, str(ObjectId()), 'one@example.com', self.stream)
+        conn2 = table.add(2, str(ObjectId()), 'two@example.com', self.stream)
+        keya = ('instanceprop', 'iid', 'loc', 'a')
+        keyb = ('instanceprop', 'iid', 'loc', 'b')
+        keyc = ('populace', 'iid', 'loc')
+
+        self.assertEqual(table.dirty_for_changes(set([keya])), {})
+        
+        table.set_dependencies(conn1, DIRTY_LOCALE, set([keya, keyb]))
+        table.set_dependencies(conn1, DIRTY_FOCUS, set([keya]))
+        table.set_dependencies(conn2, DIRTY_POPULACE, set([keyc]))
+        self.assertEqual(table.dirty_for_changes(set([keya])),
+                         {1: DIRTY_LOCALE|DIRTY_FOCUS})
+        self.assertEqual(table.dirty_for_changes(set([keyb, keyc])),
+                         {1: DIRTY_LOCALE, 2: DIRTY_POPULACE})
+
+        # Rebuilding a dependency set replaces the old one.
+        table.set_dependencies(conn1, DIRTY_LOCALE, set([keyc]))
+        self.assertEqual(table.dirty_for_changes(set([keyb])), {})
+        self.assertEqual(table.dirty_for_changes(set([keya])),
+                         {1: DIRTY_FOCUS})
+        self.assertEqual(table.dirty_for_changes(set([keyc])),
+                         {1: DIRTY_LOCALE, 2: DIRTY_POPULACE})
+
+        # Removing a connection removes it from the index.
+        table.remove(1)
+        self.assertEqual(table.dirty_for_changes(set([keya, keyb, keyc])),
+                         {2: DIRTY_POPULACE})
+        table.remove(2)
+        self.assertEqual(table.depindex, {})
@@ -100,3 +100,160 @@ class TestDeepCopy(unittest.TestCase):
         self.assertEqual(val[2], res[2])
         self.assertFalse(val[2]['z'] is res[2]['z'])
         self.assertEqual(val[2]['z'], res[2]['z'])
+
+class TestSharedPropCache(unittest.TestCase):
+    class DummyApp:
+        def __init__(self):
+            self.log = logging.getLogger('tworld')
+            
+    def test_store_get(self):
+        shared = two.propcache.SharedPropCache(self.DummyApp())
+        wid = ObjectId()
+        locid = ObjectId()
+        tup = ('worldprop', wid, locid, 'x')
+        
+        self.assertFalse(shared.has(tup))
+        shared.store(tup, True, [1, 2], shared.generation)
+        self.assertTrue(shared.has(tup))
+        (found, val) = shared.get(tup)
+        self.assertTrue(found)
+        self.assertEqual(val, [1, 2])
+        # Mutating the returned copy doesn't affect the cache.
+        val.append(3)
+        (found, val) = shared.get(tup)
+        self.assertEqual(val, [1, 2])
+
+        tup2 = ('worldprop', wid, locid, 'y')
+        shared.store(tup2, False, None, shared.generation)
+        self.assertTrue(shared.has(tup2))
+        self.assertEqual(shared.get(tup2), (False, None))
+        self.assertEqual(shared.hits, 2)
+        self.assertEqual(shared.misses, 1)
+
+    def test_invalidate(self):
+        shared = two.propcache.SharedPropCache(self.DummyApp())
+        wid = ObjectId()
+        locid = ObjectId()
+        tupx = ('worldprop', wid, locid, 'x')
+        tupy = ('worldprop', wid, locid, 'y')
+        tupz = ('worldprop', wid, None, 'z')
+        for tup in (tupx, tupy, tupz):
+            shared.store(tup, True, 1, shared.generation)
+            
+        shared.invalidate(tupx)
+        self.assertFalse(tupx in shared.map)
+        self.assertTrue(tupy in shared.map)
+        shared.invalidate(('worldprop', wid, locid, None))
+        self.assertFalse(tupy in shared.map)
+        self.assertTrue(tupz in shared.map)
+        # Unrelated change keys are ignored.
+        shared.invalidate(('portlist', ObjectId(), None))
+        self.assertTrue(tupz in shared.map)
+
+        # A read which straddles an invalidation is not stored.
+        generation = shared.generation
+        shared.invalidate(tupz)
+        shared.store(tupz, True, 2, generation)
+        self.assertFalse(tupz in shared.map)
+
+    def test_eviction(self):
+        shared = two.propcache.SharedPropCache(self.DummyApp())
+        shared.MAX_ENTRIES = 3
+        wid = ObjectId()
+        tups = [ ('worldprop', wid, None, 'key%d' % (ix,)) for ix in range(4) ]
+        for tup in tups[0:3]:
+            shared.store(tup, True, 1, shared.generation)
+        # Touch the oldest, so that the second-oldest goes first.
+        shared.get(tups[0])
+        shared.store(tups[3], True, 1, shared.generation)
+        self.assertEqual(len(shared.map), 3)
+        self.assertTrue(tups[0] in shared.map)
+        self.assertFalse(tups[1] in shared.map)
+        self.assertEqual(shared.totalsize, sum([ ent[2] for ent in shared.map.values() ]))
+
+    def test_full_scope(self):
+        shared = two.propcache.SharedPropCache(self.DummyApp())
+        wid = ObjectId()
+        locid = ObjectId()
+        scope = ('worldprop', wid, locid)
+        shared.store_scope(scope, {'desc':'Here.', 'x':[1]}, shared.generation)
+        self.assertTrue(shared.is_full_scope(scope))
+        self.assertTrue(shared.has(scope+('desc',)))
+        self.assertEqual(shared.get(scope+('x',)), (True, [1]))
+        # Keys we didn't see are known to be absent.
+        self.assertTrue(shared.has(scope+('nosuch',)))
+        self.assertEqual(shared.get(scope+('nosuch',)), (False, None))
+        # A new key in the scope makes it not-full.
+        shared.invalidate(scope+('nosuch',))
+        self.assertFalse(shared.is_full_scope(scope))
+        self.assertFalse(shared.has(scope+('nosuch',)))
+        self.assertTrue(shared.has(scope+('desc',)))
+
+    def test_expiry(self):
+        shared = two.propcache.SharedPropCache(self.DummyApp())
+        shared.TTL = -1
+        wid = ObjectId()
+        locid = ObjectId()
+        tup = ('worldprop', wid, locid, 'x')
+        shared.store(tup, True, 1, shared.generation)
+        self.assertFalse(shared.has(tup))
+        self.assertFalse(tup in shared.map)
+        scope = ('worldprop', wid, locid)
+        shared.store_scope(scope, {'desc':'Here.'}, shared.generation)
+        self.assertFalse(shared.is_full_scope(scope))
+        self.assertFalse(shared.has(scope+('nosuch',)))
+
+class TestTracked(unittest.TestCase):
+    def test_track(self):
+        tracker = two.propcache.MutationTracker()
+        val = [1, [2, {}], {'x':'y', 'z':[1,2]}]
+        res = two.propcache.track(val, tracker)
+        self.assertEqual(val, res)
+        self.assertFalse(val is res)
+        self.assertTrue(isinstance(res, list))
+        self.assertTrue(isinstance(res[1], two.propcache.TrackedList))
+        self.assertTrue(isinstance(res[2], two.propcache.TrackedDict))
+        self.assertTrue(isinstance(res[2]['z'], two.propcache.TrackedList))
+        self.assertFalse(tracker.changed)
+
+        # Reading doesn't count.
+        res[2].get('x')
+        res[1][0]
+        len(res)
+        self.assertFalse(tracker.changed)
+
+        # Mutation at any depth does.
+        res[2]['z'].append(3)
+        self.assertTrue(tracker.changed)
+        tracker.changed = False
+        res[1][1]['w'] = 1
+        self.assertTrue(tracker.changed)
+        tracker.changed = False
+        res[2].setdefault('q', 2)
+        self.assertTrue(tracker.changed)
+        tracker.changed = False
+        res += [5]
+        self.assertTrue(tracker.changed)
+        tracker.changed = False
+        res[2] |= {'x':'yy'}
+        self.assertTrue(tracker.changed)
+        self.assertTrue(isinstance(res[2], two.propcache.TrackedDict))
+        self.assertEqual(res[2]['x'], 'yy')
+
+    def test_equal_values(self):
+        # Changes that compare equal are still changes.
+        ent = two.propcache.PropEntry([1], ('instanceprop', None, None, 'x'), {})
+        self.assertTrue(ent.mutable)
+        self.assertFalse(ent.isdirty())
+        ent.val[0] = 1.0
+        self.assertTrue(ent.isdirty())
+        ent.mark_clean()
+        self.assertFalse(ent.isdirty())
+        
+    def test_dirty_entry(self):
+        # A dirty entry keeps the caller's object.
+        val = {'a':1}
+        ent = two.propcache.PropEntry(val, ('instanceprop', None, None, 'x'), {}, dirty=True)
+        self.assertTrue(ent.val is val)
+        self.assertEqual(ent.id, id(val))
+        self.assertTrue(ent.isdirty())
@@ -0,0 +1,125 @@
+import logging
+import unittest
+
+from bson.objectid import ObjectId
+
+import twcommon.misc
+import two.execute
+import two.task
+import two.profiler
+import two.rendercache
+from two.rendercache import RenderEntry
+from two.evalctx import EvalPropContext, LEVEL_DISPLAY
+
+class MockApplication:
+    def __init__(self):
+        self.log = logging.getLogger('tworld')
+        self.profiler = two.profiler.ScriptProfiler(self)
+
+class TestRenderCache(unittest.TestCase):
+    def test_versions(self):
+        cache = two.rendercache.RenderCache(MockApplication())
+        (iid, locid) = (ObjectId(), ObjectId())
+        key1 = ('instanceprop', iid, locid, 'desc')
+        key2 = ('instanceprop', iid, locid, 'lamp')
+
+        ent = RenderEntry(cache.counter, 'A room.', {}, frozenset([key1, key2]))
+        self.assertTrue(cache.is_current(ent))
+        cache.note_changes(set([('instanceprop', iid, None, 'desc')]))
+        self.assertTrue(cache.is_current(ent))
+        cache.note_changes(set([key2]))
+        self.assertFalse(cache.is_current(ent))
+
+        # A later stamp is unaffected by the earlier change.
+        ent = RenderEntry(cache.counter, 'A room.', {}, frozenset([key1, key2]))
+        self.assertTrue(cache.is_current(ent))
+        # A wildcard change covers every key in the location.
+        cache.note_changes(set([('instanceprop', iid, locid, None)]))
+        self.assertFalse(cache.is_current(ent))
+
+        ent = RenderEntry(cache.counter, 'A room.', {}, frozenset([key1]))
+        self.assertTrue(cache.is_current(ent))
+        cache.clear()
+        self.assertFalse(cache.is_current(ent))
+        self.assertEqual(cache.versions, {})
+
+    def test_interleaved_tasks(self):
+        app = MockApplication()
+        cache = two.rendercache.RenderCache(app)
+        (iid, locid, otherlocid) = (ObjectId(), ObjectId(), ObjectId())
+        key1 = ('instanceprop', iid, locid, 'desc')
+        key2 = ('instanceprop', iid, locid, 'lamp')
+        otherkey = ('instanceprop', iid, otherlocid, 'desc')
+
+        # Two tasks start; the other one finishes first, changing
+        # something elsewhere. Then our task changes the lamp.
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+        task.renderstamp = cache.counter
+        othertask = two.task.Task(app, None, 3, 4, twcommon.misc.now())
+        othertask.renderstamp = cache.counter
+        cache.note_changes(set([otherkey]))
+        othertask.renderversion = cache.counter
+        # Before our changes are noted, we can only use our start stamp.
+        self.assertEqual(cache.stamp_for(task, frozenset([key1, key2])), task.renderstamp)
+        cache.note_changes(set([key2]))
+        task.renderversion = cache.counter
+
+        # What we render now is good as of our own changes.
+        stamp = cache.stamp_for(task, frozenset([key1, key2]))
+        self.assertEqual(stamp, task.renderversion)
+        ent = RenderEntry(stamp, 'A room.', {}, frozenset([key1, key2]))
+        self.assertTrue(cache.is_current(ent))
+        # But not if the other task touched one of our dependencies.
+        stamp = cache.stamp_for(task, frozenset([key1, otherkey]))
+        self.assertEqual(stamp, task.renderstamp)
+        ent = RenderEntry(stamp, 'A room.', {}, frozenset([key1, otherkey]))
+        self.assertFalse(cache.is_current(ent))
+        # Later changes invalidate it in the usual way.
+        ent = RenderEntry(cache.stamp_for(task, frozenset([key1, key2])), 'A room.', {}, frozenset([key1, key2]))
+        cache.note_changes(set([key1]))
+        self.assertFalse(cache.is_current(ent))
+        # And so does a change that landed after our own.
+        self.assertEqual(cache.stamp_for(task, frozenset([key1, key2])), task.renderstamp)
+
+    def test_expiry(self):
+        cache = two.rendercache.RenderCache(MockApplication())
+        ent = RenderEntry(cache.counter, 'A room.', {}, frozenset())
+        cache.cache.set('key', ent)
+        self.assertIs(cache.lookup('key'), ent)
+        cache.TTL = -1
+        self.assertIsNone(cache.lookup('key'))
+
+    def test_rekey_description(self):
+        rekey = two.rendercache.rekey_description
+        (desc, targets) = rekey('A room.', {})
+        self.assertEqual(desc, 'A room.')
+        self.assertEqual(targets, {})
+
+        desc = ['A ', ['link', 'k1'], 'door', ['endlink'], ' and a ', ['link', 'k2'], 'window', ['endlink'], '.']
+        (newdesc, newtargets) = rekey(desc, {'k1':'opendoor', 'k2':'window'})
+        self.assertEqual(len(newtargets), 2)
+        self.assertNotIn('k1', newtargets)
+        self.assertNotIn('k2', newtargets)
+        self.assertEqual(newtargets[newdesc[1][1]], 'opendoor')
+        self.assertEqual(newtargets[newdesc[5][1]], 'window')
+        self.assertEqual(newdesc[2:5], desc[2:5])
+        # The original is unchanged.
+        self.assertEqual(desc[1], ['link', 'k1'])
+
+    def test_player_independent(self):
+        app = MockApplication()
+        task = two.task.Task(app, None, 1, 2, twcommon.misc.now())
+        uid = ObjectId()
+        (iid, locid) = (ObjectId(), ObjectId())
+        loctx = two.task.LocContext(uid=uid, iid=iid, locid=locid)
+
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
+        ent = RenderEntry(0, 'A room.', {}, frozenset([('instanceprop', iid, locid, 'desc'), ('iplayerprop', iid, None, 'hat')]))
+        self.assertTrue(two.rendercache.is_player_independent(ctx, ent))
+        # Asking who the player is makes it player-specific.
+        self.assertEqual(ctx.uid, uid)
+        self.assertFalse(two.rendercache.is_player_independent(ctx, ent))
+
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
+        ent = RenderEntry(0, 'A room.', {}, frozenset([('instanceprop', iid, locid, 'desc'), ('iplayerprop', iid, uid, 'hat')]))
+        self.assertFalse(two.rendercache.is_player_independent(ctx, ent))
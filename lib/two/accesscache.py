@@ -0,0 +1,58 @@
+"""
+Access cache: remembers players' access levels to scopes, as computed by
+scope_access_level().
+
+An access level depends on the scope document, the world's creator (for
+the global scope), and the scopeaccess table. The first two are fixed
+once created. tworld never writes the scopeaccess table; tweb only
+inserts rows for brand-new scopes. If that ever changes, send a
+notifyentitychange command with collection 'scopeaccess' and the player's
+uid. As a backstop, every entry expires after TTL seconds.
+"""
+
+import time
+
+import twcommon.misc
+
+class AccessCache(object):
+    """AccessCache maps (uid, wid, scid) triples to access levels.
+    (The wid only matters for the global scope, but it's cheaper to
+    include it than to look up the scope type first.)
+    """
+    MAX_ENTRIES = 10000
+    TTL = 300  # seconds
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = twcommon.misc.LRUCache(self.MAX_ENTRIES, name='AccessCache')
+        # Bumped on every invalidation. A check that started before an
+        # invalidation doesn't store its (possibly stale) result.
+        self.generation = 0
+
+    def __repr__(self):
+        return '<AccessCache: %d entries; %d hits, %d misses>' % (len(self.cache), self.cache.hits, self.cache.misses)
+
+    def get(self, uid, wid, scid):
+        """Return the cached access level, or None if it's not cached
+        (or has expired).
+        """
+        key = (uid, wid, scid)
+        ent = self.cache.get(key)
+        if ent is None:
+            return None
+        (expiry, level) = ent
+        if expiry < time.monotonic():
+            self.cache.discard(key)
+            return None
+        return level
+
+    def set(self, uid, wid, scid, level, generation):
+        if generation == self.generation:
+            self.cache.set((uid, wid, scid), (time.monotonic() + self.TTL, level))
+
+    def clear(self):
+        """Drop everything. (Access changes are rare enough that it's not
+        worth indexing the entries by player.)
+        """
+        self.generation += 1
+        self.cache.clear()
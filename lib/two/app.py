@@ -6,6 +6,7 @@ import signal
 
 import tornado.ioloop
 import tornado.gen
+import tornado.stack_context
 
 import motor
 
@@ -17,12 +18,20 @@ import two.commands
 import two.symbols
 import two.task
 import two.propcache
-from two.evalctx import EvalPropContext
+import two.playercache
+import two.occupancy
+import two.entitycache
+import two.rendercache
+import two.accesscache
+import two.profiler
 import twcommon.misc
 import twcommon.autoreload
 from twcommon import wcproto
 
 class Tworld(object):
+    # How many tasks (in different lanes) may run at once.
+    TASK_CONCURRENCY_LIMIT = 16
+    
     def __init__(self, opts):
         self.opts = opts
         self.log = logging.getLogger('tworld')
@@ -42,15 +51,44 @@ class Tworld(object):
         self.mongomgr = two.mongomgr.MongoMgr(self)
         self.ipool = two.ipool.InstancePool(self)
 
-        # The command queue.
+        # The command queue. Commands are partitioned into lanes (one per
+        # instance, one per player in the void, plus the global lane for
+        # server-wide commands). See pop_queue().
         self.queue = []
-        self.commandbusy = False
+        self.dispatching = False
+        self.dispatchagain = False
+        # Maps lane keys to the running Task in that lane.
+        self.runninglanes = {}
+        # uids of players who have a command running.
+        self.runninguids = set()
+        # True when a global-lane command is running.
+        self.globalbusy = False
+
+        # The long-lived property cache, underneath the per-task ones.
+        self.sharedpropcache = two.propcache.SharedPropCache(self)
+        # Player names, pronouns, and descs.
+        self.playercache = two.playercache.PlayerCache(self)
+        # Which players are in which locations.
+        self.occupancy = two.occupancy.OccupancyIndex(self)
+        # Worlds, scopes, instances, locations, portlists, and config values.
+        self.entitycache = two.entitycache.EntityCache(self)
+        # Rendered location descriptions.
+        self.rendercache = two.rendercache.RenderCache(self)
+        # Players' access levels to scopes.
+        self.accesscache = two.accesscache.AccessCache(self)
+        # Per-symbol script costs, for worlds that are being profiled.
+        self.profiler = two.profiler.ScriptProfiler(self, allworlds=opts.script_profile)
 
         # Miscellaneous.
+        # The propcache of whichever task is currently executing. (Each
+        # Task has its own; Task.activate() swaps it in.)
         self.propcache = None
         self.caughtinterrupt = False
         self.shuttingdown = False
         self.debugstacktraces = opts.show_stack_traces
+        # Wall-clock limit on each phase of a task (seconds), or None
+        # for the default. See Task.WALL_TIME_LIMIT.
+        self.scripttimelimit = opts.script_time_limit
 
         # When the IOLoop starts, we'll set up periodic tasks.
         tornado.ioloop.IOLoop.instance().add_callback(self.init_timers)
@@ -173,31 +211,154 @@ class Tworld(object):
             obj = wcproto.namespace_wrapper(obj)
         # If this command was caused by a message from tweb, twwcid is
         # its ID number. We will rarely need this.
-        self.queue.append( (obj, connid, twwcid, twcommon.misc.now()) )
-        
-        if not self.commandbusy:
+        self.queue.append(QueuedCommand(obj, connid, twwcid, twcommon.misc.now()))
+
+        # Whatever stack context we're in (possibly some task's), the
+        # dispatcher runs outside it.
+        with tornado.stack_context.NullContext():
             self.ioloop.add_callback(self.pop_queue)
 
+    def command_lane_is_global(self, qcmd):
+        """Decide (synchronously) whether a queued command must run in the
+        global lane -- that is, with no other command running at all. This
+        is true of server commands (unless they declare instancelane) and
+        of player commands on a connection we don't know yet (playeropen).
+
+        For a non-global player command, this also fills in qcmd.uid.
+        """
+        cmd = self.all_commands.get(qcmd.cmdobj.cmd, None)
+        if qcmd.connid == 0:
+            if cmd and cmd.instancelane and getattr(qcmd.cmdobj, 'iid', None):
+                qcmd.lane = ('instance', qcmd.cmdobj.iid)
+                return False
+            return True
+        conn = self.playconns.get(qcmd.connid)
+        if not conn or not cmd or not self.mongodb:
+            return True
+        qcmd.uid = conn.uid
+        return False
+
     @tornado.gen.coroutine
-    def pop_queue(self):
-        if self.commandbusy:
-            self.log.warning('pop_queue called when already busy!')
-            return
+    def find_command_lane(self, qcmd):
+        """Work out which lane a (non-global) queued command belongs in.
+        Player commands go in the lane of the instance the player is in,
+        or a lane of their own if they're in the void.
+
+        The caller guarantees that no earlier command for the same player
+        is queued or running. But other commands (an instancelane server
+        command, say) can still move the player while this one waits, so
+        we work the lane out afresh on every dispatch pass rather than
+        keeping it from an earlier one. (We ask the occupancy index, which
+        is authoritative, so this doesn't normally touch the database.)
+        """
+        if qcmd.uid is None:
+            # A server command; its lane was fixed when it was queued.
+            return qcmd.lane
+        loc = yield self.occupancy.location_of(qcmd.uid)
+        if loc:
+            qcmd.lane = ('instance', loc[0])
+        else:
+            qcmd.lane = ('player', qcmd.uid)
+        return qcmd.lane
 
-        if not self.queue:
-            self.log.warning('pop_queue called when already empty!')
-            return
+    @tornado.gen.coroutine
+    def pop_queue(self):
+        """Start as many queued commands as the lane rules allow.
 
-        (cmdobj, connid, twwcid, queuetime) = self.queue.pop(0)
+        Commands in the same lane run strictly in queue order. Commands
+        for the same player also run in queue order, whatever lane they
+        land in. A global-lane command is a barrier: it waits until
+        everything queued before it has finished, and nothing queued after
+        it starts until it is done.
 
-        task = two.task.Task(self, cmdobj, connid, twwcid, queuetime)
-        self.commandbusy = True
+        Only one pop_queue pass runs at a time; if we're called during a
+        pass (because a task finished, or something was queued), the pass
+        goes around again.
+        """
+        if self.dispatching:
+            self.dispatchagain = True
+            return
 
-        EvalPropContext.context_stack.clear()
+        self.dispatching = True
+        try:
+            self.dispatchagain = True
+            while self.dispatchagain:
+                self.dispatchagain = False
+                yield self.dispatch_pass()
+        except Exception as ex:
+            self.log.error('Error dispatching command queue', exc_info=True)
+        finally:
+            self.dispatching = False
 
+    @tornado.gen.coroutine
+    def dispatch_pass(self):
+        blockeduids = set()
+        blockedlanes = set()
+        index = 0
+        while index < len(self.queue):
+            if self.globalbusy or self.shuttingdown:
+                return
+            if len(self.runninglanes) >= self.TASK_CONCURRENCY_LIMIT:
+                return
+            qcmd = self.queue[index]
+            if self.command_lane_is_global(qcmd):
+                if index == 0 and not self.runninglanes:
+                    self.queue.pop(0)
+                    self.start_task(qcmd, None)
+                # Nothing after this starts until it has.
+                return
+            uid = qcmd.uid
+            if uid is not None:
+                if uid in self.runninguids or uid in blockeduids:
+                    blockeduids.add(uid)
+                    index += 1
+                    continue
+                # Hold this player while we look up the lane; we're
+                # about to start (or skip) this command either way.
+                blockeduids.add(uid)
+            lane = yield self.find_command_lane(qcmd)
+            if lane in self.runninglanes or lane in blockedlanes:
+                blockedlanes.add(lane)
+                index += 1
+                continue
+            blockedlanes.add(lane)
+            # The queue may have grown during the yield, but only this
+            # pass removes entries, so qcmd is still at index.
+            assert self.queue[index] is qcmd
+            self.queue.pop(index)
+            self.start_task(qcmd, lane)
+
+    def start_task(self, qcmd, lane):
+        """Begin running a queued command as a Task. This returns
+        immediately; the task runs on the ioloop, in its own stack context,
+        until run_task finishes.
+
+        The lane is None for the global lane.
+        """
+        task = two.task.Task(self, qcmd.cmdobj, qcmd.connid, qcmd.twwcid, qcmd.queuetime)
         # Set up a property cache (only for the duration of the task).
-        self.propcache = two.propcache.PropCache(self)
+        task.propcache = two.propcache.PropCache(self)
+        # Anything the task renders is stamped as of now, since the
+        # propcache may hold values from now on.
+        task.renderstamp = self.rendercache.counter
+        if self.scripttimelimit:
+            task.timelimit = self.scripttimelimit
+
+        if lane is None:
+            self.globalbusy = True
+        else:
+            self.runninglanes[lane] = task
+            if qcmd.uid is not None:
+                self.runninguids.add(qcmd.uid)
+        
+        with tornado.stack_context.NullContext():
+            with tornado.stack_context.StackContext(task.activate):
+                self.run_task(task, qcmd, lane)
 
+    @tornado.gen.coroutine
+    def run_task(self, task, qcmd, lane):
+        cmdobj = task.cmdobj
+        
         # Handle the command.
         try:
             yield task.handle()
@@ -214,31 +375,52 @@ class Tworld(object):
             except Exception as ex:
                 self.log.error('Error resolving task: %s', cmdobj, exc_info=True)
 
-        if EvalPropContext.context_stack:
-            self.log.error('EvalPropContext.context_stack has %d entries remaining at end of task!', len(EvalPropContext.context_stack))
-            
         task.resetticks()
 
         # Write back any necessary property DB changes and drop the propcache.
         try:
-            yield self.propcache.write_all_dirty()
+            yield task.propcache.write_all_dirty()
         except Exception as ex:
             self.log.error('Error clearing propcache: %s', cmdobj, exc_info=True)
-        self.propcache.final()
-        self.propcache = None
+        task.propcache.final()
         
         starttime = task.starttime
         endtime = twcommon.misc.now()
         self.log.info('Finished command in %.3f ms (queued for %.3f ms); %d ticks max, %d ticks total',
                       (endtime-starttime).total_seconds() * 1000,
-                      (starttime-queuetime).total_seconds() * 1000,
+                      (starttime-qcmd.queuetime).total_seconds() * 1000,
                       task.maxcputicks,
                       task.totalcputicks)
 
-        self.commandbusy = False
+        if lane is None:
+            self.globalbusy = False
+        else:
+            del self.runninglanes[lane]
+            if qcmd.uid is not None:
+                self.runninguids.discard(qcmd.uid)
         task.close()
 
         # Keep popping, if the queue is nonempty.
         if self.queue:
-            self.ioloop.add_callback(self.pop_queue)
-
+            with tornado.stack_context.NullContext():
+                self.ioloop.add_callback(self.pop_queue)
+
+
+class QueuedCommand(object):
+    """Pure-data class: one entry in the command queue.
+    """
+    def __init__(self, cmdobj, connid, twwcid, queuetime):
+        self.cmdobj = cmdobj
+        self.connid = connid
+        self.twwcid = twwcid
+        self.queuetime = queuetime
+        # The player who sent this, for player commands.
+        self.uid = None
+        # The lane key: ('instance', iid) or ('player', uid). For player
+        # commands, this is worked out again on each dispatch pass, since
+        # the player may move while the command waits. (Global-lane
+        # commands leave this None.)
+        self.lane = None
+
+    def __repr__(self):
+        return '<QueuedCommand %s connid=%s lane=%s>' % (self.cmdobj.cmd, self.connid, self.lane)
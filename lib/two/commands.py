@@ -16,7 +16,7 @@ class Command:
     # in this dict.
     all_commands = {}
 
-    def __init__(self, name, func, isserver=False, restrict=None, noneedmongo=False, preconnection=False, doeswrite=False):
+    def __init__(self, name, func, isserver=False, restrict=None, noneedmongo=False, preconnection=False, doeswrite=False, instancelane=False):
         self.name = name
         self.func = tornado.gen.coroutine(func)
         # isserver could be merged into restrict='server', since restrict
@@ -26,6 +26,11 @@ class Command:
         self.noneedmongo = noneedmongo
         self.preconnection = preconnection
         self.doeswrite = doeswrite
+        # Server commands normally run in the global lane, exclusive of
+        # everything else. If instancelane is set, the command carries
+        # an iid and only touches that instance, so it can run alongside
+        # commands in other instances.
+        self.instancelane = instancelane
         
     def __repr__(self):
         return '<Command "%s">' % (self.name,)
@@ -86,6 +91,13 @@ def define_commands():
     def cmd_dbconnected(app, task, cmd, stream):
         # We've connected (or reconnected) to mongodb. Re-synchronize any
         # data that we had cached from there.
+
+        # We may have missed build changes while disconnected.
+        app.sharedpropcache.clear()
+        app.playercache.clear()
+        app.entitycache.clear()
+        app.rendercache.clear()
+        app.accesscache.clear()
         
         # First, grab and then update the lastactive value.
         lastactive = None
@@ -109,18 +121,13 @@ def define_commands():
         except Exception as ex:
             task.log.warning('Caught exception (loading localization data): %s', ex, exc_info=app.debugstacktraces)
 
+        # Load up the occupancy index.
+        yield app.occupancy.rebuild()
+
         # Awaken any inhabited instances. If an instance is marked awake
         # but uninhabited, put it to sleep.
         # Go through the list of players who are in the world.
-        inhabset = set()
-        cursor = app.mongodb.playstate.find({'iid':{'$ne':None}},
-                                            {'_id':1, 'iid':1})
-        while (yield cursor.fetch_next):
-            playstate = cursor.next_object()
-            iid = playstate['iid']
-            if iid:
-                inhabset.add(iid)
-        # cursor autoclose
+        inhabset = yield app.occupancy.inhabited_instances()
         # Go through the list of apparently-awake instances.
         awakeset = set()
         cursor = app.mongodb.instances.find({'lastawake':True},
@@ -143,6 +150,7 @@ def define_commands():
                 yield motor.Op(app.mongodb.instances.update,
                                {'_id':iid},
                                {'$set':{'lastawake':lastactive}})
+                app.entitycache.invalidate('instances', iid)
                 continue
             # Instance should be awake. Call the hook and set lastawake true.
             # The hook's _slept argument will be lastactive.
@@ -152,8 +160,8 @@ def define_commands():
                 yield motor.Op(app.mongodb.instances.update,
                                {'_id':iid},
                                {'$set':{'lastawake':True}})
-                instance = yield motor.Op(app.mongodb.instances.find_one,
-                                          {'_id':iid})
+                app.entitycache.invalidate('instances', iid)
+                instance = yield app.entitycache.get('instances', iid)
                 loctx = two.task.LocContext(None, wid=instance['wid'], scid=instance['scid'], iid=iid)
                 task.resetticks()
                 # If the instance/world has an on_wake property, run it.
@@ -165,7 +173,7 @@ def define_commands():
                     ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                     try:
                         args = { '_slept':lastactive }
-                        yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW, locals=args)
+                        yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW, symbol='on_wake', locals=args)
                     except Exception as ex:
                         task.log.warning('Caught exception (awakening instance): %s', ex, exc_info=app.debugstacktraces)
 
@@ -179,15 +187,7 @@ def define_commands():
                        {'key':'lastactive'},
                        {'key':'lastactive', 'val':task.starttime}, upsert=True)
         # Go through the list of players who are in the world.
-        iidset = set()
-        cursor = app.mongodb.playstate.find({'iid':{'$ne':None}},
-                                            {'_id':1, 'iid':1})
-        while (yield cursor.fetch_next):
-            playstate = cursor.next_object()
-            iid = playstate['iid']
-            if iid:
-                iidset.add(iid)
-        # cursor autoclose
+        iidset = yield app.occupancy.inhabited_instances()
         iidls = list(iidset)
         for iid in iidls:
             instance = app.ipool.get(iid)
@@ -203,8 +203,8 @@ def define_commands():
                 yield motor.Op(app.mongodb.instances.update,
                                {'_id':iid},
                                {'$set':{'lastawake':task.starttime}})
-                instance = yield motor.Op(app.mongodb.instances.find_one,
-                                          {'_id':iid})
+                app.entitycache.invalidate('instances', iid)
+                instance = yield app.entitycache.get('instances', iid)
                 loctx = two.task.LocContext(None, wid=instance['wid'], scid=instance['scid'], iid=iid)
                 task.resetticks()
                 # If the instance/world has an on_sleep property, run it.
@@ -215,21 +215,19 @@ def define_commands():
                 if sleephook and twcommon.misc.is_typed_dict(sleephook, 'code'):
                     ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                     try:
-                        yield ctx.eval(sleephook, evaltype=EVALTYPE_RAW)
+                        yield ctx.eval(sleephook, evaltype=EVALTYPE_RAW, symbol='on_sleep')
                     except Exception as ex:
                         task.log.warning('Caught exception (sleeping instance): %s', ex, exc_info=app.debugstacktraces)
                 app.ipool.remove_instance(iid)
     
-    @command('sleepinstance', isserver=True)
+    @command('sleepinstance', isserver=True, instancelane=True)
     def cmd_sleepinstance(app, task, cmd, stream):
         inst = app.ipool.get(cmd.iid)
         if not inst:
             task.log.warning('sleepinstance: instance is not awake (%s)', cmd.iid)
             return
-        cursor = app.mongodb.playstate.find({'iid':cmd.iid},
-                                            {'_id':1})
-        res = yield motor.Op(cursor.count)
-        # cursor autoclose
+        ls = yield app.occupancy.players_at(cmd.iid)
+        res = len(ls)
         if res:
             task.log.warning('sleepinstance: unable to sleep instance because %d players are present', res)
             return
@@ -277,15 +275,12 @@ def define_commands():
         # disconnected.
         ls = []
         inworld = 0
-        cursor = app.mongodb.playstate.find({'iid':{'$ne':None}},
-                                            {'_id':1})
-        while (yield cursor.fetch_next):
-            playstate = cursor.next_object()
-            conncount = app.playconns.count_for_uid(playstate['_id'])
+        uids = yield app.occupancy.players_in_world()
+        for uid in uids:
+            conncount = app.playconns.count_for_uid(uid)
             inworld += 1
             if not conncount:
-                ls.append(playstate['_id'])
-        # cursor autoclose
+                ls.append(uid)
 
         app.log.info('checkdisconnected: %d players in world, %d are disconnected', inworld, len(ls))
         ### Keep a two-strikes list, so that players are knocked out after some minimum interval
@@ -309,7 +304,7 @@ def define_commands():
                 else:
                     args = { '_from':None,
                              '_to':None }
-                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, symbol='on_leave', locals=args)
             except Exception as ex:
                 task.log.warning('Caught exception (leaving loc, linkout): %s', ex, exc_info=app.debugstacktraces)
             ctx = None
@@ -321,9 +316,7 @@ def define_commands():
         task.write_event(cmd.uid, app.localize('action.portout')) # 'The world fades away.'
         others = yield task.find_locale_players(uid=cmd.uid, notself=True)
         if others:
-            res = yield motor.Op(app.mongodb.players.find_one,
-                                 {'_id':cmd.uid},
-                                 {'name':1})
+            res = yield app.playercache.get(cmd.uid)
             playername = res['name']
             task.write_event(others, app.localize('action.oportout') % (playername,)) # '%s disappears.'
         # Move the player to the void.
@@ -333,6 +326,7 @@ def define_commands():
                                 'portto':portto,
                                 'lastlocid': None,
                                 'lastmoved':task.starttime }})
+        app.occupancy.set_location(cmd.uid, None, None)
         task.set_dirty(cmd.uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_WORLD | DIRTY_POPULACE)
         task.set_data_change( ('playstate', cmd.uid, 'iid') )
         task.set_data_change( ('playstate', cmd.uid, 'locid') )
@@ -346,14 +340,13 @@ def define_commands():
     def cmd_logplayerconntable(app, task, cmd, stream):
         app.playconns.dumplog()
         
-    @command('timerevent', isserver=True, doeswrite=True)
+    @command('timerevent', isserver=True, doeswrite=True, instancelane=True)
     def cmd_timerevent(app, task, cmd, stream):
         iid = cmd.iid
         instance = app.ipool.get(iid)
         if not instance:
             raise ErrorMessageException('instance is not awake')
-        instance = yield motor.Op(app.mongodb.instances.find_one,
-                                  {'_id':iid})
+        instance = yield app.entitycache.get('instances', iid)
         loctx = two.task.LocContext(None, wid=instance['wid'], scid=instance['scid'], iid=iid)
         func = cmd.func
         if twcommon.misc.is_typed_dict(func, 'code'):
@@ -403,8 +396,8 @@ def define_commands():
             ls.append(portal)
         # cursor autoclose
         map = {}
-        for portal in ls:
-            desc = yield two.execute.portal_description(app, portal, conn.uid, uidiid=iid, location=True, short=True)
+        descs = yield two.execute.portal_descriptions(app, ls, conn.uid, uidiid=iid, location=True, short=True)
+        for (portal, desc) in zip(ls, descs):
             if desc:
                 strid = str(portal['_id'])
                 desc['portid'] = strid
@@ -425,8 +418,7 @@ def define_commands():
             return
 
         map = {}
-        config = yield motor.Op(app.mongodb.config.find_one,
-                                {'key':'globalscopeid'})
+        config = yield app.entitycache.get_config('globalscopeid')
         scope = yield two.execute.scope_description(app, config['val'], conn.uid)
         if scope:
             map[scope['id']] = scope
@@ -446,15 +438,13 @@ def define_commands():
         wid = ObjectId(cmd.wid)
         locid = ObjectId(cmd.locid)
         
-        world = yield motor.Op(app.mongodb.worlds.find_one,
-                                {'_id':wid})
+        world = yield app.entitycache.get('worlds', wid)
         if not world:
             raise ErrorMessageException('buildcopyportal: no such world: %s' % (wid,))
         if world['creator'] != uid:
             raise ErrorMessageException('buildcopyportal: world not owned by player: %s' % (wid,))
 
-        loc = yield motor.Op(app.mongodb.locations.find_one,
-                             {'_id':locid})
+        loc = yield app.entitycache.get('locations', locid)
         if not loc:
             raise ErrorMessageException('buildcopyportal: no such location: %s' % (locid,))
 
@@ -467,8 +457,7 @@ def define_commands():
         # a new link to his own world. We go with a global-scope link,
         # unless the world is personal-only.
         if world['instancing'] != 'solo':
-            config = yield motor.Op(app.mongodb.config.find_one,
-                                    {'key':'globalscopeid'})
+            config = yield app.entitycache.get_config('globalscopeid')
             scid = config['val']
         else:
             scid = player['scid']
@@ -482,17 +471,33 @@ def define_commands():
         # We may need to handle other data-key formats eventually. But
         # right now, it's all [db, wid, locid/uid, key] where db is
         # 'worldprop' or 'wplayerprop' and the id values may be None
-        # or ObjectId.
-        ### All of this prop-access stuff will need to go through the 
-        ### propcache, when the propcache has a lifespan.
+        # or ObjectId. (Or ['portlist', plistid, None].) A key of None
+        # means every key in that location.
         if type(ls[1]) is str:
             ls[1] = ObjectId(ls[1])
         if type(ls[2]) is str:
             ls[2] = ObjectId(ls[2])
         key = tuple(ls)
         app.log.info('Build change notification: %s', key)
+        app.sharedpropcache.invalidate(key)
+        if key[0] == 'players':
+            app.playercache.invalidate(key[1])
         task.set_data_change(key)
         
+    @command('notifyentitychange', isserver=True)
+    def cmd_notifyentitychange(app, task, cmd, stream):
+        # A world or location document has been changed by a build page.
+        # Drop it from the entity cache. (Or a player's flags, or their
+        # scopeaccess rows, have been changed by an admin page.)
+        app.log.info('Build entity change notification: %s %s', cmd.collection, cmd.id)
+        if cmd.collection == 'players':
+            app.playercache.invalidate(ObjectId(cmd.id))
+            app.accesscache.clear()
+        elif cmd.collection == 'scopeaccess':
+            app.accesscache.clear()
+        else:
+            app.entitycache.invalidate(cmd.collection, ObjectId(cmd.id))
+        
     @command('playeropen', noneedmongo=True, preconnection=True)
     def cmd_playeropen(app, task, cmd, conn):
         assert conn is None, 'playeropen command with connection not None'
@@ -554,11 +559,9 @@ def define_commands():
                 newlocid = res['locid']
             else:
                 # Last hope: the start world.
-                res = yield motor.Op(app.mongodb.config.find_one,
-                                     {'key':'startworldloc'})
+                res = yield app.entitycache.get_config('startworldloc')
                 lockey = res['val']
-                res = yield motor.Op(app.mongodb.config.find_one,
-                                     {'key':'startworldid'})
+                res = yield app.entitycache.get_config('startworldid')
                 newwid = res['val']
                 newscid = player['scid']
                 res = yield motor.Op(app.mongodb.locations.find_one,
@@ -596,7 +599,7 @@ def define_commands():
             if inithook and twcommon.misc.is_typed_dict(inithook, 'code'):
                 ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                 try:
-                    yield ctx.eval(inithook, evaltype=EVALTYPE_RAW)
+                    yield ctx.eval(inithook, evaltype=EVALTYPE_RAW, symbol='on_init')
                 except Exception as ex:
                     task.log.warning('Caught exception (initing instance): %s', ex, exc_info=app.debugstacktraces)
                 ctx = None
@@ -615,6 +618,7 @@ def define_commands():
             yield motor.Op(app.mongodb.instances.update,
                            {'_id':newiid},
                            {'$set':{'lastawake':True}})
+            app.entitycache.invalidate('instances', newiid)
             loctx = two.task.LocContext(None, wid=newwid, scid=newscid, iid=newiid)
             task.resetticks()
             # If the instance/world has an on_wake property, run it.
@@ -626,7 +630,7 @@ def define_commands():
                 ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                 try:
                     args = { '_slept':lastawake }
-                    yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW, locals=args)
+                    yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW, symbol='on_wake', locals=args)
                 except Exception as ex:
                     task.log.warning('Caught exception (awakening instance): %s', ex, exc_info=app.debugstacktraces)
                 ctx = None
@@ -639,6 +643,7 @@ def define_commands():
                                 'lastmoved': task.starttime,
                                 'lastlocid': None,
                                 'portto':None }})
+        app.occupancy.set_location(cmd.uid, newiid, newlocid, task.starttime)
         task.set_dirty(cmd.uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_WORLD | DIRTY_POPULACE)
         task.set_data_change( ('playstate', cmd.uid, 'iid') )
         task.set_data_change( ('playstate', cmd.uid, 'locid') )
@@ -661,7 +666,7 @@ def define_commands():
             try:
                 args = { '_from':None,
                          '_to':two.execute.LocationProxy(newlocid) }
-                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, symbol='on_enter', locals=args)
             except Exception as ex:
                 task.log.warning('Caught exception (entering loc, linkin): %s', ex, exc_info=app.debugstacktraces)
         
@@ -715,8 +720,7 @@ def define_commands():
         conn.write({'cmd':'message', 'text':msg})
 
         if loctx.wid:
-            world = yield motor.Op(app.mongodb.worlds.find_one,
-                                   {'_id':loctx.wid})
+            world = yield app.entitycache.get('worlds', loctx.wid)
             name = '(none)'
             if world:
                 name = world.get('name', '???')
@@ -726,23 +730,19 @@ def define_commands():
             msg = 'Instance: (%s).' % (loctx.iid,)
             conn.write({'cmd':'message', 'text':msg})
         if loctx.scid:
-            scope = yield motor.Op(app.mongodb.scopes.find_one,
-                                   {'_id':loctx.scid})
+            scope = yield app.entitycache.get('scopes', loctx.scid)
             if scope:
                 msg = 'Scope: %s (%s).' % (scope['type'], loctx.scid)
                 conn.write({'cmd':'message', 'text':msg})
         if loctx.locid:
-            loc = yield motor.Op(app.mongodb.locations.find_one,
-                                 {'_id':loctx.locid})
+            loc = yield app.entitycache.get('locations', loctx.locid)
             if loc:
                 msg = 'Location: "%s" (%s).' % (loc['name'], loctx.locid)
                 conn.write({'cmd':'message', 'text':msg})
         
     @command('meta_me')
     def cmd_me(app, task, cmd, conn):
-        res = yield motor.Op(app.mongodb.players.find_one,
-                             {'_id':conn.uid},
-                             {'name':1})
+        res = yield app.playercache.get(conn.uid)
         playername = res['name']
         if not cmd.args:
             raise MessageException('No pose given.')
@@ -753,9 +753,7 @@ def define_commands():
 
     @command('meta_shout')
     def cmd_shout(app, task, cmd, conn):
-        res = yield motor.Op(app.mongodb.players.find_one,
-                             {'_id':conn.uid},
-                             {'name':1})
+        res = yield app.playercache.get(conn.uid)
         playername = res['name']
         if not cmd.args:
             raise MessageException('No message given.')
@@ -814,12 +812,9 @@ def define_commands():
         loctx = yield task.get_loctx(conn.uid)
         if not loctx.iid:
             raise MessageException('You are not in an instance.')
-        cursor = app.mongodb.playstate.find({'iid':loctx.iid},
-                                            {'_id':1})
-        while (yield cursor.fetch_next):
-            player = cursor.next_object()
-            app.queue_command({'cmd':'tovoid', 'uid':player['_id'], 'portin':True})
-        # cursor autoclose
+        uids = yield app.occupancy.players_at(loctx.iid)
+        for uid in uids:
+            app.queue_command({'cmd':'tovoid', 'uid':uid, 'portin':True})
         app.queue_command({'cmd':'sleepinstance', 'iid':loctx.iid})
         
     @command('meta_getprop', restrict='creator')
@@ -828,19 +823,16 @@ def define_commands():
             raise MessageException('Usage: /getprop key')
         origkey = cmd.args[0]
         key = origkey
-        playstate = yield motor.Op(app.mongodb.playstate.find_one,
-                                   {'_id':conn.uid},
-                                   {'iid':1, 'locid':1})
-        iid = playstate['iid']
+        # The restrict='creator' check has probably cached this already.
+        loctx = yield task.get_loctx(conn.uid)
+        iid = loctx.iid
         if not iid:
             # In the void, there should be no actions.
             raise ErrorMessageException('You are between worlds.')
         ### All of this prop-access stuff will need to go through the 
         ### propcache, when the propcache has a lifespan.
-        instance = yield motor.Op(app.mongodb.instances.find_one,
-                                  {'_id':iid})
-        wid = instance['wid']
-        locid = playstate['locid']
+        wid = loctx.wid
+        locid = loctx.locid
         if '.' in key:
             lockey, dummy, key = key.partition('.')
             if not lockey:
@@ -874,23 +866,52 @@ def define_commands():
             raise MessageException('World property: %s = %s' % (origkey, repr(res['val'])))
         raise MessageException('Instance/world property not set: %s' % (origkey,))
 
+    @command('meta_profile', restrict='creator')
+    def cmd_meta_profile(app, task, cmd, conn):
+        loctx = yield task.get_loctx(conn.uid)
+        wid = loctx.wid
+        if not wid:
+            raise ErrorMessageException('You are between worlds.')
+        profiler = app.profiler
+        subcmd = cmd.args[0] if cmd.args else 'show'
+        if subcmd == 'on':
+            profiler.activate(wid, True)
+            raise MessageException('Script profiling is on for this world.')
+        if subcmd == 'off':
+            profiler.activate(wid, False)
+            raise MessageException('Script profiling is off for this world.')
+        if subcmd == 'clear':
+            profiler.clear(wid)
+            raise MessageException('Script profile cleared.')
+        if subcmd == 'json':
+            conn.write({'cmd':'message', 'text':profiler.dump_json(wid)})
+            return
+        if subcmd not in ('show', 'calls', 'ticks', 'walltime', 'fetches'):
+            raise MessageException('Usage: /profile [on|off|clear|json|calls|ticks|walltime|fetches]')
+        sortkey = ('ticks' if subcmd == 'show' else subcmd)
+        ls = profiler.entries(wid, sortkey=sortkey)
+        if not ls:
+            if profiler.is_active(wid):
+                raise MessageException('Nothing has been profiled in this world yet.')
+            raise MessageException('Script profiling is off for this world. (Use \u201C/profile on\u201D.)')
+        conn.write({'cmd':'message', 'text':'Script profile, by %s (%d symbols):' % (sortkey, len(ls))})
+        for ent in ls[ : 20 ]:
+            conn.write({'cmd':'message', 'text':ent.describe()})
+
     @command('meta_delprop', restrict='creator', doeswrite=True)
     def cmd_meta_delprop(app, task, cmd, conn):
         if len(cmd.args) != 1:
             raise MessageException('Usage: /delprop key')
         origkey = cmd.args[0]
         key = origkey
-        playstate = yield motor.Op(app.mongodb.playstate.find_one,
-                                   {'_id':conn.uid},
-                                   {'iid':1, 'locid':1})
-        iid = playstate['iid']
+        # The restrict='creator' check has probably cached this already.
+        loctx = yield task.get_loctx(conn.uid)
+        iid = loctx.iid
         if not iid:
             # In the void, there should be no actions.
             raise ErrorMessageException('You are between worlds.')
-        instance = yield motor.Op(app.mongodb.instances.find_one,
-                                  {'_id':iid})
-        wid = instance['wid']
-        locid = playstate['locid']
+        wid = loctx.wid
+        locid = loctx.locid
         if '.' in key:
             lockey, dummy, key = key.partition('.')
             if not lockey:
@@ -936,17 +957,14 @@ def define_commands():
             dummy = bson.BSON.encode({'val':newval}, check_keys=True)
         except Exception as ex:
             raise ErrorMessageException('Invalid property value: %s (%s)' % (newval, ex))
-        playstate = yield motor.Op(app.mongodb.playstate.find_one,
-                                   {'_id':conn.uid},
-                                   {'iid':1, 'locid':1})
-        iid = playstate['iid']
+        # The restrict='creator' check has probably cached this already.
+        loctx = yield task.get_loctx(conn.uid)
+        iid = loctx.iid
         if not iid:
             # In the void, there should be no actions.
             raise ErrorMessageException('You are between worlds.')
-        instance = yield motor.Op(app.mongodb.instances.find_one,
-                                  {'_id':iid})
-        wid = instance['wid']
-        locid = playstate['locid']
+        wid = loctx.wid
+        locid = loctx.locid
         if '.' in key:
             lockey, dummy, key = key.partition('.')
             if not lockey:
@@ -1033,14 +1051,10 @@ def define_commands():
     def cmd_portstart(app, task, cmd, conn):
         # Fling the player back to the start world. (Not necessarily the
         # same as a panic or initial login!)
-        player = yield motor.Op(app.mongodb.players.find_one,
-                                {'_id':conn.uid},
-                                {'scid':1})
-        res = yield motor.Op(app.mongodb.config.find_one,
-                             {'key':'startworldloc'})
+        player = yield app.playercache.get(conn.uid)
+        res = yield app.entitycache.get_config('startworldloc')
         lockey = res['val']
-        res = yield motor.Op(app.mongodb.config.find_one,
-                             {'key':'startworldid'})
+        res = yield app.entitycache.get_config('startworldid')
         newwid = res['val']
         newscid = player['scid']
         res = yield motor.Op(app.mongodb.locations.find_one,
@@ -1118,6 +1132,7 @@ def define_commands():
             yield motor.Op(app.mongodb.players.update,
                            {'_id':conn.uid},
                            {'$set': {'pronoun':cmd.pronoun}})
+            app.playercache.invalidate(conn.uid)
             task.set_data_change( ('players', conn.uid, 'pronoun') )
         if getattr(cmd, 'desc', None):
             val = str(cmd.desc)
@@ -1126,13 +1141,12 @@ def define_commands():
             yield motor.Op(app.mongodb.players.update,
                            {'_id':conn.uid},
                            {'$set': {'desc':val}})
+            app.playercache.invalidate(conn.uid)
             task.set_data_change( ('players', conn.uid, 'desc') )
         
     @command('say')
     def cmd_say(app, task, cmd, conn):
-        res = yield motor.Op(app.mongodb.players.find_one,
-                             {'_id':conn.uid},
-                             {'name':1})
+        res = yield app.playercache.get(conn.uid)
         playername = res['name']
         if cmd.text.endswith('?'):
             (say, says) = ('ask', 'asks')
@@ -1149,9 +1163,7 @@ def define_commands():
 
     @command('pose')
     def cmd_pose(app, task, cmd, conn):
-        res = yield motor.Op(app.mongodb.players.find_one,
-                             {'_id':conn.uid},
-                             {'name':1})
+        res = yield app.playercache.get(conn.uid)
         playername = res['name']
         val = '%s %s' % (playername, cmd.text,)
         everyone = yield task.find_locale_players()
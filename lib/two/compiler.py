@@ -0,0 +1,1053 @@
+"""
+The TworldPy compiler: turns a parsed {code} body into a tree of Python
+closures, which the EvalPropContext then runs.
+
+(We used to walk the AST directly, with a Tornado coroutine per node.
+That meant a generator and a Future for every "x + 1", and every yield --
+even of a Future which was already done -- went around the IOLoop. Most
+of a script's CPU time went into that machinery.)
+
+Every compiled node is a pair (func, sync). If sync is true, func(ctx)
+simply returns the node's value. Constants, temporary variables, and
+operators whose operands are all sync come out this way. They never
+touch the database, so they never have to wait for anything.
+
+Otherwise, func(ctx) returns a generator, which yields Futures (from
+property lookups, yieldy script functions, and so on) and finally returns
+the node's value. A parent node runs its non-sync children with "yield
+from". At the top, run_generator() steps the whole pile along, passing
+back the results of Futures that are already done. Only a Future which
+is really pending sends us through the IOLoop.
+
+Ticks are counted the same way the tree-walker counted them: one per
+expression node, one per statement. On top of that, each pass through
+a comprehension costs a tick, and so does every Task.TICK_SIZE_UNIT
+elements of a string or list built by +, *, or % (see charge_size), or
+by a str method like join or ljust (see charge_str_method). The
+sandbox rules (no setattr, getattr only as type_getattr_allowed says) are
+the same too.
+
+The closures keep no state between calls, so compiled code is cached
+and shared (see compile_code in evalctx).
+
+A body which is a single sync expression also gets a "pure" form, which
+the interpolation code calls directly, with no coroutine or stack frame.
+(See EvalPropContext.evalcode_sync.)
+"""
+
+import ast
+import operator
+import itertools
+import types
+
+import tornado.gen
+
+from twcommon.excepts import ExecSandboxException
+from twcommon.excepts import ReturnException, BreakException, ContinueException
+
+map_unaryop_operators = {
+    ast.Not: operator.not_,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    }
+
+# These operators are actually polymorphic. Add includes concat,
+# mod includes string-format, and so on.
+map_binop_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.FloorDiv: operator.floordiv,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    }
+
+map_compare_operators = {
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    # We don't use operator.contains, because its arguments are reversed
+    # for some forsaken reason.
+    ast.In: lambda x,y:(x in y),
+    ast.NotIn: lambda x,y:(x not in y),
+    }
+
+# Binops which can build a big string, list, or tuple (concatenation,
+# repetition, string-format). These cost extra ticks; see charge_size.
+sized_binop_types = set([ ast.Add, ast.Mult, ast.Mod ])
+sized_types = (str, list, tuple)
+
+# Str methods which can build a big string. These cost extra ticks too;
+# see charge_str_method. (The padding methods all take a width first.)
+sized_str_pad_methods = set([ 'center', 'ljust', 'rjust', 'zfill' ])
+sized_str_methods = sized_str_pad_methods | set([ 'join', 'replace' ])
+
+def evaluate(ctx, compiled):
+    """Run a compiled node (or body) in the given context. Returns the
+    value, or a Future for the value if we had to wait for something.
+    """
+    (func, sync) = compiled
+    if sync:
+        return func(ctx)
+    return run_generator(ctx, func(ctx))
+
+def run_generator(ctx, gen):
+    """Run a compiled generator as far as it can go without waiting.
+    Returns the result, or a Future for the result if the generator
+    yields a Future which isn't done yet.
+    """
+    (done, res) = advance_generator(gen, None, None)
+    if done:
+        return res
+    return finish_generator(ctx, gen, res)
+
+def advance_generator(gen, val, exc):
+    """Send a value (or throw an exception) into a generator, and keep
+    going as long as it yields Futures that are already done.
+    Returns (True, result) when it finishes, or (False, future) when
+    it yields a pending Future.
+    """
+    while True:
+        try:
+            if exc is not None:
+                future = gen.throw(exc)
+            else:
+                future = gen.send(val)
+        except StopIteration as ex:
+            return (True, ex.value)
+        if not future.done():
+            return (False, future)
+        try:
+            (val, exc) = (future.result(), None)
+        except Exception as ex:
+            (val, exc) = (None, ex)
+
+@tornado.gen.coroutine
+def finish_generator(ctx, gen, future):
+    """The slow path of run_generator: wait for each pending Future.
+    Every time we wake up, we check the task's clock; if the phase has
+    run out of time, the ExecRunawayException is thrown into the script.
+    """
+    while True:
+        try:
+            (val, exc) = ((yield future), None)
+            ctx.task.check_deadline()
+        except Exception as ex:
+            (val, exc) = (None, ex)
+        (done, res) = advance_generator(gen, val, exc)
+        if done:
+            return res
+        future = res
+
+class CompiledCode(object):
+    """A compiled {code} body. The body is the usual (func, sync) pair.
+
+    If the code is a single pure expression (see is_pure_expression),
+    pure is a plain function which evaluates it -- ticks included -- and
+    returns the value. Otherwise pure is None.
+    """
+    def __init__(self, body, pure=None):
+        self.body = body
+        self.pure = pure
+
+def compile_module(tree):
+    """Compile an ast.Module (as returned by parse_code) into a
+    CompiledCode object.
+    """
+    assert type(tree) is ast.Module
+    body = compile_body(tree.body)
+    pure = None
+    if len(tree.body) == 1 and type(tree.body[0]) is ast.Expr:
+        nod = tree.body[0].value
+        if is_pure_expression(nod):
+            (func, sync) = compile_expr(nod)
+            if sync:
+                pure = func
+    return CompiledCode(body, pure)
+
+def is_pure_expression(nod):
+    """Decide whether an expression can be evaluated without a stack frame.
+    It must not read temporary variables (an interpolation's frame has
+    none, but a lookup would still need one) and must not build a dict
+    (which might be a typed dict, which we'd have to invoke). Whether it
+    can touch the database is a separate question; the compiler answers
+    that with its sync flag.
+    """
+    for subnod in ast.walk(nod):
+        typ = type(subnod)
+        if typ is ast.Name and subnod.id.startswith('_') and subnod.id != '_':
+            return False
+        if typ is ast.Dict:
+            return False
+    return True
+
+def compile_unsupported(message, tick=True):
+    """A node we can't handle. We don't complain at compile time; the
+    code might never get there. (The tree-walker didn't complain either.)
+    """
+    def ev(ctx):
+        if tick:
+            ctx.task.tick()
+        raise NotImplementedError(message)
+    return (ev, True)
+
+def unsupported_op(message):
+    def opfunc(*args):
+        raise NotImplementedError(message)
+    return opfunc
+
+def compile_combine(children, combine, tick=True):
+    """Compile a node which evaluates its (compiled) children in order,
+    and then returns combine(list of values).
+    """
+    if all(sync for (func, sync) in children):
+        funcs = [ func for (func, sync) in children ]
+        def ev(ctx):
+            if tick:
+                ctx.task.tick()
+            return combine([ func(ctx) for func in funcs ])
+        return (ev, True)
+    def ev(ctx):
+        if tick:
+            ctx.task.tick()
+        ls = []
+        for (func, sync) in children:
+            val = func(ctx) if sync else (yield from func(ctx))
+            ls.append(val)
+        return combine(ls)
+    return (ev, False)
+
+def charge_size(ctx, optyp, leftval, rightval):
+    """Charge extra ticks for a binop which builds a big string, list, or
+    tuple: one per TICK_SIZE_UNIT elements of the result. We estimate the
+    size before doing the operation, so that "x" * 10**9 runs out of
+    ticks rather than out of memory.
+    """
+    if optyp is ast.Mult:
+        if isinstance(leftval, sized_types) and isinstance(rightval, int):
+            size = len(leftval) * rightval
+        elif isinstance(rightval, sized_types) and isinstance(leftval, int):
+            size = len(rightval) * leftval
+        else:
+            return
+    elif optyp is ast.Mod:
+        # String formatting: the result is about as long as the format
+        # plus the formatted values.
+        if not isinstance(leftval, str):
+            return
+        size = len(leftval)
+        if isinstance(rightval, tuple):
+            for val in rightval:
+                if isinstance(val, sized_types):
+                    size += len(val)
+        elif isinstance(rightval, dict):
+            for val in rightval.values():
+                if isinstance(val, sized_types):
+                    size += len(val)
+        elif isinstance(rightval, sized_types):
+            size += len(rightval)
+    elif isinstance(leftval, sized_types):
+        size = len(leftval)
+        if isinstance(rightval, sized_types):
+            size += len(rightval)
+    else:
+        return
+    charge_ticks_for_size(ctx, size)
+
+def charge_ticks_for_size(ctx, size):
+    task = ctx.task
+    if size >= task.TICK_SIZE_UNIT:
+        task.tick(size // task.TICK_SIZE_UNIT)
+
+def charge_str_method(ctx, funcval, argvals, kwargvals):
+    """Charge extra ticks for a str method which builds a big string
+    (padding, join, replace), as charge_size does for binops. We estimate
+    the size before making the call, from the method's arguments.
+
+    Returns the argument list to call with. (A join argument may be a
+    one-shot iterator, so we turn it into a list before measuring it.)
+    """
+    selfval = funcval.__self__
+    name = funcval.__name__
+    if name in sized_str_pad_methods:
+        width = argvals[0] if argvals else kwargvals.get('width', 0)
+        if isinstance(width, int):
+            charge_ticks_for_size(ctx, max(width, len(selfval)))
+    elif name == 'join':
+        if argvals and not isinstance(argvals[0], sized_types):
+            argvals = [ list(argvals[0]) ] + argvals[1:]
+        if argvals:
+            ls = argvals[0]
+            size = len(selfval) * max(0, len(ls)-1)
+            for val in ls:
+                if isinstance(val, str):
+                    size += len(val)
+            charge_ticks_for_size(ctx, size)
+    elif name == 'replace':
+        if len(argvals) >= 2 and isinstance(argvals[0], str) and isinstance(argvals[1], str):
+            (old, new) = argvals[0:2]
+            count = selfval.count(old)
+            if len(argvals) >= 3 and isinstance(argvals[2], int) and argvals[2] >= 0:
+                count = min(count, argvals[2])
+            charge_ticks_for_size(ctx, len(selfval) + count * max(0, len(new)-len(old)))
+    return argvals
+
+def compile_expr(nod):
+    han = expr_compilers.get(type(nod), None)
+    if han:
+        return han(nod)
+    return compile_unsupported('Script expression type not implemented: %s' % (type(nod).__name__,))
+
+def compile_constant(val):
+    def ev(ctx):
+        ctx.task.tick()
+        return val
+    return (ev, True)
+
+def compile_constantnode(nod):
+    # Newer Pythons parse all literals into ast.Constant (or NameConstant).
+    # We accept the same literals as Str and Num did, plus True/False/None.
+    val = nod.value
+    if val is Ellipsis or isinstance(val, bytes):
+        return compile_unsupported('Script expression type not implemented: %s' % (type(val).__name__,))
+    return compile_constant(val)
+
+def compile_name(nod):
+    key = nod.id
+    if key == '_':
+        def ev(ctx):
+            ctx.task.tick()
+            return ctx.app.global_symbol_table
+        return (ev, True)
+    if two.symbols.is_immutable_symbol(key):
+        return compile_constant(two.symbols.immutable_symbol_table[key])
+    if key.startswith('_'):
+        # Temporary variables are always locals.
+        def ev(ctx):
+            ctx.task.tick()
+            locals = ctx.frame.locals
+            if key in locals:
+                return locals[key]
+            raise NameError('Temporary variable "%s" is not found' % (key,))
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        locals = ctx.frame.locals
+        if key in locals:
+            return locals[key]
+        res = yield two.symbols.find_symbol(ctx.app, ctx.loctx, key, locals=locals, dependencies=ctx.dependencies)
+        return res
+    return (ev, False)
+
+def compile_list(nod):
+    return compile_combine([ compile_expr(subnod) for subnod in nod.elts ], list)
+
+def compile_tuple(nod):
+    return compile_combine([ compile_expr(subnod) for subnod in nod.elts ], tuple)
+
+def compile_set(nod):
+    return compile_combine([ compile_expr(subnod) for subnod in nod.elts ], set)
+
+def compile_dict(nod):
+    count = len(nod.keys)
+    children = [ compile_expr(subnod) for subnod in nod.keys ]
+    children.extend([ compile_expr(subnod) for subnod in nod.values ])
+    return compile_combine(children, lambda ls: dict(zip(ls[:count], ls[count:])))
+
+def compile_unaryop(nod):
+    optyp = type(nod.op)
+    opfunc = map_unaryop_operators.get(optyp, None)
+    if not opfunc:
+        opfunc = unsupported_op('Script unaryop type not implemented: %s' % (optyp.__name__,))
+    (argfunc, sync) = compile_expr(nod.operand)
+    if sync:
+        def ev(ctx):
+            ctx.task.tick()
+            return opfunc(argfunc(ctx))
+        return (ev, True)
+    return compile_combine([(argfunc, sync)], lambda ls: opfunc(ls[0]))
+
+def compile_binop(nod):
+    optyp = type(nod.op)
+    opfunc = map_binop_operators.get(optyp, None)
+    if not opfunc:
+        opfunc = unsupported_op('Script binop type not implemented: %s' % (optyp.__name__,))
+    (leftfunc, leftsync) = compile_expr(nod.left)
+    (rightfunc, rightsync) = compile_expr(nod.right)
+    if optyp not in sized_binop_types:
+        if leftsync and rightsync:
+            def ev(ctx):
+                ctx.task.tick()
+                return opfunc(leftfunc(ctx), rightfunc(ctx))
+            return (ev, True)
+        return compile_combine([(leftfunc, leftsync), (rightfunc, rightsync)], lambda ls: opfunc(ls[0], ls[1]))
+    if leftsync and rightsync:
+        def ev(ctx):
+            ctx.task.tick()
+            leftval = leftfunc(ctx)
+            rightval = rightfunc(ctx)
+            charge_size(ctx, optyp, leftval, rightval)
+            return opfunc(leftval, rightval)
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        leftval = leftfunc(ctx) if leftsync else (yield from leftfunc(ctx))
+        rightval = rightfunc(ctx) if rightsync else (yield from rightfunc(ctx))
+        charge_size(ctx, optyp, leftval, rightval)
+        return opfunc(leftval, rightval)
+    return (ev, False)
+
+def compile_boolop(nod):
+    optyp = type(nod.op)
+    assert len(nod.values) > 0
+    if optyp is ast.And:
+        stopon = False
+    elif optyp is ast.Or:
+        stopon = True
+    else:
+        return compile_unsupported('Script boolop type not implemented: %s' % (optyp.__name__,))
+    children = [ compile_expr(subnod) for subnod in nod.values ]
+    if all(sync for (func, sync) in children):
+        funcs = [ func for (func, sync) in children ]
+        def ev(ctx):
+            ctx.task.tick()
+            for func in funcs:
+                val = func(ctx)
+                if bool(val) == stopon:
+                    return val
+            return val
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        for (func, sync) in children:
+            val = func(ctx) if sync else (yield from func(ctx))
+            if bool(val) == stopon:
+                return val
+        return val
+    return (ev, False)
+
+def compile_compare(nod):
+    (leftfunc, leftsync) = compile_expr(nod.left)
+    comps = []
+    for (op, subnod) in zip(nod.ops, nod.comparators):
+        optyp = type(op)
+        opfunc = map_compare_operators.get(optyp, None)
+        if not opfunc:
+            opfunc = unsupported_op('Script compare type not implemented: %s' % (optyp.__name__,))
+        comps.append((opfunc,) + compile_expr(subnod))
+    if leftsync and all(sync for (opfunc, func, sync) in comps):
+        def ev(ctx):
+            ctx.task.tick()
+            leftval = leftfunc(ctx)
+            for (opfunc, func, sync) in comps:
+                rightval = func(ctx)
+                res = opfunc(leftval, rightval)
+                if not res:
+                    return res
+                leftval = rightval
+            return True
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        leftval = leftfunc(ctx) if leftsync else (yield from leftfunc(ctx))
+        for (opfunc, func, sync) in comps:
+            rightval = func(ctx) if sync else (yield from func(ctx))
+            res = opfunc(leftval, rightval)
+            if not res:
+                return res
+            leftval = rightval
+        return True
+    return (ev, False)
+
+def compile_comprehension(generators, elts, result, accumulate):
+    """Compile a list, set, or dict comprehension. The elts are the
+    element expressions (one, or two for a dict); accumulate(res, vals)
+    adds their values to the result.
+    As before, every iterator is evaluated up front (so a later
+    generator can't depend on an earlier generator's variable).
+    """
+    comps = []
+    for comp in generators:
+        ifs = [ compile_expr(ifnod) for ifnod in comp.ifs ]
+        comps.append((compile_store(comp.target), compile_expr(comp.iter), ifs))
+    elts = [ compile_expr(elt) for elt in elts ]
+    def ev(ctx):
+        ctx.task.tick()
+        proxies = []
+        iters = []
+        for ((bind, bindsync, store, storesync), (iterfunc, itersync), ifs) in comps:
+            proxy = bind(ctx) if bindsync else (yield from bind(ctx))
+            proxies.append(proxy)
+            iter = iterfunc(ctx) if itersync else (yield from iterfunc(ctx))
+            iters.append(iter)
+        res = result()
+        for tup in itertools.product(*iters):
+            ctx.task.tick(ctx.task.TICK_COST_ITERATION)
+            flag = True
+            for (comp, proxy, val) in zip(comps, proxies, tup):
+                ((bind, bindsync, store, storesync), iterfunc, ifs) = comp
+                if storesync:
+                    store(ctx, proxy, val)
+                else:
+                    yield from store(ctx, proxy, val)
+                for (func, sync) in ifs:
+                    flag = func(ctx) if sync else (yield from func(ctx))
+                    if not flag:
+                        break
+                if not flag:
+                    break
+            if flag:
+                vals = []
+                for (func, sync) in elts:
+                    val = func(ctx) if sync else (yield from func(ctx))
+                    vals.append(val)
+                accumulate(res, vals)
+        return res
+    return (ev, False)
+
+def compile_listcomp(nod):
+    return compile_comprehension(nod.generators, [nod.elt], list,
+                                 lambda res, vals: res.append(vals[0]))
+
+def compile_setcomp(nod):
+    return compile_comprehension(nod.generators, [nod.elt], set,
+                                 lambda res, vals: res.add(vals[0]))
+
+def compile_dictcomp(nod):
+    return compile_comprehension(nod.generators, [nod.key, nod.value], dict,
+                                 lambda res, vals: res.__setitem__(vals[0], vals[1]))
+
+def compile_attribute(nod):
+    (argfunc, argsync) = compile_expr(nod.value)
+    key = nod.attr
+    def ev(ctx):
+        ctx.task.tick()
+        argument = argfunc(ctx) if argsync else (yield from argfunc(ctx))
+        # The real getattr() is way too powerful to offer up.
+        if isinstance(argument, two.symbols.ScriptNamespace):
+            (res, yieldy) = argument.getyieldy(key)
+            if yieldy:
+                res = yield res()
+            return res
+        if isinstance(argument, two.execute.PropertyProxyMixin):
+            res = yield argument.getprop(ctx, ctx.loctx, key)
+            return res
+        typarg = type(argument)
+        if two.symbols.type_getattr_allowed(typarg, key):
+            return getattr(argument, key)
+        raise ExecSandboxException('%s.%s: getattr not allowed' % (typarg.__name__, key))
+    return (ev, False)
+
+def compile_slice(subnod):
+    """Compile the subscript part of a subscript expression. (This does
+    not tick; only the expressions inside it do.)
+    """
+    subtyp = type(subnod)
+    if subtyp is ast.Slice:
+        children = []
+        for val in (subnod.lower, subnod.upper, subnod.step):
+            if val is None:
+                children.append(compile_none)
+            else:
+                children.append(compile_expr(val))
+        return compile_combine(children, lambda ls: slice(*ls), tick=False)
+    if subtyp is getattr(ast, 'Index', None):
+        return compile_expr(subnod.value)
+    if isinstance(subnod, ast.expr):
+        # Newer Pythons drop the Index wrapper.
+        return compile_expr(subnod)
+    return compile_unsupported('Unsupported subscript type: %s' % (subtyp.__name__,), tick=False)
+
+# A placeholder for a missing slice bound. (No tick.)
+compile_none = (lambda ctx: None, True)
+
+def compile_subscript(nod):
+    (argfunc, argsync) = compile_expr(nod.value)
+    (subfunc, subsync) = compile_slice(nod.slice)
+    def ev(ctx):
+        ctx.task.tick()
+        argument = argfunc(ctx) if argsync else (yield from argfunc(ctx))
+        subscript = subfunc(ctx) if subsync else (yield from subfunc(ctx))
+        if isinstance(argument, two.execute.PropertyProxyMixin):
+            # Special case: property proxies can be accessed by subscript.
+            res = yield argument.getprop(ctx, ctx.loctx, subscript)
+            return res
+        return argument[subscript]
+    return (ev, False)
+
+def compile_call(nod):
+    (funcfunc, funcsync) = compile_expr(nod.func)
+    # Positional arguments, as (star, compiled) pairs.
+    args = []
+    for subnod in nod.args:
+        if type(subnod) is ast.Starred:
+            args.append((True, compile_expr(subnod.value)))
+        else:
+            args.append((False, compile_expr(subnod)))
+    if getattr(nod, 'starargs', None):
+        args.append((True, compile_expr(nod.starargs)))
+    # Keyword arguments, as (key, compiled) pairs. A key of None is
+    # a **kwargs.
+    keywords = [ (subnod.arg, compile_expr(subnod.value)) for subnod in nod.keywords ]
+    if getattr(nod, 'kwargs', None):
+        keywords.append((None, compile_expr(nod.kwargs)))
+
+    def ev(ctx):
+        ctx.task.tick()
+        funcval = funcfunc(ctx) if funcsync else (yield from funcfunc(ctx))
+        argvals = []
+        for (star, (func, sync)) in args:
+            val = func(ctx) if sync else (yield from func(ctx))
+            if star:
+                argvals.extend(val)
+            else:
+                argvals.append(val)
+        kwargvals = {}
+        for (key, (func, sync)) in keywords:
+            val = func(ctx) if sync else (yield from func(ctx))
+            if key is None:
+                # Python semantics say we should reject duplicate kwargs here
+                kwargvals.update(val)
+            else:
+                kwargvals[key] = val
+
+        if isinstance(funcval, two.symbols.ScriptFunc):
+            if not funcval.yieldy:
+                return funcval.func(*argvals, **kwargvals)
+            res = yield funcval.yieldfunc(*argvals, **kwargvals)
+            return res
+        if funcval and twcommon.misc.is_typed_dict(funcval, 'code'):
+            # {code} dicts are considered callable by courtesy.
+            argspec = funcval.get('args', None)
+            if not argspec:
+                locals = None
+                if argvals or kwargvals:
+                    raise TypeError('code property does not take arguments, but was given %d' % (len(argvals)+len(kwargvals),))
+            else:
+                argspec = parse_argument_spec(argspec)
+                yield ctx.replace_argspec_defaults(argspec)
+                locals = resolve_argument_spec(argspec, argvals, kwargvals)
+            val = funcval.get('text', None)
+            if not val:
+                return None
+            newval = yield ctx.evalobj(val, evaltype=EVALTYPE_CODE, locals=locals)
+            return newval
+        ### Validate that funcval is a safe thing to call!
+        # This will raise TypeError if funcval is not callable.
+        if type(funcval) is types.BuiltinMethodType and isinstance(getattr(funcval, '__self__', None), str) and funcval.__name__ in sized_str_methods:
+            argvals = charge_str_method(ctx, funcval, argvals, kwargvals)
+        return funcval(*argvals, **kwargvals)
+    return (ev, False)
+
+def compile_store(nod):
+    """Compile the target of an assignment (or for loop, or del). This
+    returns a tuple (bind, bindsync, store, storesync).
+
+    bind(ctx) evaluates whatever is inside the target expression, and
+    returns a load/store/delete proxy (see BoundNameProxy and friends).
+    store(ctx, proxy, val) stores a value through the proxy. As usual,
+    each of them returns a generator unless its sync flag is set.
+    (Storing to a temporary variable is sync. So is binding a target
+    that has nothing to evaluate.)
+    """
+    nodtyp = type(nod)
+    if nodtyp is ast.Name:
+        return compile_store_name(nod)
+    if nodtyp is ast.Attribute:
+        key = nod.attr
+        def bindattr(ls):
+            argument = ls[0]
+            if isinstance(argument, two.execute.PropertyProxyMixin):
+                return two.execute.BoundPropertyProxy(argument, key)
+            raise ExecSandboxException('%s.%s: setattr not allowed' % (type(argument).__name__, key))
+        (bind, bindsync) = compile_combine([compile_expr(nod.value)], bindattr, tick=False)
+        return (bind, bindsync, store_proxy, False)
+    if nodtyp is ast.Subscript:
+        def bindsubscript(ls):
+            (argument, subscript) = ls
+            if isinstance(argument, two.execute.PropertyProxyMixin):
+                # Special case: property proxies can be accessed by subscript.
+                return two.execute.BoundPropertyProxy(argument, subscript)
+            return two.execute.BoundSubscriptProxy(argument, subscript)
+        (bind, bindsync) = compile_combine([compile_expr(nod.value), compile_slice(nod.slice)], bindsubscript, tick=False)
+        return (bind, bindsync, store_proxy, False)
+    if nodtyp in (ast.Tuple, ast.List):
+        return compile_store_multi(nod)
+    (bind, bindsync) = compile_unsupported('Script store-expression type not implemented: %s' % (nodtyp.__name__,), tick=False)
+    return (bind, bindsync, store_proxy, False)
+
+def store_proxy(ctx, proxy, val):
+    yield proxy.store(ctx, ctx.loctx, val)
+
+def compile_store_name(nod):
+    key = nod.id
+    proxy = two.execute.BoundNameProxy(key)
+    def bind(ctx):
+        return proxy
+    if key == '_':
+        # Assignment to _ is silently dropped, to sort-of support
+        # Python idiom.
+        def store(ctx, proxy, val):
+            pass
+        return (bind, True, store, True)
+    if key.startswith('_'):
+        def store(ctx, proxy, val):
+            ctx.frame.locals[key] = val
+        return (bind, True, store, True)
+    if two.symbols.is_immutable_symbol(key):
+        # The proxy will complain.
+        return (bind, True, store_proxy, False)
+    def store(ctx, proxy, val):
+        locals = ctx.frame.locals
+        if key in locals:
+            locals[key] = val
+            return
+        yield proxy.store(ctx, ctx.loctx, val)
+    return (bind, True, store, False)
+
+def compile_store_multi(nod):
+    children = [ compile_store(subnod) for subnod in nod.elts ]
+    count = len(children)
+    if all(bindsync for (bind, bindsync, store, storesync) in children):
+        def bind(ctx):
+            return two.execute.MultiBoundProxy([ subbind(ctx) for (subbind, subbindsync, substore, substoresync) in children ])
+        bindsync = True
+    else:
+        def bind(ctx):
+            ls = []
+            for (subbind, subbindsync, store, storesync) in children:
+                val = subbind(ctx) if subbindsync else (yield from subbind(ctx))
+                ls.append(val)
+            return two.execute.MultiBoundProxy(ls)
+        bindsync = False
+    if all(storesync for (bind, bindsync, store, storesync) in children):
+        def store(ctx, proxy, val):
+            vals = tuple(val)
+            if len(vals) != count:
+                raise ValueError('wrong number of values to unpack (expected %d)' % (count,))
+            for (child, subproxy, subval) in zip(children, proxy.tuple, vals):
+                child[2](ctx, subproxy, subval)
+        storesync = True
+    else:
+        def store(ctx, proxy, val):
+            vals = tuple(val)
+            if len(vals) != count:
+                raise ValueError('wrong number of values to unpack (expected %d)' % (count,))
+            for (child, subproxy, subval) in zip(children, proxy.tuple, vals):
+                if child[3]:
+                    child[2](ctx, subproxy, subval)
+                else:
+                    yield from child[2](ctx, subproxy, subval)
+        storesync = False
+    return (bind, bindsync, store, storesync)
+
+def compile_body(nods):
+    """Compile a list of statements. The result is the value of the last
+    one (which matters for an expression statement at the end of a code
+    body). This doesn't tick; the statements do.
+    """
+    stmts = [ compile_statement(nod) for nod in nods ]
+    if all(sync for (func, sync) in stmts):
+        funcs = [ func for (func, sync) in stmts ]
+        def ev(ctx):
+            res = None
+            for func in funcs:
+                res = func(ctx)
+            return res
+        return (ev, True)
+    def ev(ctx):
+        res = None
+        for (func, sync) in stmts:
+            res = func(ctx) if sync else (yield from func(ctx))
+        return res
+    return (ev, False)
+
+def compile_statement(nod):
+    han = statement_compilers.get(type(nod), None)
+    if han:
+        return han(nod)
+    return compile_unsupported('Script statement type not implemented: %s' % (type(nod).__name__,))
+
+def compile_exprstatement(nod):
+    (func, sync) = compile_expr(nod.value)
+    symbol = None
+    if type(nod.value) is ast.Name:
+        symbol = nod.value.id
+    # Any value might turn out to be a typed dict, so this is never sync.
+    def ev(ctx):
+        ctx.task.tick()
+        res = func(ctx) if sync else (yield from func(ctx))
+        if res is not None and isinstance(res, dict) and 'type' in res:
+            # Top-level expression has returned a typed dict. Try
+            # invoking it.
+            res = yield ctx.invoke_typed_dict(res, symbol)
+        return res
+    return (ev, False)
+
+def compile_pass(nod):
+    def ev(ctx):
+        ctx.task.tick()
+        return None
+    return (ev, True)
+
+def compile_if(nod):
+    (testfunc, testsync) = compile_expr(nod.test)
+    (bodyfunc, bodysync) = compile_body(nod.body)
+    (elsefunc, elsesync) = compile_body(nod.orelse)
+    if testsync and bodysync and elsesync:
+        def ev(ctx):
+            ctx.task.tick()
+            if testfunc(ctx):
+                return bodyfunc(ctx)
+            else:
+                return elsefunc(ctx)
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        testval = testfunc(ctx) if testsync else (yield from testfunc(ctx))
+        if testval:
+            res = bodyfunc(ctx) if bodysync else (yield from bodyfunc(ctx))
+        else:
+            res = elsefunc(ctx) if elsesync else (yield from elsefunc(ctx))
+        return res
+    return (ev, False)
+
+def compile_while(nod):
+    (testfunc, testsync) = compile_expr(nod.test)
+    (bodyfunc, bodysync) = compile_body(nod.body)
+    (elsefunc, elsesync) = compile_body(nod.orelse)
+    if testsync and bodysync and elsesync:
+        def ev(ctx):
+            ctx.task.tick()
+            while testfunc(ctx):
+                try:
+                    bodyfunc(ctx)
+                except ContinueException:
+                    pass
+                except BreakException:
+                    return None
+            elsefunc(ctx)
+            return None
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        while True:
+            testval = testfunc(ctx) if testsync else (yield from testfunc(ctx))
+            if not testval:
+                break
+            try:
+                if bodysync:
+                    bodyfunc(ctx)
+                else:
+                    yield from bodyfunc(ctx)
+            except ContinueException:
+                pass
+            except BreakException:
+                return None
+        if elsesync:
+            elsefunc(ctx)
+        else:
+            yield from elsefunc(ctx)
+        return None
+    return (ev, False)
+
+def compile_for(nod):
+    (bind, bindsync, store, storesync) = compile_store(nod.target)
+    (iterfunc, itersync) = compile_expr(nod.iter)
+    (bodyfunc, bodysync) = compile_body(nod.body)
+    (elsefunc, elsesync) = compile_body(nod.orelse)
+    if bindsync and storesync and itersync and bodysync and elsesync:
+        def ev(ctx):
+            ctx.task.tick()
+            proxy = bind(ctx)
+            for val in iterfunc(ctx):
+                store(ctx, proxy, val)
+                try:
+                    bodyfunc(ctx)
+                except ContinueException:
+                    pass
+                except BreakException:
+                    return None
+            elsefunc(ctx)
+            return None
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        proxy = bind(ctx) if bindsync else (yield from bind(ctx))
+        iter = iterfunc(ctx) if itersync else (yield from iterfunc(ctx))
+        for val in iter:
+            if storesync:
+                store(ctx, proxy, val)
+            else:
+                yield from store(ctx, proxy, val)
+            try:
+                if bodysync:
+                    bodyfunc(ctx)
+                else:
+                    yield from bodyfunc(ctx)
+            except ContinueException:
+                pass
+            except BreakException:
+                return None
+        if elsesync:
+            elsefunc(ctx)
+        else:
+            yield from elsefunc(ctx)
+        return None
+    return (ev, False)
+
+def compile_return(nod):
+    if nod.value is None:
+        (valfunc, valsync) = compile_none
+    else:
+        (valfunc, valsync) = compile_expr(nod.value)
+    if valsync:
+        def ev(ctx):
+            ctx.task.tick()
+            raise ReturnException(returnvalue=valfunc(ctx))
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        val = yield from valfunc(ctx)
+        raise ReturnException(returnvalue=val)
+    return (ev, False)
+
+def compile_break(nod):
+    def ev(ctx):
+        ctx.task.tick()
+        raise BreakException
+    return (ev, True)
+
+def compile_continue(nod):
+    def ev(ctx):
+        ctx.task.tick()
+        raise ContinueException
+    return (ev, True)
+
+def compile_assign(nod):
+    (valfunc, valsync) = compile_expr(nod.value)
+    targets = [ compile_store(tarnod) for tarnod in nod.targets ]
+    if valsync and all((bindsync and storesync) for (bind, bindsync, store, storesync) in targets):
+        def ev(ctx):
+            ctx.task.tick()
+            val = valfunc(ctx)
+            for (bind, bindsync, store, storesync) in targets:
+                store(ctx, bind(ctx), val)
+            return None
+        return (ev, True)
+    def ev(ctx):
+        ctx.task.tick()
+        val = valfunc(ctx) if valsync else (yield from valfunc(ctx))
+        for (bind, bindsync, store, storesync) in targets:
+            proxy = bind(ctx) if bindsync else (yield from bind(ctx))
+            if storesync:
+                store(ctx, proxy, val)
+            else:
+                yield from store(ctx, proxy, val)
+        return None
+    return (ev, False)
+
+def compile_augassign(nod):
+    optyp = type(nod.op)
+    opfunc = map_binop_operators.get(optyp, None)
+    if not opfunc:
+        return compile_unsupported('Script augop type not implemented: %s' % (optyp.__name__,))
+    (valfunc, valsync) = compile_expr(nod.value)
+    sized = (optyp in sized_binop_types)
+    if type(nod.target) is ast.Name and nod.target.id.startswith('_') and nod.target.id != '_' and valsync:
+        # "_count += 1" is common enough to deserve a fast path.
+        key = nod.target.id
+        def ev(ctx):
+            ctx.task.tick()
+            rightval = valfunc(ctx)
+            locals = ctx.frame.locals
+            if key not in locals:
+                raise NameError('Temporary variable "%s" is not found' % (key,))
+            leftval = locals[key]
+            if sized:
+                charge_size(ctx, optyp, leftval, rightval)
+            locals[key] = opfunc(leftval, rightval)
+            return None
+        return (ev, True)
+    (bind, bindsync, store, storesync) = compile_store(nod.target)
+    def ev(ctx):
+        ctx.task.tick()
+        proxy = bind(ctx) if bindsync else (yield from bind(ctx))
+        rightval = valfunc(ctx) if valsync else (yield from valfunc(ctx))
+        leftval = yield proxy.load(ctx, ctx.loctx)
+        if sized:
+            charge_size(ctx, optyp, leftval, rightval)
+        val = opfunc(leftval, rightval)
+        if storesync:
+            store(ctx, proxy, val)
+        else:
+            yield from store(ctx, proxy, val)
+        return None
+    return (ev, False)
+
+def compile_delete(nod):
+    targets = [ compile_store(subnod) for subnod in nod.targets ]
+    def ev(ctx):
+        ctx.task.tick()
+        for (bind, bindsync, store, storesync) in targets:
+            proxy = bind(ctx) if bindsync else (yield from bind(ctx))
+            yield proxy.delete(ctx, ctx.loctx)
+        return None
+    return (ev, False)
+
+# Some lookup tables of node compilers
+expr_compilers = {
+    ast.Str: lambda nod: compile_constant(nod.s),
+    ast.Num: lambda nod: compile_constant(nod.n),  # covers floats and ints
+    ast.Name: compile_name,
+    ast.List: compile_list,
+    ast.Tuple: compile_tuple,
+    ast.Set: compile_set,
+    ast.Dict: compile_dict,
+    ast.UnaryOp: compile_unaryop,
+    ast.BinOp: compile_binop,
+    ast.BoolOp: compile_boolop,
+    ast.Compare: compile_compare,
+    ast.ListComp: compile_listcomp,
+    ast.SetComp: compile_setcomp,
+    ast.DictComp: compile_dictcomp,
+    ast.Attribute: compile_attribute,
+    ast.Subscript: compile_subscript,
+    ast.Call: compile_call,
+    }
+for _name in ('NameConstant', 'Constant'):
+    if hasattr(ast, _name):
+        expr_compilers[getattr(ast, _name)] = compile_constantnode
+
+statement_compilers = {
+    ast.Expr: compile_exprstatement,
+    ast.Pass: compile_pass,
+    ast.Assign: compile_assign,
+    ast.AugAssign: compile_augassign,
+    ast.Delete: compile_delete,
+    ast.If: compile_if,
+    ast.While: compile_while,
+    ast.For: compile_for,
+    ast.Return: compile_return,
+    ast.Break: compile_break,
+    ast.Continue: compile_continue,
+    }
+
+
+# Late imports, to avoid circularity
+import twcommon.misc
+import two.symbols
+import two.execute
+from two.evalctx import EVALTYPE_CODE
+from two.evalctx import parse_argument_spec, resolve_argument_spec
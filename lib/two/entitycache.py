@@ -0,0 +1,129 @@
+"""
+Entity cache: keeps recently-used world, scope, instance, location, and
+portlist documents (and config values) in memory.
+
+These documents are read constantly -- every portal description looks
+up a world, a scope, and maybe a location -- and they rarely change.
+tworld itself only changes instances (lastawake), and it invalidates
+them when it does. tweb's build pages change worlds, locations, and portlists; they
+send a notifyentitychange command for each change. As a backstop, every
+entry expires after TTL seconds.
+
+Cached documents are shared among all callers, so they must not be
+modified. Don't use this for fields that change often (like an
+instance's lastawake); go to the database for those.
+"""
+
+import time
+
+import tornado.gen
+import motor
+
+import twcommon.misc
+
+# The collections we cache, by _id. (The config collection is keyed
+# by 'key', and is handled separately.)
+entity_collections = frozenset(['worlds', 'scopes', 'instances', 'locations', 'portlists'])
+
+class EntityCache(object):
+    """EntityCache maps (collection, id) pairs to (expiry, document) pairs.
+    Config values are stored under ('config', key). Documents that don't
+    exist are not cached.
+    """
+    MAX_ENTRIES = 20000
+    TTL = 300  # seconds
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = twcommon.misc.LRUCache(self.MAX_ENTRIES, name='EntityCache')
+        # Bumped on every invalidation. A fetch that started before an
+        # invalidation doesn't store its (possibly stale) result.
+        self.generation = 0
+
+    def __repr__(self):
+        return '<EntityCache: %d entries; %d hits, %d misses>' % (len(self.cache), self.cache.hits, self.cache.misses)
+
+    def lookup(self, key):
+        """Return the cached document for a key, or None if it's not
+        cached (or has expired).
+        """
+        ent = self.cache.get(key)
+        if ent is None:
+            return None
+        (expiry, doc) = ent
+        if expiry < time.monotonic():
+            self.cache.discard(key)
+            return None
+        return doc
+
+    def store(self, key, doc, generation):
+        if doc is not None and generation == self.generation:
+            self.cache.set(key, (time.monotonic() + self.TTL, doc))
+
+    @tornado.gen.coroutine
+    def get(self, collection, id):
+        """Return the document with the given _id from the given
+        collection, or None if there isn't one.
+        """
+        assert collection in entity_collections, 'EntityCache: collection not cached: %s' % (collection,)
+        key = (collection, id)
+        res = self.lookup(key)
+        if res is not None:
+            return res
+        generation = self.generation
+        res = yield motor.Op(self.app.mongodb[collection].find_one,
+                             {'_id':id})
+        self.store(key, res, generation)
+        return res
+
+    @tornado.gen.coroutine
+    def get_many(self, collection, ids):
+        """Return a dict mapping ids to documents, for all of the given
+        ids that exist in the given collection. The cache misses are
+        fetched with one query.
+        """
+        assert collection in entity_collections, 'EntityCache: collection not cached: %s' % (collection,)
+        res = {}
+        misses = []
+        for id in ids:
+            doc = self.lookup((collection, id))
+            if doc is not None:
+                res[id] = doc
+            else:
+                misses.append(id)
+        if not misses:
+            return res
+
+        generation = self.generation
+        cursor = self.app.mongodb[collection].find({'_id':{'$in':misses}})
+        while (yield cursor.fetch_next):
+            doc = cursor.next_object()
+            res[doc['_id']] = doc
+            self.store((collection, doc['_id']), doc, generation)
+        # cursor autoclose
+        return res
+
+    @tornado.gen.coroutine
+    def get_config(self, configkey):
+        """Return the config document ({'key', 'val'}) for the given key,
+        or None if there isn't one.
+        """
+        key = ('config', configkey)
+        res = self.lookup(key)
+        if res is not None:
+            return res
+        generation = self.generation
+        res = yield motor.Op(self.app.mongodb.config.find_one,
+                             {'key':configkey})
+        self.store(key, res, generation)
+        return res
+
+    def invalidate(self, collection, id):
+        """Drop a cached document. (For config, the id is the config key.)
+        """
+        self.generation += 1
+        self.cache.discard((collection, id))
+
+    def clear(self):
+        self.generation += 1
+        self.cache.clear()
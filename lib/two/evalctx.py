@@ -6,10 +6,13 @@ of TworldPy lives in the EvalPropContext module.
 import re
 import random
 import ast
-import operator
-import itertools
+import copy
+import contextlib
+import functools
 
 import tornado.gen
+import tornado.concurrent
+import tornado.stack_context
 import bson
 from bson.objectid import ObjectId
 import motor
@@ -44,6 +47,42 @@ LEVEL_RAW = 0
 # Regexp: Check whether a string starts with a vowel.
 re_vowelstart = re.compile('^[aeiou]', re.IGNORECASE)
 
+class StackContextVar(object):
+    """A variable whose value follows the flow of control, rather than
+    the flow of time. (Like contextvars.ContextVar, which newer Pythons
+    have. We get the same effect from Tornado's StackContext.)
+
+    Code wrapped in stack_context(value) sees that value, and so does
+    every callback scheduled from inside it -- which includes the rest
+    of any coroutine started there. Other code interleaved on the ioloop
+    sees its own value. Values nest: when the wrapped code is done, the
+    previous value is back.
+
+    As with any StackContext, the "with" block must not contain a yield.
+    Start the coroutine inside it, and yield its Future afterwards.
+    """
+    def __init__(self, name, default=None):
+        self.name = name
+        self.value = default
+
+    def __repr__(self):
+        return '<StackContextVar %s>' % (self.name,)
+
+    def get(self):
+        return self.value
+
+    @contextlib.contextmanager
+    def bind(self, value):
+        oldvalue = self.value
+        self.value = value
+        try:
+            yield
+        finally:
+            self.value = oldvalue
+
+    def stack_context(self, value):
+        return tornado.stack_context.StackContext(functools.partial(self.bind, value))
+
 class EvalPropFrame:
     """One stack frame in the EvalPropContext. Note that depth starts at 1.
 
@@ -76,15 +115,28 @@ class EvalPropContext(object):
     EvalPropContext to clone.
     """
 
-    # We'll push contexts on here as we nest them. (It is occasionally
-    # necessary to find the "current" context without a handy reference.)
-    context_stack = []
+    # The context whose eval() is running. (It is occasionally necessary
+    # to find the "current" context without a handy reference.) This
+    # follows each eval's coroutine chain, so evaluations for different
+    # tasks or players can interleave on the ioloop without confusion.
+    current_context = StackContextVar('EvalPropContext.current_context')
 
     @staticmethod
     def get_current_context():
-        if not EvalPropContext.context_stack:
+        ctx = EvalPropContext.current_context.get()
+        if ctx is None:
             raise Exception('get_current_context: no current context!')
-        return EvalPropContext.context_stack[-1]
+        return ctx
+
+    @staticmethod
+    def set_current_uncacheable():
+        """Mark the current context (if there is one) as having used
+        something that isn't tracked in its dependencies. Its result
+        will not be stored in the render cache.
+        """
+        ctx = EvalPropContext.current_context.get()
+        if ctx is not None:
+            ctx.cacheable = False
 
     # Used as a long-running counter in build_action_key.
     link_code_counter = 0
@@ -118,13 +170,14 @@ class EvalPropContext(object):
             assert self.task == parent.task
             self.parentdepth = parent.parentdepth + parent.depth + 1
             self.loctx = parent.loctx
-            self.uid = parent.uid
             self.caps = parent.caps
+            self.profcounter = parent.profcounter
         elif loctx is not None:
             self.parentdepth = parentdepth
             self.loctx = loctx
-            self.uid = loctx.uid
             self.caps = EVALCAP_ALL
+            # None unless this world is being profiled.
+            self.profcounter = self.app.profiler.new_counter(loctx.wid)
 
         # What kind of evaluation is going on.
         self.level = level
@@ -147,11 +200,26 @@ class EvalPropContext(object):
         self.genseed = None
         self.gencount = None
         self.genparams = None
+        self.genhash = None
 
         # Accumulating the state dependencies and action keys for the
         # client.
         self.linktargets = None
         self.dependencies = None
+        # Cleared if the evaluation touches anything that the dependencies
+        # don't capture (random numbers, the clock, etc).
+        self.cacheable = True
+        # Set if the evaluation looks at who the current player is.
+        self.playerdependent = False
+
+    @property
+    def uid(self):
+        """The current player. Anything that reads this is rendering
+        something player-specific, so we note that. (A render that never
+        asks can be shared among all the players in a location.)
+        """
+        self.playerdependent = True
+        return self.loctx.uid
 
     @property
     def depth(self):
@@ -174,9 +242,13 @@ class EvalPropContext(object):
             self.linktargets.update(ctx.linktargets)
         if ctx.dependencies:
             self.dependencies.update(ctx.dependencies)
+        if not ctx.cacheable:
+            self.cacheable = False
+        if ctx.playerdependent:
+            self.playerdependent = True
 
     @tornado.gen.coroutine
-    def eval(self, key, evaltype=EVALTYPE_SYMBOL, locals=None):
+    def eval(self, key, evaltype=EVALTYPE_SYMBOL, locals=None, symbol=None):
         """Look up and return a symbol, in this context. If EVALTYPE_TEXT,
         the argument is treated as an already-looked-up {text} value
         (a string with interpolations). If EVALTYPE_CODE, the argument
@@ -188,6 +260,10 @@ class EvalPropContext(object):
         with underscore. ###generalize for function {code} args?
         The locals dict is used "live", not copied.
 
+        For the non-symbol types, the caller may pass the symbol the value
+        came from (e.g. 'on_enter' for a hook). This is only used for
+        context, such as the script profiler's label.
+
         This is the top-level entry point to Doing Stuff in this context.
         
         After the call, dependencies will contain the symbol (and any
@@ -222,6 +298,8 @@ class EvalPropContext(object):
         self.textstate = RunOnNode
         self.linktargets = None
         self.dependencies = set()
+        self.cacheable = True
+        self.playerdependent = False
         self.wasspecial = False
 
         # These will be filled in if and when a gentext starts.
@@ -229,6 +307,7 @@ class EvalPropContext(object):
         self.genseed = None
         self.gencount = None
         self.genparams = None
+        self.genhash = None
 
         # We start with no frames and a depth of zero. (When we add frames,
         # the self.frame will always be the current stack frame, which is
@@ -237,12 +316,14 @@ class EvalPropContext(object):
         self.frames = []
 
         try:
-            EvalPropContext.context_stack.append(self)
-            res = yield self.evalobj(key, evaltype=evaltype, locals=locals)
+            # We're the current context for as long as evalobj runs
+            # (including its callbacks). We must not yield inside the
+            # StackContext, so we start evalobj there and wait outside.
+            with EvalPropContext.current_context.stack_context(self):
+                future = self.evalobj(key, evaltype=evaltype, symbol=symbol, locals=locals)
+            res = yield future
         finally:
             assert (self.depth == 0) and (self.frame is None), 'EvalPropContext did not pop all the way!'
-            assert (EvalPropContext.context_stack[-1] is self), 'EvalPropContext.context_stack did not nest properly!'
-            EvalPropContext.context_stack.pop()
 
         # At this point, if the value was a {text}, the accum will contain
         # the desired description.
@@ -283,7 +364,6 @@ class EvalPropContext(object):
             return res
         raise Exception('unrecognized eval level: %d' % (self.level,))
         
-    @tornado.gen.coroutine
     def evalobj(self, key, evaltype=EVALTYPE_SYMBOL, symbol=None, locals=None):
         """Look up a symbol, adding it to the accumulated content. If the
         result contains interpolated strings, this calls itself recursively.
@@ -292,6 +372,37 @@ class EvalPropContext(object):
         is ignored). For other types, the symbol may be provided as handy
         context.
 
+        This returns a Future. The work is done in evalobj_work(); when
+        the world is being profiled, we wrap that in evalobj_profiled().
+        """
+        if self.profcounter is not None:
+            if evaltype == EVALTYPE_SYMBOL:
+                label = key
+            elif symbol is not None or evaltype == EVALTYPE_CODE:
+                label = ScriptProfiler.label_for(key, symbol)
+            else:
+                label = None
+            if label is not None:
+                return self.evalobj_profiled(label, key, evaltype, symbol, locals)
+        return self.evalobj_work(key, evaltype=evaltype, symbol=symbol, locals=locals)
+
+    @tornado.gen.coroutine
+    def evalobj_profiled(self, label, key, evaltype, symbol, locals):
+        """Call evalobj_work(), and add its cost to the profiler's entry
+        for the label.
+        """
+        profiler = self.app.profiler
+        mark = profiler.start(self)
+        try:
+            res = yield self.evalobj_work(key, evaltype=evaltype, symbol=symbol, locals=locals)
+            return res
+        finally:
+            profiler.finish(self, label, mark)
+
+    @tornado.gen.coroutine
+    def evalobj_work(self, key, evaltype=EVALTYPE_SYMBOL, symbol=None, locals=None):
+        """The body of evalobj().
+
         Returns an object, or fills out a description array and returns that.
         (The latter only at MESSAGE/DISPLAY/DISPSPECIAL/EXECUTE level.)
 
@@ -319,7 +430,7 @@ class EvalPropContext(object):
             raise Exception('evalobj: unknown evaltype %s' % (evaltype,))
 
         objtype = None
-        if type(res) is dict:
+        if isinstance(res, dict):
             objtype = res.get('type', None)
 
         if self.depth == 0 and objtype:
@@ -330,9 +441,7 @@ class EvalPropContext(object):
         if self.depth == 0 and self.level == LEVEL_DISPSPECIAL and objtype == 'selfdesc':
             assert self.accum is not None, 'EvalPropContext.accum should not be None here'
             try:
-                world = yield motor.Op(self.app.mongodb.worlds.find_one,
-                                       {'_id':self.loctx.wid},
-                                       {'instancing':1})
+                world = yield self.app.entitycache.get('worlds', self.loctx.wid)
                 if not (world and world.get('instancing', None) == 'solo'):
                     return 'You may only edit your appearance in a solo world.'
                 extratext = None
@@ -342,9 +451,7 @@ class EvalPropContext(object):
                     ctx = EvalPropContext(self.task, parent=self, level=LEVEL_DISPLAY)
                     extratext = yield ctx.eval(val, evaltype=EVALTYPE_TEXT)
                     self.updateacdepends(ctx)
-                player = yield motor.Op(self.app.mongodb.players.find_one,
-                                        {'_id':self.uid},
-                                        {'name':1, 'pronoun':1, 'desc':1})
+                player = yield self.app.playercache.get(self.uid)
                 if not player:
                     return 'There is no such person.'
                 specres = ['selfdesc',
@@ -448,7 +555,7 @@ class EvalPropContext(object):
                         self.genseed = str(self.loctx.iid).encode()
                     except:
                         self.genseed = b'???'
-                tree = twcommon.gentext.parse(res.get('text', ''))
+                tree = twcommon.gentext.parse_cached(res.get('text', ''))
                 toplevel = (not self.gentexting)
                 if toplevel:
                     tree.setup_context(self)
@@ -497,555 +604,67 @@ class EvalPropContext(object):
         """
         self.task.tick()
 
-        ### This originlabel stuff is pretty much wrong. Also slow.
-        ### And unnecessary, now that the build interface test-parses?
-        if originlabel:
-            if type(originlabel) is dict and 'text' in originlabel:
-                originlabel = originlabel['text']
-            originlabel = '"%.20s"' % (originlabel,)
-        else:
-            originlabel = '<script>'
-            
-        tree = ast.parse(text, filename=originlabel)
-        assert type(tree) is ast.Module
+        # The originlabel is only used for a SyntaxError, which means a
+        # cache miss; compile_code() only formats it in that case.
+        code = compile_code(text, originlabel)
 
-        res = None
-        for nod in tree.body:
-            res = yield self.execcode_statement(nod)
+        res = two.compiler.evaluate(self, code.body)
+        if isinstance(res, tornado.concurrent.Future):
+            res = yield res
         return res
 
-    @tornado.gen.coroutine
-    def execcode_statement(self, nod):
-        self.task.tick()
-        nodtyp = type(nod)
-        if nodtyp is ast.Expr:
-            res = yield self.execcode_expr(nod.value)
-            if res is not None and type(res) is dict and 'type' in res:
-                # Top-level expression has returned a typed dict. Try
-                # invoking it.
-                symbol = None
-                if type(nod.value) is ast.Name:
-                    symbol = nod.value.id
-                res = yield self.invoke_typed_dict(res, symbol)
-                return res
-            return res
-        # Use lookup table for most cases. The lookup table winds up containing
-        # unbound method handlers, so we need to pass self.
-        han = self.execcode_statement_handlers.get(nodtyp, None)
-        if han:
-            res = yield han(self, nod)
-            return res
-        if nodtyp is ast.Pass:
-            return None
-        raise NotImplementedError('Script statement type not implemented: %s' % (nodtyp.__name__,))
-
-    @tornado.gen.coroutine
-    def execcode_expr_store(self, nod):
-        """Does not evaluate a complete expression. Instead, returns a
-        wrapper object with load(), store(), and delete() methods.
-        (The load() accessor supports augment "x += 1" operations.)
-        (The nod.ctx lets us know whether store/augment or delete is
-        coming up; but the way our proxies work, we don't much care.)
+    def evalcode_sync(self, text):
+        """Try to evaluate an interpolated code snippet without the
+        coroutine and stack frame that evalobj(text, EVALTYPE_CODE) would
+        set up. This only works for pure expressions (see
+        two.compiler.is_pure_expression) which can't touch the database:
+        arithmetic, comparisons, literals.
+
+        Returns (True, value), or (False, None) if the caller should go
+        the long way around. The ticks are the same either way. (There
+        are no dependencies to record, since a pure expression doesn't
+        look anything up.)
         """
-        assert type(nod.ctx) is not ast.Load, 'target of assignment has Load context'
-        nodtyp = type(nod)
-        if nodtyp is ast.Name:
-            return two.execute.BoundNameProxy(nod.id)
-        if nodtyp is ast.Attribute:
-            argument = yield self.execcode_expr(nod.value)
-            key = nod.attr
-            if isinstance(argument, two.execute.PropertyProxyMixin):
-                return two.execute.BoundPropertyProxy(argument, key)
-            raise ExecSandboxException('%s.%s: setattr not allowed' % (type(argument).__name__, key))
-        if nodtyp is ast.Subscript:
-            argument = yield self.execcode_expr(nod.value)
-            subnod = nod.slice
-            subtyp = type(subnod)
-            if subtyp is ast.Index:
-                subscript = yield self.execcode_expr(subnod.value)
-            elif subtyp is ast.Slice:
-                lower = None
-                if subnod.lower is not None:
-                    lower = yield self.execcode_expr(subnod.lower)
-                upper = None
-                if subnod.upper is not None:
-                    upper = yield self.execcode_expr(subnod.upper)
-                if subnod.step is None:
-                    subscript = slice(lower, upper)
-                else:
-                    step = yield self.execcode_expr(subnod.step)
-                    subscript = slice(lower, upper, step)
-            else:
-                raise NotImplementedError('Unsupported subscript type: %s' % (subtyp.__name__,))
-            if isinstance(argument, two.execute.PropertyProxyMixin):
-                # Special case: property proxies can be accessed by subscript.
-                return two.execute.BoundPropertyProxy(argument, subscript)
-            return two.execute.BoundSubscriptProxy(argument, subscript)
-        if nodtyp in (ast.Tuple, ast.List):
-            ls = []
-            for subnod in nod.elts:
-                val = yield self.execcode_expr_store(subnod)
-                ls.append(val)
-            return two.execute.MultiBoundProxy(ls)
-        raise NotImplementedError('Script store-expression type not implemented: %s' % (nodtyp.__name__,))
-        
-        
-    @tornado.gen.coroutine
-    def execcode_expr(self, nod):
+        try:
+            code = compile_code(text)
+        except SyntaxError:
+            # Let evalobj raise this, in the usual order.
+            return (False, None)
+        if code.pure is None:
+            return (False, None)
+        if self.parentdepth+self.depth+1 > self.task.STACK_DEPTH_LIMIT:
+            # evalobj will raise ExecRunawayException.
+            return (False, None)
+        # One tick each for evalobj, execute_code, and the expression
+        # statement; the expression ticks for itself.
         self.task.tick()
-        nodtyp = type(nod)
-        if nodtyp is ast.Str:
-            return nod.s
-        if nodtyp is ast.Num:
-            return nod.n  # covers floats and ints
-        # Use lookup table for most cases. The lookup table winds up containing
-        # unbound method handlers, so we need to pass self.
-        han = self.execcode_expr_handlers.get(nodtyp, None)
-        if han:
-            res = yield han(self, nod)
-            return res
-        raise NotImplementedError('Script expression type not implemented: %s' % (nodtyp.__name__,))
-
-    @tornado.gen.coroutine
-    def execcode_list(self, nod):
-        ls = []
-        for subnod in nod.elts:
-            val = yield self.execcode_expr(subnod)
-            ls.append(val)
-        return ls
-
-    @tornado.gen.coroutine
-    def execcode_tuple(self, nod):
-        ls = []
-        for subnod in nod.elts:
-            val = yield self.execcode_expr(subnod)
-            ls.append(val)
-        return tuple(ls)
-
-    @tornado.gen.coroutine
-    def execcode_set(self, nod):
-        ls = []
-        for subnod in nod.elts:
-            val = yield self.execcode_expr(subnod)
-            ls.append(val)
-        return set(ls)
-
-    @tornado.gen.coroutine
-    def execcode_dict(self, nod):
-        keyls = []
-        for subnod in nod.keys:
-            val = yield self.execcode_expr(subnod)
-            keyls.append(val)
-        valls = []
-        for subnod in nod.values:
-            val = yield self.execcode_expr(subnod)
-            valls.append(val)
-        return dict(zip(keyls, valls))
-
-    map_unaryop_operators = {
-        ast.Not: operator.not_,
-        ast.UAdd: operator.pos,
-        ast.USub: operator.neg,
-        }
-        
-    @tornado.gen.coroutine
-    def execcode_unaryop(self, nod):
-        optyp = type(nod.op)
-        argval = yield self.execcode_expr(nod.operand)
-        opfunc = self.map_unaryop_operators.get(optyp, None)
-        if not opfunc:
-            raise NotImplementedError('Script unaryop type not implemented: %s' % (optyp.__name__,))
-        return opfunc(argval)
-
-    # These operators are actually polymorphic. Add includes concat,
-    # mod includes string-format, and so on.
-    map_binop_operators = {
-        ast.Add: operator.add,
-        ast.Sub: operator.sub,
-        ast.Mult: operator.mul,
-        ast.Div: operator.truediv,
-        ast.Mod: operator.mod,
-        ast.Pow: operator.pow,
-        ast.FloorDiv: operator.floordiv,
-        ast.BitAnd: operator.and_,
-        ast.BitOr: operator.or_,
-        ast.BitXor: operator.xor,
-        ast.LShift: operator.lshift,
-        ast.RShift: operator.rshift,
-        }
-        
-    @tornado.gen.coroutine
-    def execcode_binop(self, nod):
-        optyp = type(nod.op)
-        leftval = yield self.execcode_expr(nod.left)
-        rightval = yield self.execcode_expr(nod.right)
-        opfunc = self.map_binop_operators.get(optyp, None)
-        if not opfunc:
-            raise NotImplementedError('Script binop type not implemented: %s' % (optyp.__name__,))
-        return opfunc(leftval, rightval)
-        
-    @tornado.gen.coroutine
-    def execcode_boolop(self, nod):
-        optyp = type(nod.op)
-        assert len(nod.values) > 0
-        if optyp is ast.And:
-            for subnod in nod.values:
-                val = yield self.execcode_expr(subnod)
-                if not val:
-                    return val
-            return val
-        if optyp is ast.Or:
-            for subnod in nod.values:
-                val = yield self.execcode_expr(subnod)
-                if val:
-                    return val
-            return val
-        raise NotImplementedError('Script boolop type not implemented: %s' % (optyp.__name__,))
-
-    map_compare_operators = {
-        ast.Is: operator.is_,
-        ast.IsNot: operator.is_not,
-        ast.Eq: operator.eq,
-        ast.NotEq: operator.ne,
-        ast.Lt: operator.lt,
-        ast.LtE: operator.le,
-        ast.Gt: operator.gt,
-        ast.GtE: operator.ge,
-        # We don't use operator.contains, because its arguments are reversed
-        # for some forsaken reason.
-        ast.In: lambda x,y:(x in y),
-        ast.NotIn: lambda x,y:(x not in y),
-        }
-    
-    @tornado.gen.coroutine
-    def execcode_compare(self, nod):
-        leftval = yield self.execcode_expr(nod.left)
-        for (op, subnod) in zip(nod.ops, nod.comparators):
-            rightval = yield self.execcode_expr(subnod)
-            optyp = type(op)
-            opfunc = self.map_compare_operators.get(optyp, None)
-            if not opfunc:
-                raise NotImplementedError('Script compare type not implemented: %s' % (optyp.__name__,))
-            res = opfunc(leftval, rightval)
-            if not res:
-                return res
-            leftval = rightval
-        return True
-        
-    @tornado.gen.coroutine
-    def execcode_listcomp(self, nod):
-        targets = []
-        iters = []
-        ifss = []
-        for comp in nod.generators:
-            target = yield self.execcode_expr_store(comp.target)
-            iter = yield self.execcode_expr(comp.iter)
-            ifs = comp.ifs
-            targets.append(target)
-            iters.append(iter)
-            ifss.append(ifs)
-        res = []
-        for tup in itertools.product(*iters):
-            flag = True
-            for target, val, ifs in zip(targets, tup, ifss):
-                yield target.store(self, self.loctx, val)
-                for ifnod in ifs:
-                    flag = yield self.execcode_expr(ifnod)
-                    if not flag:
-                        break
-                if not flag:
-                    break
-            if flag:
-                val = yield self.execcode_expr(nod.elt)
-                res.append(val)
-        return res
-        
-    @tornado.gen.coroutine
-    def execcode_setcomp(self, nod):
-        targets = []
-        iters = []
-        ifss = []
-        for comp in nod.generators:
-            target = yield self.execcode_expr_store(comp.target)
-            iter = yield self.execcode_expr(comp.iter)
-            ifs = comp.ifs
-            targets.append(target)
-            iters.append(iter)
-            ifss.append(ifs)
-        res = set()
-        for tup in itertools.product(*iters):
-            flag = True
-            for target, val, ifs in zip(targets, tup, ifss):
-                yield target.store(self, self.loctx, val)
-                for ifnod in ifs:
-                    flag = yield self.execcode_expr(ifnod)
-                    if not flag:
-                        break
-                if not flag:
-                    break
-            if flag:
-                val = yield self.execcode_expr(nod.elt)
-                res.add(val)
-        return res
-        
-    @tornado.gen.coroutine
-    def execcode_dictcomp(self, nod):
-        targets = []
-        iters = []
-        ifss = []
-        for comp in nod.generators:
-            target = yield self.execcode_expr_store(comp.target)
-            iter = yield self.execcode_expr(comp.iter)
-            ifs = comp.ifs
-            targets.append(target)
-            iters.append(iter)
-            ifss.append(ifs)
-        res = {}
-        for tup in itertools.product(*iters):
-            flag = True
-            for target, val, ifs in zip(targets, tup, ifss):
-                yield target.store(self, self.loctx, val)
-                for ifnod in ifs:
-                    flag = yield self.execcode_expr(ifnod)
-                    if not flag:
-                        break
-                if not flag:
-                    break
-            if flag:
-                keyval = yield self.execcode_expr(nod.key)
-                valueval = yield self.execcode_expr(nod.value)
-                res[keyval] = valueval
-        return res
-        
-    @tornado.gen.coroutine
-    def execcode_attribute(self, nod):
-        argument = yield self.execcode_expr(nod.value)
-        key = nod.attr
-        # The real getattr() is way too powerful to offer up.
-        if isinstance(argument, two.symbols.ScriptNamespace):
-            (res, yieldy) = argument.getyieldy(key)
-            if yieldy:
-                res = yield res()
-            return res
-        if isinstance(argument, two.execute.PropertyProxyMixin):
-            res = yield argument.getprop(self, self.loctx, key)
-            return res
-        typarg = type(argument)
-        if two.symbols.type_getattr_allowed(typarg, key):
-            return getattr(argument, key)
-        raise ExecSandboxException('%s.%s: getattr not allowed' % (typarg.__name__, key))
-
-    @tornado.gen.coroutine
-    def execcode_subscript(self, nod):
-        argument = yield self.execcode_expr(nod.value)
-        subnod = nod.slice
-        subtyp = type(subnod)
-        if subtyp is ast.Index:
-            subscript = yield self.execcode_expr(subnod.value)
-        elif subtyp is ast.Slice:
-            lower = None
-            if subnod.lower is not None:
-                lower = yield self.execcode_expr(subnod.lower)
-            upper = None
-            if subnod.upper is not None:
-                upper = yield self.execcode_expr(subnod.upper)
-            if subnod.step is None:
-                subscript = slice(lower, upper)
-            else:
-                step = yield self.execcode_expr(subnod.step)
-                subscript = slice(lower, upper, step)
-        else:
-            raise NotImplementedError('Unsupported subscript type: %s' % (subtyp.__name__,))
-        if isinstance(argument, two.execute.PropertyProxyMixin):
-            # Special case: property proxies can be accessed by subscript.
-            res = yield argument.getprop(self, self.loctx, subscript)
-            return res
-        return argument[subscript]
-
-    @tornado.gen.coroutine
-    def execcode_call(self, nod):
-        funcval = yield self.execcode_expr(nod.func)
-        args = []
-        for subnod in nod.args:
-            val = yield self.execcode_expr(subnod)
-            args.append(val)
-        if nod.starargs:
-            starargs = yield self.execcode_expr(nod.starargs)
-            args.extend(starargs)
-        kwargs = {}
-        for subnod in nod.keywords:
-            val = yield self.execcode_expr(subnod.value)
-            kwargs[subnod.arg] = val
-        if nod.kwargs:
-            starargs = yield self.execcode_expr(nod.kwargs)
-            # Python semantics say we should reject duplicate kwargs here
-            kwargs.update(starargs)
-            
-        if isinstance(funcval, two.symbols.ScriptFunc):
-            if not funcval.yieldy:
-                return funcval.func(*args, **kwargs)
-            else:
-                res = yield funcval.yieldfunc(*args, **kwargs)
-                return res
-        if funcval and twcommon.misc.is_typed_dict(funcval, 'code'):
-            # {code} dicts are considered callable by courtesy.
-            argspec = funcval.get('args', None)
-            if not argspec:
-                locals = None
-                if args or kwargs:
-                    raise TypeError('code property does not take arguments, but was given %d' % (len(args)+len(kwargs),))
-            else:
-                argspec = parse_argument_spec(argspec)
-                yield self.replace_argspec_defaults(argspec)
-                locals = resolve_argument_spec(argspec, args, kwargs)
-            val = funcval.get('text', None)
-            if not val:
-                return None
-            newval = yield self.evalobj(val, evaltype=EVALTYPE_CODE, locals=locals)
-            return newval
-        ### Validate that funcval is a safe thing to call!
-        # This will raise TypeError if funcval is not callable.
-        return funcval(*args, **kwargs)
-        
-    @tornado.gen.coroutine
-    def execcode_name(self, nod):
-        symbol = nod.id
-        res = yield two.symbols.find_symbol(self.app, self.loctx, symbol, locals=self.frame.locals, dependencies=self.dependencies)
-        return res
-
-    @tornado.gen.coroutine
-    def execcode_if(self, nod):
-        testval = yield self.execcode_expr(nod.test)
-        if testval:
-            body = nod.body
-        else:
-            body = nod.orelse
-        res = None
-        for nod in body:
-            res = yield self.execcode_statement(nod)
-        return res
-        
-    @tornado.gen.coroutine
-    def execcode_while(self, nod):
-        while True:
-            testval = yield self.execcode_expr(nod.test)
-            if not testval:
-                break
-            try:
-                for subnod in nod.body:
-                    res = yield self.execcode_statement(subnod)
-            except ContinueException:
-                pass
-            except BreakException:
-                return
-        for subnod in nod.orelse:
-            res = yield self.execcode_statement(subnod)
-        
-    @tornado.gen.coroutine
-    def execcode_for(self, nod):
-        target = yield self.execcode_expr_store(nod.target)
-        iter = yield self.execcode_expr(nod.iter)
-        for val in iter:
-            yield target.store(self, self.loctx, val)
-            try:
-                for subnod in nod.body:
-                    res = yield self.execcode_statement(subnod)
-            except ContinueException:
-                pass
-            except BreakException:
-                return
-        for subnod in nod.orelse:
-            res = yield self.execcode_statement(subnod)
-        
-    @tornado.gen.coroutine
-    def execcode_return(self, nod):
-        if nod.value is None:
-            val = None
-        else:
-            val = yield self.execcode_expr(nod.value)
-        raise ReturnException(returnvalue=val)
-        
-    @tornado.gen.coroutine
-    def execcode_break(self, nod):
-        raise BreakException
-        
-    @tornado.gen.coroutine
-    def execcode_continue(self, nod):
-        raise ContinueException
-        
-    @tornado.gen.coroutine
-    def execcode_assign(self, nod):
-        val = yield self.execcode_expr(nod.value)
-        for tarnod in nod.targets:
-            target = yield self.execcode_expr_store(tarnod)
-            yield target.store(self, self.loctx, val)
-        return None
-
-    @tornado.gen.coroutine
-    def execcode_augassign(self, nod):
-        optyp = type(nod.op)
-        opfunc = self.map_binop_operators.get(optyp, None)
-        if not opfunc:
-            raise NotImplementedError('Script augop type not implemented: %s' % (optyp.__name__,))
-        target = yield self.execcode_expr_store(nod.target)
-        rightval = yield self.execcode_expr(nod.value)
-
-        leftval = yield target.load(self, self.loctx)
-        val = opfunc(leftval, rightval)
-        
-        yield target.store(self, self.loctx, val)
-        return None
-
-    @tornado.gen.coroutine
-    def execcode_delete(self, nod):
-        for subnod in nod.targets:
-            target = yield self.execcode_expr_store(subnod)
-            yield target.delete(self, self.loctx)
-        return None
-
-    # Some lookup tables of node handlers
-    execcode_expr_handlers = {
-        ast.Name: execcode_name,
-        ast.List: execcode_list,
-        ast.Tuple: execcode_tuple,
-        ast.Set: execcode_set,
-        ast.Dict: execcode_dict,
-        ast.UnaryOp: execcode_unaryop,
-        ast.BinOp: execcode_binop,
-        ast.BoolOp: execcode_boolop,
-        ast.Compare: execcode_compare,
-        ast.ListComp: execcode_listcomp,
-        ast.SetComp: execcode_setcomp,
-        ast.DictComp: execcode_dictcomp,
-        ast.Attribute: execcode_attribute,
-        ast.Subscript: execcode_subscript,
-        ast.Call: execcode_call,
-        }
-
-    execcode_statement_handlers = {
-        ast.Assign: execcode_assign,
-        ast.AugAssign: execcode_augassign,
-        ast.Delete: execcode_delete,
-        ast.If: execcode_if,
-        ast.While: execcode_while,
-        ast.For: execcode_for,
-        ast.Return: execcode_return,
-        ast.Break: execcode_break,
-        ast.Continue: execcode_continue,
-        }
+        self.task.tick()
+        self.task.tick()
+        return (True, code.pure(self))
 
     @tornado.gen.coroutine
     def replace_argspec_defaults(self, argspec):
+        """Evaluate the default values in an argspec (which parse_argument_spec
+        leaves as ast nodes, along with their compiled forms). A kw_defaults
+        entry of None means "no default", and stays None.
+        """
         if argspec.defaults:
             ls = []
-            for val in argspec.defaults:
-                newval = yield self.execcode_expr(val)
+            for compiled in argspec.compiled_defaults:
+                newval = two.compiler.evaluate(self, compiled)
+                if isinstance(newval, tornado.concurrent.Future):
+                    newval = yield newval
                 ls.append(newval)
             argspec.defaults = ls
         if argspec.kw_defaults:
             ls = []
-            for val in argspec.kw_defaults:
-                newval = yield self.execcode_expr(val)
+            for compiled in argspec.compiled_kw_defaults:
+                if compiled is None:
+                    ls.append(None)
+                    continue
+                newval = two.compiler.evaluate(self, compiled)
+                if isinstance(newval, tornado.concurrent.Future):
+                    newval = yield newval
                 ls.append(newval)
             argspec.kw_defaults = ls
         return
@@ -1186,7 +805,7 @@ class EvalPropContext(object):
         """
         self.task.tick()
         
-        nodls = twcommon.interp.parse(text)
+        nodls = twcommon.interp.parse_cached(text)
         
         # While trawling through nodls, we may encounter $if/$end
         # nodes. This keeps track of them. Specifically: a 0 value
@@ -1215,7 +834,9 @@ class EvalPropContext(object):
                     suppstack.append(0)
                     continue
                 try:
-                    ifval = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
+                    (done, ifval) = self.evalcode_sync(nod.expr)
+                    if not done:
+                        ifval = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
                 except LookupError: # includes SymbolError
                     ifval = None
                 except AttributeError:
@@ -1241,7 +862,9 @@ class EvalPropContext(object):
                     continue
                 # We follow an unsuccessful "if". Maybe suppress.
                 try:
-                    ifval = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
+                    (done, ifval) = self.evalcode_sync(nod.expr)
+                    if not done:
+                        ifval = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
                 except LookupError: # includes SymbolError
                     ifval = None
                 except AttributeError:
@@ -1291,7 +914,9 @@ class EvalPropContext(object):
             
             if nodkey == 'Interpolate':
                 try:
-                    subres = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
+                    (done, subres) = self.evalcode_sync(nod.expr)
+                    if not done:
+                        subres = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
                 except LookupError: # includes SymbolError:
                     continue
                 except AttributeError:
@@ -1314,15 +939,16 @@ class EvalPropContext(object):
                 else:
                     uid = self.uid
                     
-                player = yield motor.Op(self.app.mongodb.players.find_one,
-                                        {'_id':uid},
-                                        {'name':1, 'pronoun':1})
+                player = yield self.app.playercache.get(uid)
                 if not player:
                     self.accum.append('[No such player]')
                     continue
                 if nod.key == 'name':
                     self.accum_append(player['name'], raw=True)
                 else:
+                    # Pronouns can change (selfdesc), and we don't track
+                    # that as a dependency.
+                    self.cacheable = False
                     self.accum_append(two.grammar.resolve_pronoun(player, nod.key), raw=True)
                 continue
 
@@ -1395,9 +1021,7 @@ class EvalPropContext(object):
         if not (self.caps & EVALCAP_MOVE):
             raise Exception('Moves not permitted in this code')
 
-        player = yield motor.Op(self.app.mongodb.players.find_one,
-                                {'_id':self.uid},
-                                {'name':1})
+        player = yield self.app.playercache.get(self.uid)
         playername = player['name']
                 
         # If the location has an on_leave property, run it.
@@ -1410,7 +1034,7 @@ class EvalPropContext(object):
             try:
                 args = { '_from':two.execute.LocationProxy(self.loctx.locid),
                          '_to':two.execute.LocationProxy(locid) }
-                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, symbol='on_leave', locals=args)
             except Exception as ex:
                 self.task.log.warning('Caught exception (leaving loc, move): %s', ex, exc_info=self.app.debugstacktraces)
             ctx = None
@@ -1434,6 +1058,7 @@ class EvalPropContext(object):
                                 'focus':None,
                                 'lastlocid': lastlocid,
                                 'lastmoved': self.task.starttime }})
+        self.app.occupancy.set_location(self.uid, self.loctx.iid, locid, self.task.starttime)
         self.task.set_dirty(self.uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_POPULACE)
         self.task.set_data_change( ('playstate', self.uid, 'locid') )
         if lastlocid:
@@ -1474,7 +1099,7 @@ class EvalPropContext(object):
                 else:
                     args = { '_from':None,
                              '_to':two.execute.LocationProxy(locid) }
-                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, symbol='on_enter', locals=args)
             except Exception as ex:
                 self.task.log.warning('Caught exception (entering loc, move): %s', ex, exc_info=self.app.debugstacktraces)
 
@@ -1603,14 +1228,69 @@ def optimize_accum(ls):
         end = beg
     return
 
+# Process-wide caches of compiled script code and parsed argument specs,
+# keyed by source text. These are shared, so nothing may modify them.
+code_compile_cache = twcommon.misc.LRUCache(2000, name='code_compile_cache')
+argspec_parse_cache = twcommon.misc.LRUCache(500, name='argspec_parse_cache')
+
+def compile_code(text, originlabel=None):
+    """Parse a {code} body and compile it (see two.compiler), or fetch it
+    from the cache. Raises SyntaxError if the code is invalid. (Failures
+    aren't cached.)
+    """
+    code = code_compile_cache.get(text)
+    if code is not None:
+        return code
+    tree = parse_code(text, originlabel)
+    code = two.compiler.compile_module(tree)
+    code_compile_cache.set(text, code)
+    return code
+
+def parse_code(text, originlabel=None):
+    """Parse a {code} body into an ast.Module.
+    Raises SyntaxError if the code is invalid.
+    The originlabel is the property key (or a dict with 'text'), for
+    the error message.
+    """
+    ### This originlabel stuff is pretty much wrong.
+    ### And unnecessary, now that the build interface test-parses?
+    if originlabel:
+        if isinstance(originlabel, dict) and 'text' in originlabel:
+            originlabel = originlabel['text']
+        originlabel = '"%.20s"' % (originlabel,)
+    else:
+        originlabel = '<script>'
+            
+    tree = ast.parse(text, filename=originlabel)
+    assert type(tree) is ast.Module
+    return tree
+
 def parse_argument_spec(spec):
+    """Cached wrapper for parse_argument_spec_uncached. The result is
+    a fresh shallow copy, so the caller may replace its defaults and
+    kw_defaults arrays.
+
+    The cached spec also carries compiled_defaults and compiled_kw_defaults
+    arrays (compiled once, here), which replace_argspec_defaults evaluates.
+    """
+    if not spec:
+        spec = ''
+    res = argspec_parse_cache.get(spec)
+    if res is None:
+        res = parse_argument_spec_uncached(spec)
+        res.compiled_defaults = [ two.compiler.compile_expr(val) for val in res.defaults ]
+        res.compiled_kw_defaults = [ (None if val is None else two.compiler.compile_expr(val)) for val in res.kw_defaults ]
+        argspec_parse_cache.set(spec, res)
+    return copy.copy(res)
+
+def parse_argument_spec_uncached(spec):
     """Take a function argument spec (e.g. "x, y=3") and parse it into a
     structure. Raises SyntaxError if the spec is invalid.
     Do not include the parentheses in the spec.
     This relies on the Python mechanism in ast.parse.
     
     The defaults and kw_defaults arrays in the result contain ast nodes.
-    The caller should immediately evaluate these (self.execcode_expr).
+    The caller should immediately evaluate these (replace_argspec_defaults).
     (The tests and code both assume that spec.defaults and spec.kw_defaults
     are reassignable.)
     """
@@ -1705,6 +1385,8 @@ from twcommon.interp import InterpNode
 from twcommon.gentext import GenNodeClass, SymbolNode, SeqNode, AltNode, ShuffleNode, BeginNode, WordNode, ANode, AFormNode, AnFormNode, RunOnNode, RunOnExplicitNode, RunOnCapNode, ParaNode, StopNode, SemiNode, CommaNode
 import two.execute
 import two.symbols
+import two.compiler
 import twcommon.gentext
 import two.grammar
 from two.task import DIRTY_ALL, DIRTY_WORLD, DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS
+from two.profiler import ScriptProfiler
@@ -68,29 +68,17 @@ class PlayerProxy(PropertyProxyMixin, object):
         dependencies = ctx.dependencies
         app = ctx.app
         
+        tups = []
         if iid is not None:
-            res = yield app.propcache.get(('iplayerprop', iid, uid, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-    
-        if True:
-            res = yield app.propcache.get(('wplayerprop', wid, uid, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-
+            tups.append(('iplayerprop', iid, uid, key))
+        tups.append(('wplayerprop', wid, uid, key))
         if iid is not None:
-            res = yield app.propcache.get(('iplayerprop', iid, None, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-    
-        if True:
-            res = yield app.propcache.get(('wplayerprop', wid, None, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
+            tups.append(('iplayerprop', iid, None, key))
+        tups.append(('wplayerprop', wid, None, key))
+        
+        res = yield app.propcache.get_first(tups, dependencies=dependencies)
+        if res:
+            return res.val
 
         raise AttributeError('Player property "%s" is not found' % (key,))
         
@@ -153,29 +141,17 @@ class LocationProxy(PropertyProxyMixin, object):
         app = ctx.app
         dependencies = ctx.dependencies
         
+        tups = []
         if iid is not None:
-            res = yield app.propcache.get(('instanceprop', iid, locid, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-    
-        if True:
-            res = yield app.propcache.get(('worldprop', wid, locid, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-
+            tups.append(('instanceprop', iid, locid, key))
+        tups.append(('worldprop', wid, locid, key))
         if iid is not None:
-            res = yield app.propcache.get(('instanceprop', iid, None, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-    
-        if True:
-            res = yield app.propcache.get(('worldprop', wid, None, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
+            tups.append(('instanceprop', iid, None, key))
+        tups.append(('worldprop', wid, None, key))
+        
+        res = yield app.propcache.get_first(tups, dependencies=dependencies)
+        if res:
+            return res.val
 
         raise AttributeError('Property "%s" is not found' % (key,))
         
@@ -224,17 +200,14 @@ class RealmProxy(PropertyProxyMixin, object):
         app = ctx.app
         dependencies = ctx.dependencies
         
+        tups = []
         if iid is not None:
-            res = yield app.propcache.get(('instanceprop', iid, None, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
-    
-        if True:
-            res = yield app.propcache.get(('worldprop', wid, None, key),
-                                          dependencies=dependencies)
-            if res:
-                return res.val
+            tups.append(('instanceprop', iid, None, key))
+        tups.append(('worldprop', wid, None, key))
+        
+        res = yield app.propcache.get_first(tups, dependencies=dependencies)
+        if res:
+            return res.val
 
         raise AttributeError('Realm property "%s" is not found' % (key,))
         
@@ -442,13 +415,22 @@ def scope_access_level(app, uid, wid, scid):
     If the scope is personal, the owner has creator access. (This is actually
     in the scopeaccess table, but we special-case it anyhow.)
     Otherwise, check the scopeaccess table.
+
+    The result is cached in app.accesscache.
     """
-    scope = yield motor.Op(app.mongodb.scopes.find_one,
-                         {'_id':scid},
-                         {'type':1, 'level':1})
+    level = app.accesscache.get(uid, wid, scid)
+    if level is not None:
+        return level
+    generation = app.accesscache.generation
+    level = yield scope_access_level_uncached(app, uid, wid, scid)
+    app.accesscache.set(uid, wid, scid, level, generation)
+    return level
+
+@tornado.gen.coroutine
+def scope_access_level_uncached(app, uid, wid, scid):
+    scope = yield app.entitycache.get('scopes', scid)
     if scope['type'] == 'glob':
-        world = yield motor.Op(app.mongodb.worlds.find_one,
-                               {'_id':wid})
+        world = yield app.entitycache.get('worlds', wid)
         if world and world['creator'] == uid:
             return ACC_FOUNDER
         return ACC_VISITOR
@@ -480,9 +462,9 @@ def portal_in_reach(app, portal, uid, wid):
         if portal['inwid'] != wid:
             raise ErrorMessageException('You are not in this portal\'s world.')
     elif 'plistid' in portal:
-        # In a portlist.
-        portlist = yield motor.Op(app.mongodb.portlists.find_one,
-                                  {'_id':portal['plistid']})
+        # In a portlist. (The type, uid, and wid of a portlist never
+        # change, so the cached copy is fine.)
+        portlist = yield app.entitycache.get('portlists', portal['plistid'])
         if not portlist:
             raise ErrorMessageException('Portal does not have a portlist.')
         if portlist['type'] == 'pers':
@@ -503,8 +485,7 @@ def portal_alt_scope_accessible(app, scid, uid, world):
     if (world['instancing'] != 'standard'):
         raise ErrorMessageException('The instance of this portal may not be changed.')
 
-    scope = yield motor.Op(app.mongodb.scopes.find_one,
-                            {'_id':scid})
+    scope = yield app.entitycache.get('scopes', scid)
     if not scope:
         raise ErrorMessageException('No such scope!')
 
@@ -512,9 +493,7 @@ def portal_alt_scope_accessible(app, scid, uid, world):
         # Global scope is always okay
         return
     if scope['type'] == 'pers':
-        player = yield motor.Op(app.mongodb.players.find_one,
-                                {'_id':uid},
-                                {'scid':1})
+        player = yield app.playercache.get(uid)
         if scid == player['scid']:
             # Your personal scope is always okay
             return
@@ -543,15 +522,12 @@ def portal_resolve_scope(app, portal, uid, scid, world):
         reqscid = 'global'
     
     if reqscid == 'personal':
-        player = yield motor.Op(app.mongodb.players.find_one,
-                                {'_id':uid},
-                                {'scid':1})
+        player = yield app.playercache.get(uid)
         if not player or not player['scid']:
             raise ErrorMessageException('You have no personal scope!')
         newscid = player['scid']
     elif reqscid == 'global':
-        config = yield motor.Op(app.mongodb.config.find_one,
-                                {'key':'globalscopeid'})
+        config = yield app.entitycache.get_config('globalscopeid')
         if not config:
             raise ErrorMessageException('There is no global scope!')
         newscid = config['val']
@@ -567,8 +543,7 @@ def scope_description(app, scid, uid):
     """Return a (JSONable) object describing a scope in human-readable
     strings. Returns None if a problem arises.
     """
-    scope = yield motor.Op(app.mongodb.scopes.find_one,
-                           {'_id':scid})
+    scope = yield app.entitycache.get('scopes', scid)
     if not scope:
         return None
 
@@ -583,9 +558,7 @@ def scope_description(app, scid, uid):
         res['name'] = 'Personal'
         res['you'] = True
     elif scopetype == 'pers':
-        player = yield motor.Op(app.mongodb.players.find_one,
-                                {'_id':scope['uid']},
-                                {'name':1})
+        player = yield app.playercache.get(scope['uid'])
         res['name'] = 'Personal: %s' % (player['name'],)
     else:
         res['name'] = '???'
@@ -609,14 +582,12 @@ def portal_description(app, portal, uid, uidiid=None, location=False, short=Fals
         if not portal:
             return None
         
-        world = yield motor.Op(app.mongodb.worlds.find_one,
-                               {'_id':portal['wid']})
+        world = yield app.entitycache.get('worlds', portal['wid'])
         if not world:
             return None
         worldname = world.get('name', '???')
         
-        creator = yield motor.Op(app.mongodb.players.find_one,
-                                 {'_id':world['creator']}, {'name':1})
+        creator = yield app.playercache.get(world['creator'])
         if creator:
             creatorname = creator.get('name', '???')
         else:
@@ -630,30 +601,21 @@ def portal_description(app, portal, uid, uidiid=None, location=False, short=Fals
             reqscid = 'global'
             
         if reqscid == 'personal':
-            player = yield motor.Op(app.mongodb.players.find_one,
-                                    {'_id':uid},
-                                    {'scid':1})
-            scope = yield motor.Op(app.mongodb.scopes.find_one,
-                                   {'_id':player['scid']})
+            player = yield app.playercache.get(uid)
+            scope = yield app.entitycache.get('scopes', player['scid'])
         elif reqscid == 'global':
-            config = yield motor.Op(app.mongodb.config.find_one,
-                                    {'key':'globalscopeid'})
-            scope = yield motor.Op(app.mongodb.scopes.find_one,
-                                   {'_id':config['val']})
+            config = yield app.entitycache.get_config('globalscopeid')
+            scope = yield app.entitycache.get('scopes', config['val'])
         elif reqscid == 'same':
             if not uidiid:
                 playstate = yield motor.Op(app.mongodb.playstate.find_one,
                                            {'_id':uid},
                                            {'iid':1})
                 uidiid = playstate['iid']
-            instance = yield motor.Op(app.mongodb.instances.find_one,
-                                       {'_id':uidiid},
-                                       {'scid':1})
-            scope = yield motor.Op(app.mongodb.scopes.find_one,
-                                   {'_id':instance['scid']})
+            instance = yield app.entitycache.get('instances', uidiid)
+            scope = yield app.entitycache.get('scopes', instance['scid'])
         else:
-            scope = yield motor.Op(app.mongodb.scopes.find_one,
-                                   {'_id':reqscid})
+            scope = yield app.entitycache.get('scopes', reqscid)
 
         if scope['type'] == 'glob':
             if short:
@@ -666,9 +628,7 @@ def portal_description(app, portal, uid, uidiid=None, location=False, short=Fals
             else: 
                 scopename = 'Personal instance'
         elif scope['type'] == 'pers':
-            scopeowner = yield motor.Op(app.mongodb.players.find_one,
-                                        {'_id':scope['uid']},
-                                        {'name':1})
+            scopeowner = yield app.playercache.get(scope['uid'])
             if short:
                 scopename = 'personal: %s' % (scopeowner['name'],)
             else: 
@@ -693,8 +653,7 @@ def portal_description(app, portal, uid, uidiid=None, location=False, short=Fals
             res['preferred'] = True
 
         if location:
-            loc = yield motor.Op(app.mongodb.locations.find_one,
-                                 {'_id':portal['locid']})
+            loc = yield app.entitycache.get('locations', portal['locid'])
             if loc:
                 locname = loc.get('name', '???')
             else:
@@ -707,6 +666,76 @@ def portal_description(app, portal, uid, uidiid=None, location=False, short=Fals
         app.log.warning('portal_description failed: %s', ex, exc_info=app.debugstacktraces)
         return None
 
+@tornado.gen.coroutine
+def portal_descriptions(app, portals, uid, uidiid=None, location=False, short=False):
+    """Return a list of portal_description() results (each a JSONable
+    object or None), one for each portal in the list.
+
+    This is faster than calling portal_description() on each portal,
+    because it first loads everything the list refers to -- worlds,
+    creators, scopes, scope owners, locations -- into the entity and
+    player caches, one query per collection. Then the descriptions
+    are put together from memory.
+    """
+    try:
+        wids = set([ portal['wid'] for portal in portals ])
+        worlds = yield app.entitycache.get_many('worlds', wids)
+
+        uids = set([ world['creator'] for world in worlds.values() ])
+        uids.add(uid)
+        players = yield app.playercache.get_many(uids)
+
+        # Work out which scopes the portals lead to. This logic is parallel
+        # to portal_description(), but we only care about the scids.
+        scids = set()
+        for portal in portals:
+            world = worlds.get(portal['wid'], None)
+            if not world:
+                continue
+            reqscid = portal['scid']
+            if world['instancing'] == 'solo':
+                reqscid = 'personal'
+            if world['instancing'] == 'shared':
+                reqscid = 'global'
+            if reqscid == 'personal':
+                player = players.get(uid, None)
+                if player:
+                    scids.add(player['scid'])
+            elif reqscid == 'global':
+                config = yield app.entitycache.get_config('globalscopeid')
+                if config:
+                    scids.add(config['val'])
+            elif reqscid == 'same':
+                if not uidiid:
+                    playstate = yield motor.Op(app.mongodb.playstate.find_one,
+                                               {'_id':uid},
+                                               {'iid':1})
+                    uidiid = playstate['iid']
+                instance = yield app.entitycache.get('instances', uidiid)
+                if instance:
+                    scids.add(instance['scid'])
+            else:
+                scids.add(reqscid)
+        scopes = yield app.entitycache.get_many('scopes', scids)
+
+        uids = set([ scope['uid'] for scope in scopes.values() if scope['type'] == 'pers' ])
+        if uids:
+            yield app.playercache.get_many(uids)
+
+        if location:
+            locids = set([ portal['locid'] for portal in portals ])
+            yield app.entitycache.get_many('locations', locids)
+    except Exception as ex:
+        # Carry on; portal_description() will look things up one at a time
+        # (and report the error, if it recurs).
+        app.log.warning('portal_descriptions prefetch failed: %s', ex, exc_info=app.debugstacktraces)
+
+    res = []
+    for portal in portals:
+        desc = yield portal_description(app, portal, uid, uidiid=uidiid, location=location, short=short)
+        res.append(desc)
+    return res
+
 @tornado.gen.coroutine
 def create_portal_for_player(app, uid, plistid, newwid, newscid, newlocid):
     """Create a new portal in the player's portal list. This does not check
@@ -811,9 +840,7 @@ def render_focus(task, loctx, conn, focusobj):
         restype = focusobj[0]
         
         if restype == 'player':
-            player = yield motor.Op(task.app.mongodb.players.find_one,
-                                    {'_id':focusobj[1]},
-                                    {'name':1, 'desc':1})
+            player = yield task.app.playercache.get(focusobj[1])
             if not player:
                 return ('There is no such person.', False)
             focusdesc = '%s is %s' % (player.get('name', '???'), player.get('desc', '...'))
@@ -914,8 +941,8 @@ def render_focus(task, loctx, conn, focusobj):
                 conn.focusdependencies.add( ('portlist', plistid, loctx.iid) )
             
             subls = []
-            for portal in ls:
-                desc = yield two.execute.portal_description(task.app, portal, conn.uid, uidiid=loctx.iid, short=True)
+            descs = yield two.execute.portal_descriptions(task.app, ls, conn.uid, uidiid=loctx.iid, short=True)
+            for (portal, desc) in zip(ls, descs):
                 if not desc:
                     continue
                 ackey = 'plist' + EvalPropContext.build_action_key()
@@ -951,9 +978,13 @@ def render_focus(task, loctx, conn, focusobj):
     return (focusdesc, ctx.wasspecial)
 
 @tornado.gen.coroutine
-def generate_update(task, conn, dirty):
+def generate_update(task, conn, dirty, others=()):
     """Construct an update message for a player client. This will involve
     recomputing the locale text, focus text, or so on.
+
+    If the player has other connections that need the same update, pass
+    them as others. We render once (for conn) and then copy the message,
+    actions, and dependencies to the others.
     """
     assert conn is not None, 'generate_update: conn is None'
     if not dirty:
@@ -961,43 +992,34 @@ def generate_update(task, conn, dirty):
 
     app = task.app
     uid = conn.uid
-    # Don't go to task.get_loctx for the locale info; we need a few different
-    # bits of data. Plus, maybe the player moved.
+    # The task's loctx cache is cleared whenever a player moves, so this
+    # is up to date.
+    loctx = yield task.get_loctx(uid)
 
     msg = { 'cmd': 'update' }
 
-    playstate = yield motor.Op(app.mongodb.playstate.find_one,
-                               {'_id':uid},
-                               {'iid':1, 'locid':1, 'focus':1})
-    
-    iid = playstate['iid']
+    iid = loctx.iid
     if not iid:
         msg['world'] = {'world':app.localize('label.in_transition'), 'scope':'\u00A0', 'creator':'...'}
         msg['focus'] = False ### probably needs to be something for linking out of the void
         msg['populace'] = False
         msg['locale'] = { 'desc': '...' }
         conn.write(msg)
+        for other in others:
+            other.write(msg)
         return
 
-    instance = yield motor.Op(app.mongodb.instances.find_one,
-                              {'_id':iid})
-    wid = instance['wid']
-    scid = instance['scid']
-    locid = playstate['locid']
-    loctx = two.task.LocContext(uid, wid, scid, iid, locid)
+    wid = loctx.wid
+    scid = loctx.scid
+    locid = loctx.locid
 
     if dirty & DIRTY_WORLD:
-        scope = yield motor.Op(app.mongodb.scopes.find_one,
-                               {'_id':scid})
-        world = yield motor.Op(app.mongodb.worlds.find_one,
-                               {'_id':wid},
-                               {'creator':1, 'name':1})
+        scope = yield app.entitycache.get('scopes', scid)
+        world = yield app.entitycache.get('worlds', wid)
     
         worldname = world['name']
     
-        creator = yield motor.Op(app.mongodb.players.find_one,
-                                 {'_id':world['creator']},
-                                 {'name':1})
+        creator = yield app.playercache.get(world['creator'])
         creatorname = app.localize('label.created_by') % (creator['name'],)
     
         if scope['type'] == 'glob':
@@ -1005,9 +1027,7 @@ def generate_update(task, conn, dirty):
         elif scope['type'] == 'pers' and scope['uid'] == conn.uid:
             scopename = app.localize('label.personal_instance_you_paren')
         elif scope['type'] == 'pers':
-            scopeowner = yield motor.Op(app.mongodb.players.find_one,
-                                        {'_id':scope['uid']},
-                                        {'name':1})
+            scopeowner = yield app.playercache.get(scope['uid'])
             scopename = app.localize('label.personal_instance_paren') % (scopeowner['name'],)
         elif scope['type'] == 'grp':
             scopename = app.localize('label.group_instance_paren') % (scope['group'],)
@@ -1022,7 +1042,7 @@ def generate_update(task, conn, dirty):
 
         ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
         try:
-            localedesc = yield ctx.eval('desc')
+            localedesc = yield app.rendercache.eval(ctx, 'desc')
         except Exception as ex:
             task.log.warning('Exception rendering locale: %s', ex, exc_info=app.debugstacktraces)
             localedesc = '[Exception: %s]' % (str(ex),)
@@ -1031,10 +1051,9 @@ def generate_update(task, conn, dirty):
             conn.localeactions.update(ctx.linktargets)
         if ctx.dependencies:
             conn.localedependencies.update(ctx.dependencies)
+        app.playconns.set_dependencies(conn, DIRTY_LOCALE, conn.localedependencies)
 
-        location = yield motor.Op(app.mongodb.locations.find_one,
-                                  {'_id':locid},
-                                  {'wid':1, 'name':1})
+        location = yield app.entitycache.get('locations', locid)
 
         if not location or location['wid'] != wid:
             locname = '[Location not found]'
@@ -1049,11 +1068,9 @@ def generate_update(task, conn, dirty):
         
         # Build a list of all the other people in the location.
         conn.populacedependencies.add( ('populace', iid, locid) )
-        cursor = app.mongodb.playstate.find({'iid':iid, 'locid':locid},
-                                            {'_id':1, 'lastmoved':1})
+        occupants = yield app.occupancy.occupants(iid, locid)
         people = []
-        while (yield cursor.fetch_next):
-            ostate = cursor.next_object()
+        for ostate in occupants:
             if ostate['_id'] == uid:
                 continue
             if not ostate.get('lastmoved', None):
@@ -1064,12 +1081,13 @@ def generate_update(task, conn, dirty):
             ostate['_ackey'] = ackey
             conn.populaceactions[ackey] = ('player', ostate['_id'])
             conn.populacedependencies.add( ('playstate', ostate['_id'], 'locid') )
-        # cursor autoclose
-        for ostate in people:
-            oplayer = yield motor.Op(app.mongodb.players.find_one,
-                                     {'_id':ostate['_id']},
-                                     {'name':1})
-            ostate['name'] = oplayer.get('name', '???')
+        # Look up all the names at once (probably from the cache).
+        if people:
+            oplayers = yield app.playercache.get_many([ ostate['_id'] for ostate in people ])
+            for ostate in people:
+                oplayer = oplayers.get(ostate['_id'], None)
+                ostate['name'] = oplayer.get('name', '???') if oplayer else '???'
+        app.playconns.set_dependencies(conn, DIRTY_POPULACE, conn.populacedependencies)
 
         if not people:
             populacedesc = False
@@ -1100,18 +1118,48 @@ def generate_update(task, conn, dirty):
         conn.focusdependencies.clear()
 
         try:
+            playstate = yield motor.Op(app.mongodb.playstate.find_one,
+                                       {'_id':uid},
+                                       {'focus':1})
             focusobj = playstate.get('focus', None)
             (focusdesc, focusspecial) = yield render_focus(task, loctx, conn, focusobj)
         except Exception as ex:
             task.log.warning('Exception rendering focus: %s', ex, exc_info=app.debugstacktraces)
             focusdesc = '[Exception: %s]' % (str(ex),)
             focusspecial = False
+        app.playconns.set_dependencies(conn, DIRTY_FOCUS, conn.focusdependencies)
 
         msg['focus'] = focusdesc
         if focusspecial:
             msg['focusspecial'] = True
     
     conn.write(msg)
+    for other in others:
+        copy_update_state(app, conn, other, dirty)
+        other.write(msg)
+
+def copy_update_state(app, conn, other, dirty):
+    """Copy the action maps and dependency sets that generate_update()
+    just built for conn to another connection of the same player. Only
+    the sections covered by dirty are copied. Each connection gets its
+    own copies.
+    """
+    assert conn.uid == other.uid
+    if other.connid is None:
+        # Closed while we were rendering.
+        return
+    if dirty & DIRTY_LOCALE:
+        other.localeactions = dict(conn.localeactions)
+        other.localedependencies = set(conn.localedependencies)
+        app.playconns.set_dependencies(other, DIRTY_LOCALE, other.localedependencies)
+    if dirty & DIRTY_POPULACE:
+        other.populaceactions = dict(conn.populaceactions)
+        other.populacedependencies = set(conn.populacedependencies)
+        app.playconns.set_dependencies(other, DIRTY_POPULACE, other.populacedependencies)
+    if dirty & DIRTY_FOCUS:
+        other.focusactions = dict(conn.focusactions)
+        other.focusdependencies = set(conn.focusdependencies)
+        app.playconns.set_dependencies(other, DIRTY_FOCUS, other.focusdependencies)
     
 
 @tornado.gen.coroutine
@@ -1244,15 +1292,13 @@ def perform_action(task, cmd, conn, target):
             # Check that the portal is accessible.
             yield portal_in_reach(app, portal, uid, loctx.wid)
 
-            world = yield motor.Op(app.mongodb.worlds.find_one,
-                                   {'_id':portal['wid']})
+            world = yield app.entitycache.get('worlds', portal['wid'])
             if not world:
                 raise ErrorMessageException('Destination world not found.')
             newwid = world['_id']
 
-            location = yield motor.Op(app.mongodb.locations.find_one,
-                                      {'_id':portal['locid'], 'wid':newwid})
-            if not location:
+            location = yield app.entitycache.get('locations', portal['locid'])
+            if not location or location['wid'] != newwid:
                 raise ErrorMessageException('Destination location not found.')
             newlocid = location['_id']
 
@@ -1286,15 +1332,13 @@ def perform_action(task, cmd, conn, target):
             # Check that the portal is accessible.
             yield portal_in_reach(app, portal, uid, loctx.wid)
 
-            world = yield motor.Op(app.mongodb.worlds.find_one,
-                                   {'_id':portal['wid']})
+            world = yield app.entitycache.get('worlds', portal['wid'])
             if not world:
                 raise ErrorMessageException('Destination world not found.')
             newwid = world['_id']
 
-            location = yield motor.Op(app.mongodb.locations.find_one,
-                                      {'_id':portal['locid'], 'wid':newwid})
-            if not location:
+            location = yield app.entitycache.get('locations', portal['locid'])
+            if not location or location['wid'] != newwid:
                 raise ErrorMessageException('Destination location not found.')
             newlocid = location['_id']
 
@@ -1319,9 +1363,7 @@ def perform_action(task, cmd, conn, target):
                 task.write_event(uid, app.localize('message.instance_no_access')) # 'You do not have access to this instance.'
                 return
         
-            res = yield motor.Op(app.mongodb.players.find_one,
-                                 {'_id':uid},
-                                 {'name':1})
+            res = yield app.playercache.get(uid)
             playername = res['name']
         
             # If the location has an on_leave property, run it.
@@ -1337,7 +1379,7 @@ def perform_action(task, cmd, conn, target):
                                  '_to':None }
                     else:
                         args = { '_from':None, '_to':None }
-                    yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args)
+                    yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, symbol='on_leave', locals=args)
                 except Exception as ex:
                     task.log.warning('Caught exception (leaving loc, linkout): %s', ex, exc_info=app.debugstacktraces)
                 ctx = None
@@ -1359,6 +1401,7 @@ def perform_action(task, cmd, conn, target):
                                     'lastmoved': task.starttime,
                                     'lastlocid': None,
                                     'portto':portto }})
+            app.occupancy.set_location(uid, None, None)
             task.set_dirty(uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_WORLD | DIRTY_POPULACE)
             task.set_data_change( ('playstate', uid, 'iid') )
             task.set_data_change( ('playstate', uid, 'locid') )
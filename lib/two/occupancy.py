@@ -0,0 +1,166 @@
+"""
+Occupancy index: keeps track of which players are in which locations.
+
+tworld is the only process that changes a player's playstate iid and locid
+(tweb only creates playstates, in the void). So we can keep an in-memory
+copy of that information and answer "who is here?" without asking the
+database. Every place that moves a player -- perform_move, portin, tovoid,
+the move-to-void in perform_action -- must call set_location() after
+updating playstate. The whole index is rebuilt from the database on
+dbconnected.
+
+Until the first rebuild completes, the lookup methods fall back to
+querying the database. That's why they're coroutines.
+"""
+
+import tornado.gen
+import motor
+
+class OccupancyIndex(object):
+    """OccupancyIndex maps locations to the players in them. Only players
+    who are in an instance are tracked; players in the void aren't.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.log = self.app.log
+
+        # False until rebuild() has run; until then, we query the db.
+        self.loaded = False
+
+        self.uidmap = {}  # maps uids to (iid, locid, lastmoved)
+        self.locmap = {}  # maps (iid, locid) to sets of uids
+        self.instmap = {}  # maps iids to sets of uids
+
+    def __repr__(self):
+        return '<OccupancyIndex: %d players, %d locations, %d instances>' % (len(self.uidmap), len(self.locmap), len(self.instmap))
+
+    @tornado.gen.coroutine
+    def rebuild(self):
+        """Load the index from the playstate collection.
+        """
+        uidmap = {}
+        cursor = self.app.mongodb.playstate.find({'iid':{'$ne':None}},
+                                                 {'_id':1, 'iid':1, 'locid':1, 'lastmoved':1})
+        while (yield cursor.fetch_next):
+            playstate = cursor.next_object()
+            if not playstate['iid']:
+                continue
+            uidmap[playstate['_id']] = (playstate['iid'], playstate.get('locid', None), playstate.get('lastmoved', None))
+        # cursor autoclose
+
+        self.uidmap = {}
+        self.locmap = {}
+        self.instmap = {}
+        for (uid, (iid, locid, lastmoved)) in uidmap.items():
+            self.set_location(uid, iid, locid, lastmoved)
+        self.loaded = True
+        self.log.info('Occupancy index loaded: %d players in the world', len(self.uidmap))
+
+    def set_location(self, uid, iid, locid, lastmoved=None):
+        """Record that a player has moved. An iid of None means the void.
+        """
+        old = self.uidmap.pop(uid, None)
+        if old is not None:
+            (oldiid, oldlocid, dummy) = old
+            uset = self.locmap.get((oldiid, oldlocid), None)
+            if uset is not None:
+                uset.discard(uid)
+                if not uset:
+                    del self.locmap[(oldiid, oldlocid)]
+            uset = self.instmap.get(oldiid, None)
+            if uset is not None:
+                uset.discard(uid)
+                if not uset:
+                    del self.instmap[oldiid]
+        if not iid:
+            return
+        self.uidmap[uid] = (iid, locid, lastmoved)
+        self.locmap.setdefault((iid, locid), set()).add(uid)
+        self.instmap.setdefault(iid, set()).add(uid)
+
+    @tornado.gen.coroutine
+    def location_of(self, uid):
+        """Return (iid, locid) for the given player, or None if the player
+        is in the void (or doesn't exist).
+        """
+        if self.loaded:
+            res = self.uidmap.get(uid, None)
+            if res is None:
+                return None
+            return res[0:2]
+        playstate = yield motor.Op(self.app.mongodb.playstate.find_one,
+                                   {'_id':uid},
+                                   {'iid':1, 'locid':1})
+        if not playstate or not playstate['iid']:
+            return None
+        return (playstate['iid'], playstate['locid'])
+
+    @tornado.gen.coroutine
+    def occupants(self, iid, locid=None):
+        """Return a list of playstate-like dicts ('_id' and 'lastmoved')
+        for the players in a location. If locid is None, all the players
+        in the instance. The lastmoved values may be None.
+        """
+        if self.loaded:
+            if locid:
+                uset = self.locmap.get((iid, locid), ())
+            else:
+                uset = self.instmap.get(iid, ())
+            return [ {'_id':uid, 'lastmoved':self.uidmap[uid][2]} for uid in uset ]
+        if locid:
+            query = {'iid':iid, 'locid':locid}
+        else:
+            query = {'iid':iid}
+        cursor = self.app.mongodb.playstate.find(query,
+                                                 {'_id':1, 'lastmoved':1})
+        res = []
+        while (yield cursor.fetch_next):
+            ostate = cursor.next_object()
+            res.append( {'_id':ostate['_id'], 'lastmoved':ostate.get('lastmoved', None)} )
+        # cursor autoclose
+        return res
+
+    @tornado.gen.coroutine
+    def players_at(self, iid, locid=None):
+        """Return a list of uids of players in a location. If locid is None,
+        all the players in the instance.
+        """
+        if self.loaded:
+            if locid:
+                return list(self.locmap.get((iid, locid), ()))
+            else:
+                return list(self.instmap.get(iid, ()))
+        ls = yield self.occupants(iid, locid)
+        return [ ostate['_id'] for ostate in ls ]
+
+    @tornado.gen.coroutine
+    def players_in_world(self):
+        """Return a list of uids of all players who are in an instance.
+        """
+        if self.loaded:
+            return list(self.uidmap.keys())
+        cursor = self.app.mongodb.playstate.find({'iid':{'$ne':None}},
+                                                 {'_id':1})
+        res = []
+        while (yield cursor.fetch_next):
+            playstate = cursor.next_object()
+            res.append(playstate['_id'])
+        # cursor autoclose
+        return res
+
+    @tornado.gen.coroutine
+    def inhabited_instances(self):
+        """Return a set of iids of instances that have players in them.
+        """
+        if self.loaded:
+            return set(self.instmap.keys())
+        cursor = self.app.mongodb.playstate.find({'iid':{'$ne':None}},
+                                                 {'_id':1, 'iid':1})
+        res = set()
+        while (yield cursor.fetch_next):
+            playstate = cursor.next_object()
+            if playstate['iid']:
+                res.add(playstate['iid'])
+        # cursor autoclose
+        return res
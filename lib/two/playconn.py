@@ -29,6 +29,12 @@ class PlayerConnectionTable(object):
 
         self.uidmap = {} # maps uids (ObjectIds) to sets of PlayerConnections.
 
+        # Reverse dependency index: maps change keys to dicts, which map
+        # PlayerConnections to the dirty bits that the key affects. This
+        # lets a task find the affected connections for a changeset without
+        # checking every connection.
+        self.depindex = {}
+
     def get(self, connid):
         """Look up a player connection by its ID. Returns None if not found.
         """
@@ -86,8 +92,58 @@ class PlayerConnectionTable(object):
             uset.remove(conn)
             if not uset:
                 del self.uidmap[conn.uid]
+        for dirtybit in list(conn.indexeddeps.keys()):
+            self.set_dependencies(conn, dirtybit, ())
         conn.close()
 
+    def set_dependencies(self, conn, dirtybit, deps):
+        """Record that the given connection's dirtybit section (locale,
+        focus, etc) depends on the given change keys, replacing whatever
+        was recorded for that section before. This should be called
+        whenever one of the connection's dependency sets is rebuilt.
+        """
+        if conn.connid is None:
+            # Connection was closed while it was being updated.
+            return
+        olddeps = conn.indexeddeps.get(dirtybit, ())
+        newdeps = frozenset(deps)
+        for key in olddeps:
+            if key in newdeps:
+                continue
+            connmap = self.depindex.get(key, None)
+            if connmap is None:
+                continue
+            bits = connmap.get(conn, 0) & ~dirtybit
+            if bits:
+                connmap[conn] = bits
+            else:
+                connmap.pop(conn, None)
+                if not connmap:
+                    del self.depindex[key]
+        for key in newdeps:
+            connmap = self.depindex.get(key, None)
+            if connmap is None:
+                connmap = {}
+                self.depindex[key] = connmap
+            connmap[conn] = connmap.get(conn, 0) | dirtybit
+        if newdeps:
+            conn.indexeddeps[dirtybit] = newdeps
+        else:
+            conn.indexeddeps.pop(dirtybit, None)
+
+    def dirty_for_changes(self, changeset):
+        """Given a set of change keys, return a dict mapping connids to
+        the dirty bits that the changes imply.
+        """
+        res = {}
+        for key in changeset:
+            connmap = self.depindex.get(key, None)
+            if not connmap:
+                continue
+            for (conn, bits) in connmap.items():
+                res[conn.connid] = res.get(conn.connid, 0) | bits
+        return res
+
     def dumplog(self):
         self.log.debug('PlayerConnectionTable has %d entries', len(self.map))
         for (connid, conn) in sorted(self.map.items()):
@@ -98,6 +154,7 @@ class PlayerConnectionTable(object):
             self.log.debug('ERROR: empty set in uidmap!')
         if uidsum != len(self.map):
             self.log.debug('ERROR: uidmap has %d entries!', uidsum)
+        self.log.debug(' dependency index has %d keys', len(self.depindex))
 
 class PlayerConnection(object):
     """PlayerConnection represents one connected player.
@@ -131,6 +188,10 @@ class PlayerConnection(object):
         self.focusdependencies = set()
         self.populacedependencies = set()
 
+        # What the table's dependency index currently has for this
+        # connection: maps dirty bits to frozensets of change keys.
+        self.indexeddeps = {}
+
         # Only used by the /eval command.
         self.debuglocals = {}
 
@@ -152,6 +213,7 @@ class PlayerConnection(object):
         self.localedependencies = None
         self.focusdependencies = None
         self.populacedependencies = None
+        self.indexeddeps = None
         
     def write(self, msg):
         """Shortcut to send a message to a player via this connection.
@@ -0,0 +1,96 @@
+"""
+Player info cache: keeps players' display fields (name, pronoun, desc)
+in memory, along with their personal scope (scid) and permission flags
+(admin, build).
+
+These are looked up constantly -- every populace list, every [$name] or
+[$we] in a description, every creator command -- and they almost never
+change. The name is fixed when the player is created (as is the scid);
+the pronoun and desc change only through the "selfdesc" command, which
+calls invalidate(). The flags change through tweb's admin page (and the
+build flag through the ask-for-build page), which send a
+notifyentitychange command.
+
+Cached records are shared among all callers, so they must not be modified.
+"""
+
+import tornado.gen
+import motor
+
+import twcommon.misc
+
+# The fields we cache.
+PLAYER_FIELDS = {'name':1, 'pronoun':1, 'desc':1, 'scid':1, 'admin':1, 'build':1}
+
+class PlayerCache(object):
+    """PlayerCache maps uids to player records (dicts containing '_id' and
+    the PLAYER_FIELDS). It's bounded; the least-recently-used records are
+    dropped when it fills up.
+
+    Players that don't exist are not cached.
+    """
+    MAX_ENTRIES = 10000
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = twcommon.misc.LRUCache(self.MAX_ENTRIES, name='PlayerCache')
+        # Bumped on every invalidation. A fetch that started before an
+        # invalidation doesn't store its (possibly stale) result.
+        self.generation = 0
+
+    def __repr__(self):
+        return '<PlayerCache: %d entries; %d hits, %d misses>' % (len(self.cache), self.cache.hits, self.cache.misses)
+
+    @tornado.gen.coroutine
+    def get(self, uid):
+        """Return the record for the given uid, or None if there's no
+        such player.
+        """
+        res = self.cache.get(uid)
+        if res is not None:
+            return res
+        generation = self.generation
+        res = yield motor.Op(self.app.mongodb.players.find_one,
+                             {'_id':uid},
+                             PLAYER_FIELDS)
+        if res is not None and generation == self.generation:
+            self.cache.set(uid, res)
+        return res
+
+    @tornado.gen.coroutine
+    def get_many(self, uids):
+        """Return a dict mapping uids to records, for all of the given
+        uids that exist. The cache misses are fetched with one query.
+        """
+        res = {}
+        misses = []
+        for uid in uids:
+            player = self.cache.get(uid)
+            if player is not None:
+                res[uid] = player
+            else:
+                misses.append(uid)
+        if not misses:
+            return res
+
+        generation = self.generation
+        cursor = self.app.mongodb.players.find({'_id':{'$in':misses}},
+                                               PLAYER_FIELDS)
+        while (yield cursor.fetch_next):
+            player = cursor.next_object()
+            res[player['_id']] = player
+            if generation == self.generation:
+                self.cache.set(player['_id'], player)
+        # cursor autoclose
+        return res
+
+    def invalidate(self, uid):
+        """Drop the given player's record. Call this after changing the
+        player's name, pronoun, or desc.
+        """
+        self.generation += 1
+        self.cache.discard(uid)
+
+    def clear(self):
+        self.generation += 1
+        self.cache.clear()
@@ -0,0 +1,213 @@
+"""
+Script profiler: keeps running totals of how much work each symbol costs,
+so that a world's creator can find the hot spots without reading all of
+the world's source.
+
+Profiling is off by default. It can be turned on for one world (with the
+"/profile on" command) or for every world (the script_profile option).
+When it's on, every EvalPropContext.evalobj() of a symbol adds one call
+to that symbol's entry, along with the ticks and wall-clock time it took
+and the property lookups it made. Hooks (on_enter, etc) are counted
+under their own names. An [[interpolation]] of code, which has no symbol,
+gets an entry under its source text -- unless it's a pure expression
+that evalcode_sync() handles, which is too cheap to be worth profiling.
+
+The totals are cumulative, like cProfile's "cumtime": if "desc" calls
+"lamp", the cost of "lamp" is counted in both entries. They're also a bit
+approximate, since evaluations in the same task can interleave.
+
+Property lookups are counted by PropCache, which finds the current
+context through EvalPropContext.current_context. A lookup that the cache
+answers without a database query is a hit; the queries themselves are
+counted as fetches.
+"""
+
+import time
+import json
+
+class ProfileCounter(object):
+    """Property-lookup totals for one top-level EvalPropContext (and all
+    of its sub-contexts, which share it).
+    """
+    def __init__(self):
+        self.lookups = 0
+        self.hits = 0
+        self.fetches = 0
+
+class ProfileEntry(object):
+    """The totals for one symbol in one world.
+    """
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.calls = 0
+        self.ticks = 0
+        self.walltime = 0.0
+        self.lookups = 0
+        self.hits = 0
+        self.fetches = 0
+
+    def hitrate(self):
+        """The fraction of property lookups that didn't go to the database,
+        or None if there weren't any.
+        """
+        if not self.lookups:
+            return None
+        return self.hits / self.lookups
+
+    def describe(self):
+        hitrate = self.hitrate()
+        if hitrate is None:
+            hitval = '-'
+        else:
+            hitval = '%d%%' % (round(hitrate * 100),)
+        return '%s: %d calls, %d ticks, %.3f ms, %d fetches, %s hits' % (
+            self.symbol, self.calls, self.ticks, self.walltime * 1000,
+            self.fetches, hitval)
+
+    def to_json(self):
+        return {
+            'symbol': self.symbol,
+            'calls': self.calls,
+            'ticks': self.ticks,
+            'walltime': self.walltime,
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'fetches': self.fetches,
+            'hitrate': self.hitrate(),
+            }
+
+class ScriptProfiler(object):
+    """ScriptProfiler maps wids to dicts of ProfileEntry objects (keyed by
+    symbol).
+    """
+    # A world with more distinct symbols than this (probably because
+    # somebody is /eval-ing lots of different code) lumps the rest together.
+    MAX_SYMBOLS = 2000
+    OTHER_SYMBOL = '(other)'
+    # Interpolation labels are cut down to this length.
+    MAX_LABEL = 60
+
+    def __init__(self, app, allworlds=False):
+        self.app = app
+        # If true, every world is profiled.
+        self.allworlds = allworlds
+        # Worlds that have been turned on individually.
+        self.activewids = set()
+        self.worlds = {}
+
+    def __repr__(self):
+        return '<ScriptProfiler: %d worlds, %d active>' % (len(self.worlds), len(self.activewids))
+
+    def is_active(self, wid):
+        if wid is None:
+            return False
+        return self.allworlds or (wid in self.activewids)
+
+    def activate(self, wid, flag=True):
+        if flag:
+            self.activewids.add(wid)
+        else:
+            self.activewids.discard(wid)
+
+    def new_counter(self, wid):
+        """Return a ProfileCounter for a new top-level context in the given
+        world, or None if that world isn't being profiled.
+        """
+        if not self.is_active(wid):
+            return None
+        return ProfileCounter()
+
+    @staticmethod
+    def label_for(key, symbol):
+        """Decide what a profiled evalobj() call counts as. The caller has
+        already worked out the symbol, if there is one; otherwise the key
+        is a code snippet.
+        """
+        if symbol is not None:
+            return symbol
+        label = ' '.join(key.split())
+        if len(label) > ScriptProfiler.MAX_LABEL:
+            label = label[ : ScriptProfiler.MAX_LABEL-3 ] + '...'
+        return '[[' + label + ']]'
+
+    def start(self, ctx):
+        """Take a snapshot of the context's counters, to be handed back to
+        finish() when the evaluation is done.
+        """
+        counter = ctx.profcounter
+        return (ctx.task.cputicks, time.monotonic(),
+                counter.lookups, counter.hits, counter.fetches)
+
+    def finish(self, ctx, label, mark):
+        """Add the difference between the context's counters and the
+        snapshot to the label's entry.
+        """
+        (ticks, walltime, lookups, hits, fetches) = mark
+        table = self.worlds.get(ctx.loctx.wid, None)
+        if table is None:
+            table = {}
+            self.worlds[ctx.loctx.wid] = table
+        ent = table.get(label, None)
+        if ent is None:
+            if len(table) >= self.MAX_SYMBOLS:
+                label = self.OTHER_SYMBOL
+                ent = table.get(label, None)
+            if ent is None:
+                ent = ProfileEntry(label)
+                table[label] = ent
+        counter = ctx.profcounter
+        ent.calls += 1
+        # A phase boundary would reset the task's ticks, but evalobj()
+        # never spans one; so this should never go negative.
+        ent.ticks += max(0, ctx.task.cputicks - ticks)
+        ent.walltime += (time.monotonic() - walltime)
+        ent.lookups += (counter.lookups - lookups)
+        ent.hits += (counter.hits - hits)
+        ent.fetches += (counter.fetches - fetches)
+
+    def entries(self, wid, sortkey='ticks'):
+        """Return a list of the given world's entries, most expensive first.
+        """
+        table = self.worlds.get(wid, None)
+        if not table:
+            return []
+        ls = list(table.values())
+        ls.sort(key=lambda ent: (getattr(ent, sortkey), ent.calls), reverse=True)
+        return ls
+
+    def dump_json(self, wid):
+        """Return the given world's entries as a JSON string.
+        """
+        ls = [ ent.to_json() for ent in self.entries(wid) ]
+        return json.dumps({'wid':str(wid), 'entries':ls}, indent=1)
+
+    def clear(self, wid=None):
+        """Throw away the totals for one world, or for all of them.
+        """
+        if wid is None:
+            self.worlds.clear()
+        else:
+            self.worlds.pop(wid, None)
+
+def note_lookup(hit):
+    """Called by PropCache for every get() or get_first(). If a profiled
+    context is running, the lookup counts against it.
+    """
+    ctx = EvalPropContext.current_context.get()
+    if ctx is None or ctx.profcounter is None:
+        return
+    counter = ctx.profcounter
+    counter.lookups += 1
+    if hit:
+        counter.hits += 1
+
+def note_fetch(ctx):
+    """Called by PropCache for every database query it makes while the
+    given context is running.
+    """
+    if ctx.profcounter is not None:
+        ctx.profcounter.fetches += 1
+
+
+# Late imports, to avoid circularity
+from two.evalctx import EvalPropContext
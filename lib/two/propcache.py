@@ -8,18 +8,29 @@ When a property is changed or deleted, we add a cache entry with the dirty
 flag. At the end of the task, we call write_all_dirty() to resolve these
 back to the database (update or delete).
 
-This also tracks mutable values. If a list or dict changes, write_all_dirty()
-detects that too and does an update.
-
-Currently, this lives in the app, but its lifespan is just the duration of one
-task. A future version may hang around longer.
+This also tracks mutable values. A list or dict read from the database is
+converted to a TrackedList or TrackedDict, which flags its entry as changed
+when anything mutates it (at any depth). write_all_dirty() sees that flag
+and does an update.
+
+Each task has its own PropCache, whose lifespan is just the duration of
+the task. Underneath those sits one SharedPropCache, which lives as long as
+the app. It holds only the collections that tworld never writes ('worldprop'
+and 'wplayerprop'). tweb sends a notifydatachange for each build edit;
+changes made behind tweb's back (twloadworld, twsetup) show up when the
+shared entries expire.
 
 ### Future version should also do work in write_all_dirty() to break apart
 ### objmap sets larger than 1. Deepcopy all values, so that there's no
 ### id sharing any more.
 """
 
+import sys
+import time
+import collections
+
 import tornado.gen
+import tornado.concurrent
 from bson.objectid import ObjectId
 import motor
 
@@ -27,11 +38,49 @@ import motor
 # which may only be updated by build code.)
 writable_collections = set(['instanceprop', 'iplayerprop'])
 
+# The identifying fields of each property collection. A property tuple
+# (db, id1, id2, key) means the query {field1:id1, field2:id2, 'key':key}.
+collection_fields = {
+    'worldprop': ('wid', 'locid'),
+    'instanceprop': ('iid', 'locid'),
+    'wplayerprop': ('wid', 'uid'),
+    'iplayerprop': ('iid', 'uid'),
+    }
+
+# Collections whose location and realm scopes are loaded all at once,
+# when scopeprefetch is on.
+scope_collections = set(['worldprop', 'instanceprop'])
+
+# Collections that the SharedPropCache holds. These are exactly the
+# ones that code may *not* update.
+shared_collections = set(['worldprop', 'wplayerprop'])
+
+def scopes_for_tuple(tup):
+    """Return the scopes which should be loaded when looking up this
+    tuple: its own location, and the realm level.
+    """
+    scope = tup[0:3]
+    if tup[2] is None:
+        return [ scope ]
+    return [ scope, (tup[0], tup[1], None) ]
+
 class PropCache:
+    # How many write-backs to have in flight at once.
+    WRITE_CONCURRENCY = 16
+    
     def __init__(self, app):
         # Keep a link to the owning application.
         self.app = app
         self.log = self.app.log
+        # The long-lived cache underneath us, if the app has one.
+        self.shared = getattr(app, 'sharedpropcache', None)
+
+        # If scopeprefetch is set, the first lookup in a location (or
+        # realm) loads every property there. loadedscopes contains the
+        # (db, id1, id2) scopes we've done that for.
+        self.scopeprefetch = True
+        self.loadedscopes = set()
+        self.loadingscopes = {}  # maps scope to Future, while loading
 
         self.propmap = {}  # maps tuple to PropEntry
         self.objmap = {}  # maps id(val) to set of PropEntry
@@ -53,9 +102,11 @@ class PropCache:
         # PropCache someday and that would be a ref cycle.
         self.objmap.clear()
         self.propmap.clear()
+        self.loadedscopes.clear()
 
         # Shut down.
         self.app = None
+        self.shared = None
         self.objmap = None
         self.propmap = None
 
@@ -73,15 +124,24 @@ class PropCache:
     @staticmethod
     def query_for_tuple(tup):
         (db, id1, id2, key) = tup
-        if db == 'worldprop':
-            return {'wid':id1, 'locid':id2, 'key':key}
-        if db == 'instanceprop':
-            return {'iid':id1, 'locid':id2, 'key':key}
-        if db == 'wplayerprop':
-            return {'wid':id1, 'uid':id2, 'key':key}
-        if db == 'iplayerprop':
-            return {'iid':id1, 'uid':id2, 'key':key}
-        raise Exception('Unknown collection: %s' % (db,))
+        fields = collection_fields.get(db, None)
+        if fields is None:
+            raise Exception('Unknown collection: %s' % (db,))
+        (field1, field2) = fields
+        return {field1:id1, field2:id2, 'key':key}
+
+    def add_entry(self, ent):
+        """Put a freshly-read entry into the maps. (Not for dirty entries;
+        see set() and delete() for those.)
+        """
+        self.propmap[ent.tup] = ent
+        if ent.mutable:
+            assert ent.found
+            oset = self.objmap.get(ent.id, None)
+            if oset is None:
+                self.objmap[ent.id] = set((ent,))
+            else:
+                oset.add(ent)
 
     @tornado.gen.coroutine
     def get(self, tup, dependencies=None):
@@ -104,36 +164,260 @@ class PropCache:
             
         ent = self.propmap.get(tup, None)
         if ent is not None:
+            two.profiler.note_lookup(True)
             if not ent.found:
                 # Cached "not found" value
                 return None
             return ent
 
         dbname = tup[0]
-        query = PropCache.query_for_tuple(tup)
-        res = yield motor.Op(self.app.mongodb[dbname].find_one,
-                             query,
-                             {'val':1})
-        if not res:
-            ent = PropEntry(None, tup, query, found=False)
-        else:
-            val = res['val']
-            ent = PropEntry(val, tup, query, found=True)
-            
-        self.propmap[tup] = ent
-        if ent.mutable:
-            assert ent.found
-            oset = self.objmap.get(ent.id, None)
-            if oset is None:
-                self.objmap[ent.id] = set((ent,))
+        missed = False
+        if self.scopeprefetch and dbname in scope_collections:
+            missed = yield self.load_scopes(scopes_for_tuple(tup))
+
+        ent = self.cached_entry(tup)
+        if ent is None:
+            missed = True
+            self.charge_fetch()
+            query = PropCache.query_for_tuple(tup)
+            shared = None
+            if self.shared is not None and dbname in shared_collections:
+                shared = self.shared
+                generation = shared.generation
+            res = yield motor.Op(self.app.mongodb[dbname].find_one,
+                                 query,
+                                 {'val':1})
+            if not res:
+                ent = PropEntry(None, tup, query, found=False)
             else:
-                oset.add(ent)
+                val = res['val']
+                ent = PropEntry(val, tup, query, found=True)
+            if shared is not None:
+                shared.store(tup, ent.found, ent.val, generation)
+            self.add_entry(ent)
+        two.profiler.note_lookup(not missed)
 
         if not ent.found:
             # Cached "not found" value
             return None
         return ent
 
+    def charge_fetch(self):
+        """Called before every database query. If script code is running
+        (and so, presumably, asked for this), the query costs its task
+        TICK_COST_FETCH ticks. It's also noted for the profiler.
+        """
+        ctx = EvalPropContext.current_context.get()
+        if ctx is None:
+            return
+        ctx.task.tick(ctx.task.TICK_COST_FETCH)
+        two.profiler.note_fetch(ctx)
+
+    def cached_entry(self, tup):
+        """Find a tuple without touching the database, if we can. That
+        means it's in the propmap, or it's in a scope we've loaded, or it's
+        in the shared cache. In the latter two cases, this adds it to the
+        propmap. Returns a PropEntry (perhaps a not-found one) or None if
+        we'll have to ask the database.
+        """
+        ent = self.propmap.get(tup, None)
+        if ent is not None:
+            return ent
+        
+        scope = tup[0:3]
+        if scope in self.loadedscopes:
+            # We loaded the whole scope, and this key wasn't in it.
+            ent = PropEntry(None, tup, PropCache.query_for_tuple(tup), found=False)
+            self.add_entry(ent)
+            return ent
+
+        if self.shared is not None and tup[0] in shared_collections:
+            if self.shared.has(tup):
+                # PropEntry converts a mutable value to tracked containers,
+                # which copies it; so we can take the shared cache's
+                # value without an extra copy.
+                (found, val) = self.shared.get(tup, copy=False)
+                ent = PropEntry(val, tup, PropCache.query_for_tuple(tup), found=found)
+                self.add_entry(ent)
+                return ent
+
+        return None
+
+    def scope_is_loaded(self, scope):
+        if scope in self.loadedscopes:
+            return True
+        if self.shared is not None and scope[0] in shared_collections:
+            return self.shared.is_full_scope(scope)
+        return False
+    
+    @tornado.gen.coroutine
+    def load_scopes(self, scopes):
+        """Load every property in each of the given scopes (unless we've
+        already done it). A scope is (db, id1, id2) -- a property tuple
+        without the key. The loads run concurrently.
+
+        Returns true if we had to wait for the database.
+        """
+        ls = [ self.load_scope(scope) for scope in scopes
+               if not self.scope_is_loaded(scope) ]
+        if not ls:
+            return False
+        if len(ls) == 1:
+            yield ls[0]
+        else:
+            yield ls
+        return True
+
+    @tornado.gen.coroutine
+    def load_scope(self, scope):
+        """Load every property in one scope, with one query. After this,
+        any key in the scope that we didn't see is known to be absent.
+        """
+        if scope in self.loadingscopes:
+            # Somebody else in this task is already on it.
+            yield self.loadingscopes[scope]
+            return
+        (dbname, id1, id2) = scope
+        (field1, field2) = collection_fields[dbname]
+        
+        shared = None
+        if self.shared is not None and dbname in shared_collections:
+            shared = self.shared
+            generation = shared.generation
+
+        future = tornado.concurrent.Future()
+        self.loadingscopes[scope] = future
+        try:
+            self.charge_fetch()
+            rows = {}
+            cursor = self.app.mongodb[dbname].find({field1:id1, field2:id2},
+                                                   {'key':1, 'val':1})
+            while (yield cursor.fetch_next):
+                res = cursor.next_object()
+                if res['key'] not in rows:
+                    rows[res['key']] = res['val']
+            # cursor autoclose
+        finally:
+            del self.loadingscopes[scope]
+            future.set_result(None)
+
+        for (key, val) in rows.items():
+            tup = (dbname, id1, id2, key)
+            if tup not in self.propmap:
+                self.add_entry(PropEntry(val, tup, PropCache.query_for_tuple(tup), found=True))
+        self.loadedscopes.add(scope)
+        if shared is not None:
+            shared.store_scope(scope, rows, generation)
+
+    @tornado.gen.coroutine
+    def get_first(self, tups, dependencies=None):
+        """Look up a list of tuples, and return the PropEntry for the first
+        one that exists (or None if none do). This is the symbol-lookup
+        pattern: instance property, then world property, and so on.
+
+        The result is the same as calling get() on each tuple in turn and
+        stopping at the first hit -- including what's added to the
+        dependencies set. But the database reads happen all at once;
+        see prefetch().
+        """
+        missed = yield self.prefetch(tups)
+        two.profiler.note_lookup(not missed)
+        for tup in tups:
+            if dependencies is not None:
+                dependencies.add(tup)
+            ent = self.propmap.get(tup, None)
+            if ent is None:
+                # Shouldn't happen, but get() will sort it out.
+                ent = yield self.get(tup)
+                if ent:
+                    return ent
+                continue
+            if ent.found:
+                return ent
+        return None
+
+    @tornado.gen.coroutine
+    def prefetch(self, tups):
+        """Make sure that all the given tuples are in the cache (possibly
+        as "not found" entries). Tuples that differ only in the third
+        element (locid or uid) are fetched with a single query; the
+        queries for different collections run concurrently.
+
+        Returns true if we had to wait for the database.
+        """
+        missed = False
+        if self.scopeprefetch:
+            scopes = []
+            for tup in tups:
+                if tup[0] in scope_collections and tup not in self.propmap:
+                    for scope in scopes_for_tuple(tup):
+                        if scope not in scopes:
+                            scopes.append(scope)
+            if scopes:
+                missed = yield self.load_scopes(scopes)
+        
+        groups = collections.OrderedDict()
+        for tup in tups:
+            if self.cached_entry(tup) is not None:
+                continue
+            (dbname, id1, id2, key) = tup
+            groupkey = (dbname, id1, key)
+            ls = groups.get(groupkey, None)
+            if ls is None:
+                groups[groupkey] = [ id2 ]
+            elif id2 not in ls:
+                ls.append(id2)
+
+        if not groups:
+            return missed
+        ls = [ self.fetch_group(dbname, id1, key, id2s)
+               for ((dbname, id1, key), id2s) in groups.items() ]
+        if len(ls) == 1:
+            yield ls[0]
+        else:
+            yield ls
+        return True
+
+    @tornado.gen.coroutine
+    def fetch_group(self, dbname, id1, key, id2s):
+        """Read a group of tuples (dbname, id1, id2, key), for each id2 in
+        the id2s list, with one database query. Every tuple winds up in the
+        cache.
+        """
+        (field1, field2) = collection_fields[dbname]
+        if len(id2s) == 1:
+            query = {field1:id1, field2:id2s[0], 'key':key}
+        else:
+            query = {field1:id1, field2:{'$in':id2s}, 'key':key}
+
+        shared = None
+        if self.shared is not None and dbname in shared_collections:
+            shared = self.shared
+            generation = shared.generation
+            
+        self.charge_fetch()
+        foundmap = {}
+        cursor = self.app.mongodb[dbname].find(query, {'val':1, field2:1})
+        while (yield cursor.fetch_next):
+            res = cursor.next_object()
+            id2 = res.get(field2, None)
+            if id2 not in foundmap:
+                foundmap[id2] = res['val']
+        # cursor autoclose
+
+        for id2 in id2s:
+            tup = (dbname, id1, id2, key)
+            if tup in self.propmap:
+                # Somebody got here while we were waiting.
+                continue
+            if id2 in foundmap:
+                ent = PropEntry(foundmap[id2], tup, PropCache.query_for_tuple(tup), found=True)
+            else:
+                ent = PropEntry(None, tup, PropCache.query_for_tuple(tup), found=False)
+            if shared is not None:
+                shared.store(tup, ent.found, ent.val, generation)
+            self.add_entry(ent)
+
     @tornado.gen.coroutine
     def set(self, tup, val):
         """Set a new (dirty) object in the cache. If we had an object cached
@@ -209,9 +493,67 @@ class PropCache:
 
     @tornado.gen.coroutine
     def write_all_dirty(self):
+        """Write back every dirty entry. Deletes are grouped into one
+        remove per collection; updates (which are upserts, and can't be
+        combined in this version of pymongo) are sent concurrently, a
+        batch at a time. Nothing here depends on the order of the writes;
+        every entry is a different document.
+
+        A failed write is logged, and its entry stays dirty. (So final()
+        will complain about it, too.) The other writes go ahead.
+        """
         ls = self.dirty_entries()
+        if not ls:
+            return
+        
+        # Each job is (func, args). We don't call the coroutines until
+        # their batch comes up, because calling one starts it.
+        jobs = []
+        deletes = collections.OrderedDict()  # maps dbname to list
         for ent in ls:
+            if ent.dbname not in writable_collections:
+                yield self.resolve_dirty(ent)
+            elif ent.found:
+                jobs.append( (self.resolve_dirty_logged, (ent,)) )
+            else:
+                if ent.dbname not in deletes:
+                    deletes[ent.dbname] = []
+                deletes[ent.dbname].append(ent)
+
+        for (dbname, ents) in deletes.items():
+            jobs.append( (self.resolve_deletes, (dbname, ents)) )
+
+        for ix in range(0, len(jobs), self.WRITE_CONCURRENCY):
+            yield [ func(*args) for (func, args) in jobs[ix:ix+self.WRITE_CONCURRENCY] ]
+
+    @tornado.gen.coroutine
+    def resolve_dirty_logged(self, ent):
+        """Call resolve_dirty(), logging rather than raising exceptions.
+        """
+        try:
             yield self.resolve_dirty(ent)
+        except Exception as ex:
+            self.log.error('propcache: unable to write back %s: %s', ent.tup, ex)
+
+    @tornado.gen.coroutine
+    def resolve_deletes(self, dbname, ents):
+        """Resolve a list of delete entries in one collection, with a
+        single remove. If that fails, fall back to deleting them one by
+        one, so that we can say which entries failed.
+        """
+        if len(ents) == 1:
+            yield self.resolve_dirty_logged(ents[0])
+            return
+        try:
+            yield motor.Op(self.app.mongodb[dbname].remove,
+                           {'$or': [ ent.query for ent in ents ]})
+        except Exception as ex:
+            self.log.warning('propcache: grouped remove failed in %s (%s); retrying singly', dbname, ex)
+            for ent in ents:
+                yield self.resolve_dirty_logged(ent)
+            return
+        for ent in ents:
+            ent.mark_clean()
 
     @tornado.gen.coroutine
     def resolve_dirty(self, ent):
@@ -220,8 +562,7 @@ class PropCache:
             # Maybe we should update the equivalent writable entry here,
             # but we'll just skip it.
             self.log.warning('Unable to update %s entry: %s', dbname, ent.key)
-            if ent.mutable:
-                ent.origval = deepcopy(ent.val)
+            ent.mark_clean()
             return
 
         if ent.found:
@@ -231,36 +572,40 @@ class PropCache:
             yield motor.Op(self.app.mongodb[dbname].update,
                            ent.query, newval,
                            upsert=True)
-            if ent.mutable:
-                ent.origval = deepcopy(ent.val)
         else:
             # Resolve delete.
             yield motor.Op(self.app.mongodb[dbname].remove,
                            ent.query)
-        ent.dirty = False
+        ent.mark_clean()
 
 class PropEntry:
     """Represents a database entry, or perhaps the lack of a database entry.
     """
     
     def __init__(self, val, tup, query, found=True, dirty=False):
-        self.val = val
         self.tup = tup  # Dependency key
         self.dbname = tup[0]  # Collection name
         self.key = tup[-1]
         self.query = query  # Query in the collection
         self.found = found  # Was a database entry found at all?
         self.dirty = dirty  # Needs to be written back?
+        # Notices mutation of a list or dict value read from the database.
+        self.tracker = None
 
         # Mutable entries will be added to objmap.
         if not found:
             self.mutable = False
         else:
-            self.id = id(val)
             self.mutable = isinstance(val, (list, dict))
-            if self.mutable:
-                # Keep a copy, to check for possible changes
-                self.origval = deepcopy(val)
+            if self.mutable and not dirty:
+                # Convert to tracked containers, so that we know if the
+                # value changes. (A dirty entry is going to be written
+                # back anyway; and its value belongs to the caller, so we
+                # mustn't replace it.)
+                self.tracker = MutationTracker()
+                val = track(val, self.tracker)
+            self.id = id(val)
+        self.val = val
 
     def __repr__(self):
         if not self.found:
@@ -275,15 +620,316 @@ class PropEntry:
     def isdirty(self):
         """Has this value changed since we cached it?
         (Always true if we created this entry for a set/delete.)
-        
-        ### This will fail to detect changes that compare equal. That is,
-        ### if an array [1] changes to [1.0], this will not notice the
-        ### difference.
         """
         if self.dirty:
             return True
-        if self.mutable and (self.val != self.origval):
+        if self.tracker is not None and self.tracker.changed:
+            return True
+        return False
+
+    def mark_clean(self):
+        """The value has been written back (or we've given up on that).
+        """
+        self.dirty = False
+        if self.tracker is not None:
+            self.tracker.changed = False
+
+class MutationTracker:
+    """Shared by all the tracked containers in one PropEntry value. Any
+    mutation, at any depth, sets the changed flag.
+    """
+    __slots__ = ('changed',)
+    def __init__(self):
+        self.changed = False
+
+class TrackedList(list):
+    """A list which notes when it's mutated. Script code sees this as a
+    list (it is one); the sandbox offers it the same attributes.
+
+    Containers inserted into a TrackedList are not converted. They don't
+    need to be: inserting something is a mutation, so the entry is already
+    due for write-back at the end of the task.
+    """
+    __slots__ = ('tracker',)
+    
+    def __init__(self, *args, tracker=None):
+        list.__init__(self, *args)
+        if tracker is None:
+            tracker = MutationTracker()
+        self.tracker = tracker
+
+    def __setitem__(self, key, val):
+        self.tracker.changed = True
+        list.__setitem__(self, key, val)
+    def __delitem__(self, key):
+        self.tracker.changed = True
+        list.__delitem__(self, key)
+    def __iadd__(self, val):
+        self.tracker.changed = True
+        return list.__iadd__(self, val)
+    def __imul__(self, val):
+        self.tracker.changed = True
+        return list.__imul__(self, val)
+    def append(self, val):
+        self.tracker.changed = True
+        list.append(self, val)
+    def extend(self, val):
+        self.tracker.changed = True
+        list.extend(self, val)
+    def insert(self, index, val):
+        self.tracker.changed = True
+        list.insert(self, index, val)
+    def pop(self, *args):
+        self.tracker.changed = True
+        return list.pop(self, *args)
+    def remove(self, val):
+        self.tracker.changed = True
+        list.remove(self, val)
+    def reverse(self):
+        self.tracker.changed = True
+        list.reverse(self)
+    def sort(self, **kwargs):
+        self.tracker.changed = True
+        list.sort(self, **kwargs)
+    def clear(self):
+        self.tracker.changed = True
+        list.clear(self)
+
+class TrackedDict(dict):
+    """A dict which notes when it's mutated. See TrackedList.
+    """
+    __slots__ = ('tracker',)
+    
+    def __init__(self, *args, tracker=None, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        if tracker is None:
+            tracker = MutationTracker()
+        self.tracker = tracker
+
+    def __setitem__(self, key, val):
+        self.tracker.changed = True
+        dict.__setitem__(self, key, val)
+    def __delitem__(self, key):
+        self.tracker.changed = True
+        dict.__delitem__(self, key)
+    def clear(self):
+        self.tracker.changed = True
+        dict.clear(self)
+    def pop(self, *args):
+        self.tracker.changed = True
+        return dict.pop(self, *args)
+    def popitem(self):
+        self.tracker.changed = True
+        return dict.popitem(self)
+    def setdefault(self, *args):
+        self.tracker.changed = True
+        return dict.setdefault(self, *args)
+    def update(self, *args, **kwargs):
+        self.tracker.changed = True
+        dict.update(self, *args, **kwargs)
+    def __ior__(self, val):
+        self.tracker.changed = True
+        return dict.__ior__(self, val)
+
+def track(val, tracker):
+    """Return a copy of a value, with lists and dicts (at any depth)
+    converted to tracked containers reporting to the given tracker.
+    Immutable values are returned as-is. Like deepcopy(), this presumes
+    the value is DB-storable.
+    """
+    if isinstance(val, list):
+        return TrackedList([ track(subval, tracker) for subval in val ], tracker=tracker)
+    if isinstance(val, dict):
+        return TrackedDict([ (key, track(subval, tracker)) for (key, subval) in val.items() ], tracker=tracker)
+    return val
+
+class SharedPropCache:
+    """The long-lived property cache. This sits underneath the per-task
+    PropCache, and only holds read-only collections (see shared_collections).
+    Like PropCache, it remembers "not found" results as well as values.
+
+    Entries are evicted least-recently-used first, when we go over either
+    the entry count or the (estimated) total value size.
+
+    Values are copied going in and coming out (coming out, the copy is
+    the PropEntry's conversion to tracked containers), so a task which
+    mutates a value in place (which it shouldn't, but the propcache will
+    only log a warning) can't damage the cached copy.
+
+    The cache is only as good as its invalidation. Build edits in tweb
+    send notifydatachange, which calls invalidate(). Other tools (like
+    twloadworld) write worldprop and wplayerprop straight to the database;
+    as a backstop for those, every entry expires after TTL seconds.
+    """
+
+    # Limits on the cache size.
+    MAX_ENTRIES = 20000
+    MAX_BYTES = 32 * 1024 * 1024
+    TTL = 300  # seconds
+
+    def __init__(self, app):
+        self.app = app
+        self.log = app.log
+
+        # Maps tuple to (found, val, size, expiry), in
+        # least-to-most-recently-used order.
+        self.map = collections.OrderedDict()
+        # Maps (db, id1, id2) to the set of keys cached in that scope.
+        # (So that we can invalidate a whole location at once.)
+        self.scopemap = {}
+        # Maps scopes for which every key is cached to their expiry
+        # times. (Keys not in the map are known to be absent.) Evicting
+        # or invalidating anything in the scope removes it from this.
+        self.fullscopes = {}
+        self.totalsize = 0
+
+        # Bumped on every invalidation. A database read that started
+        # before an invalidation doesn't get stored; it may be stale.
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<SharedPropCache %d entries, %d bytes; %d hits, %d misses>' % (len(self.map), self.totalsize, self.hits, self.misses)
+
+    def has(self, tup):
+        """Check whether a tuple is cached. (The answer may be "cached as
+        not found".) This counts as a hit or a miss.
+        """
+        res = self.map.get(tup, None)
+        if res is not None:
+            if res[3] < time.monotonic():
+                self.discard(tup)
+            else:
+                self.hits += 1
+                return True
+        elif self.is_full_scope(tup[0:3]):
+            self.hits += 1
             return True
+        self.misses += 1
+        return False
+    
+    def get(self, tup, copy=True):
+        """Return (found, val) for a cached tuple. The val is a fresh copy,
+        unless you pass copy=False -- in which case you must not mutate
+        it. Only call this if has() returned true.
+        """
+        res = self.map.get(tup, None)
+        if res is None:
+            # Absent from a full scope.
+            return (False, None)
+        (found, val, size, expiry) = res
+        self.map.move_to_end(tup)
+        if not copy:
+            return (found, val)
+        return (found, deepcopy(val))
+
+    def is_full_scope(self, scope):
+        expiry = self.fullscopes.get(scope, None)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del self.fullscopes[scope]
+            return False
+        return True
+
+    def store_scope(self, scope, rows, generation):
+        """Add every property in a scope to the cache, and mark the scope
+        full. The rows argument maps keys to values.
+        """
+        if generation != self.generation:
+            return
+        # Take the expiry first, so that the scope doesn't outlive any
+        # of its entries.
+        expiry = time.monotonic() + self.TTL
+        for (key, val) in rows.items():
+            self.store(scope + (key,), True, val, generation)
+        # If storing evicted part of the scope, it isn't full after all.
+        for key in rows:
+            if scope + (key,) not in self.map:
+                return
+        self.fullscopes[scope] = expiry
+
+    def store(self, tup, found, val, generation):
+        """Add an entry to the cache. The generation must be the value
+        of self.generation from before the database read began.
+        """
+        if generation != self.generation:
+            # An invalidation arrived while we were reading.
+            return
+        if tup in self.map:
+            self.discard(tup)
+        if not found:
+            val = None
+        size = estimate_size(tup) + estimate_size(val)
+        if size > self.MAX_BYTES // 16:
+            # Absurdly large; not worth pushing everything else out for.
+            return
+        self.map[tup] = (found, deepcopy(val), size, time.monotonic() + self.TTL)
+        self.totalsize += size
+        scope = tup[0:3]
+        keyset = self.scopemap.get(scope, None)
+        if keyset is None:
+            keyset = set()
+            self.scopemap[scope] = keyset
+        keyset.add(tup[3])
+
+        while self.map and (len(self.map) > self.MAX_ENTRIES
+                            or self.totalsize > self.MAX_BYTES):
+            oldtup = next(iter(self.map))
+            self.discard(oldtup)
+
+    def discard(self, tup):
+        res = self.map.pop(tup, None)
+        if res is None:
+            return
+        self.totalsize -= res[2]
+        scope = tup[0:3]
+        self.fullscopes.pop(scope, None)
+        keyset = self.scopemap.get(scope, None)
+        if keyset is not None:
+            keyset.discard(tup[3])
+            if not keyset:
+                del self.scopemap[scope]
+
+    def invalidate(self, tup):
+        """Drop a changed property from the cache. The tuple is a change
+        key, ('worldprop', wid, locid, key) or ('wplayerprop', wid, uid,
+        key). If the key is None, the whole scope is dropped (every key
+        at that wid/locid).
+
+        Other kinds of change key are ignored.
+        """
+        if not tup or tup[0] not in shared_collections or len(tup) != 4:
+            return
+        self.generation += 1
+        # Even a key we don't have may be new to a full scope.
+        self.fullscopes.pop(tup[0:3], None)
+        if tup[3] is not None:
+            self.discard(tup)
+            return
+        keyset = self.scopemap.get(tup[0:3], None)
+        if keyset:
+            for key in list(keyset):
+                self.discard(tup[0:3] + (key,))
+
+    def clear(self):
+        self.generation += 1
+        self.map.clear()
+        self.scopemap.clear()
+        self.fullscopes.clear()
+        self.totalsize = 0
+
+def estimate_size(val):
+    """Guess how much memory a DB-storable value takes up. This doesn't
+    have to be accurate; it just has to grow with the value.
+    """
+    if isinstance(val, (list, tuple)):
+        return sys.getsizeof(val) + sum([ estimate_size(subval) for subval in val ])
+    if isinstance(val, dict):
+        return sys.getsizeof(val) + sum([ estimate_size(key) + estimate_size(subval) for (key, subval) in val.items() ])
+    return sys.getsizeof(val)
 
 def deepcopy(val):
     """Return a copy of a value. For immutable values, this returns the
@@ -298,3 +944,7 @@ def deepcopy(val):
         return dict([ (key, deepcopy(subval)) for (key, subval) in val.items() ])
     return val
 
+
+# Late imports, to avoid circularity
+import two.profiler
+from two.evalctx import EvalPropContext
@@ -0,0 +1,232 @@
+"""
+Render cache: remembers the display-level rendering of a symbol (usually
+a location's "desc") for a given player and location, so that we don't
+re-evaluate it when nothing it depends on has changed.
+
+A rendering records the dependencies it touched (the same set that
+generate_update hands to the connection table). We keep a version counter
+for every change key we've seen; a cached rendering is good as long as
+none of its dependencies has changed since the rendering started.
+As a backstop (for changes made behind tweb's back, which nobody tells
+us about), entries also expire after TTL seconds.
+
+Some script functions depend on things that aren't recorded as
+dependencies -- random numbers, the clock, database lookups. Calling one
+of those clears the context's cacheable flag (see ScriptFunc volatile),
+and the result isn't stored.
+
+(Gentext seeds are derived from the iid and the property name, so
+gentext renders the same way every time, given the same inputs.)
+
+Most renderings don't depend on who's looking. If an evaluation never
+asked for the current player (see EvalPropContext.uid) and touched no
+player properties of the viewer, it is player-independent, and we share
+it among everybody in the location. Within a task, the first player to
+render a location does the work and the rest wait for it; so when a
+crowded room changes, we evaluate its desc once, not once per occupant.
+"""
+
+import time
+
+import tornado.gen
+import tornado.concurrent
+
+import twcommon.misc
+
+class RenderEntry(object):
+    """One cached rendering. The desc may be a string or a description
+    array (which must not be modified). The linktargets map action keys
+    (which appear in ['link', ackey] elements of the desc) to targets.
+    """
+    def __init__(self, stamp, desc, linktargets, dependencies):
+        self.stamp = stamp
+        self.desc = desc
+        self.linktargets = linktargets
+        self.dependencies = dependencies
+        self.created = time.monotonic()
+
+class RenderCache(object):
+    """RenderCache maps (uid, wid, scid, iid, locid, symbol) to RenderEntry
+    objects. Player-independent renderings are stored with a uid of None.
+    """
+    MAX_ENTRIES = 5000
+    # If we've seen this many different change keys, we throw out the
+    # versions table (and all the entries, which might depend on it).
+    MAX_VERSIONS = 50000
+    TTL = 300  # seconds
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = twcommon.misc.LRUCache(self.MAX_ENTRIES, name='RenderCache')
+        # Maps change keys to the counter value when they last changed.
+        self.versions = {}
+        # Bumped on every change. Entries are stamped with the counter
+        # value from when their task started.
+        self.counter = 0
+        # Entries stamped before this are invalid.
+        self.floor = 0
+
+    def __repr__(self):
+        return '<RenderCache: %d entries, %d versions; %d hits, %d misses>' % (len(self.cache), len(self.versions), self.cache.hits, self.cache.misses)
+
+    def note_changes(self, changeset):
+        """Record that the data under the given change keys has changed.
+        (A key whose last element is None means every key in that
+        location; we record it as-is and check for it in is_current.)
+        """
+        if len(self.versions) + len(changeset) > self.MAX_VERSIONS:
+            self.clear()
+        self.counter += 1
+        for key in changeset:
+            self.versions[key] = self.counter
+
+    def is_current(self, ent):
+        if ent.stamp < self.floor:
+            return False
+        versions = self.versions
+        for dep in ent.dependencies:
+            if versions.get(dep, 0) > ent.stamp:
+                return False
+            if len(dep) == 4 and dep[3] is not None:
+                if versions.get(dep[0:3]+(None,), 0) > ent.stamp:
+                    return False
+        return True
+
+    def lookup(self, key):
+        """Return the cached entry for a key, or None if it's not cached
+        (or is out of date).
+        """
+        ent = self.cache.get(key)
+        if ent is None:
+            return None
+        if ent.created + self.TTL < time.monotonic() or not self.is_current(ent):
+            self.cache.discard(key)
+            return None
+        return ent
+
+    @tornado.gen.coroutine
+    def eval(self, ctx, symbol):
+        """Equivalent to ctx.eval(symbol), for a LEVEL_DISPLAY context,
+        except that the result may come from the cache (or from another
+        player's rendering of the same location, earlier in the task).
+        Either way, ctx.linktargets and ctx.dependencies are filled in
+        afterwards; the linktargets always have fresh action keys.
+        Exceptions are passed through (and the result isn't cached).
+        """
+        assert ctx.level == LEVEL_DISPLAY, 'RenderCache: only LEVEL_DISPLAY can be cached'
+        task = ctx.task
+        loctx = ctx.loctx
+        sharedkey = (None, loctx.wid, loctx.scid, loctx.iid, loctx.locid, symbol)
+        key = (loctx.uid,) + sharedkey[1:]
+        
+        ent = self.lookup(key)
+        if ent is None:
+            ent = self.lookup(sharedkey)
+        if ent is None:
+            future = task.sharedrenders.get(sharedkey, None)
+            if future is not None:
+                # Somebody else in this task is already rendering this.
+                # If their result turns out to be player-independent,
+                # we can use it. (Unless the task has changed something
+                # since then.)
+                ent = yield future
+                if ent is not None and not self.is_current(ent):
+                    ent = None
+        if ent is not None:
+            (desc, ctx.linktargets) = rekey_description(ent.desc, ent.linktargets)
+            ctx.dependencies = set(ent.dependencies)
+            return desc
+
+        if sharedkey in task.sharedrenders:
+            # We waited, but it was a player-specific render (or out of
+            # date). Do our own.
+            future = None
+        else:
+            future = tornado.concurrent.Future()
+            task.sharedrenders[sharedkey] = future
+        
+        ent = None
+        shared = False
+        try:
+            desc = yield ctx.eval(symbol)
+            dependencies = frozenset(ctx.dependencies or ())
+            stamp = self.stamp_for(task, dependencies)
+            ent = RenderEntry(stamp, desc, dict(ctx.linktargets or {}), dependencies)
+            shared = is_player_independent(ctx, ent)
+            if ctx.cacheable and stamp >= self.floor:
+                self.cache.set((sharedkey if shared else key), ent)
+        finally:
+            if future is not None:
+                # Wake up the waiters (with None if they can't share
+                # our result).
+                future.set_result(ent if shared else None)
+        return desc
+
+    def stamp_for(self, task, dependencies):
+        """Work out what stamp a task's rendering is good as of.
+
+        The task's propcache may hold values from as early as the task's
+        start (task.renderstamp), so that's the safe answer. But once the
+        task has noted its own changes, a rendering which comes after them
+        is good as of those changes (task.renderversion) -- provided that
+        no other task has changed any of its dependencies since we started.
+        (Other lanes note changes all the time, but they rarely touch the
+        same keys.)
+        """
+        stamp = task.renderstamp
+        ownversion = task.renderversion
+        if ownversion is None or stamp < self.floor:
+            return stamp
+        versions = self.versions
+        for dep in dependencies:
+            version = versions.get(dep, 0)
+            if version > stamp and version != ownversion:
+                return stamp
+            if len(dep) == 4 and dep[3] is not None:
+                version = versions.get(dep[0:3]+(None,), 0)
+                if version > stamp and version != ownversion:
+                    return stamp
+        return ownversion
+
+    def clear(self):
+        self.cache.clear()
+        self.versions.clear()
+        self.counter += 1
+        self.floor = self.counter
+
+def is_player_independent(ctx, ent):
+    """Decide whether a rendering would come out the same for any player
+    in the location.
+    """
+    if ctx.playerdependent:
+        return False
+    uid = ctx.loctx.uid
+    for dep in ent.dependencies:
+        if dep[0] in ('iplayerprop', 'wplayerprop') and dep[2] == uid:
+            return False
+    return True
+
+def rekey_description(desc, linktargets):
+    """Given a description array and its linktargets, return copies with
+    fresh action keys.
+    """
+    if not linktargets:
+        return (desc, {})
+    keymap = {}
+    newtargets = {}
+    for (ackey, target) in linktargets.items():
+        newkey = EvalPropContext.build_action_key()
+        keymap[ackey] = newkey
+        newtargets[newkey] = target
+    if type(desc) is not list:
+        return (desc, newtargets)
+    newdesc = []
+    for val in desc:
+        if type(val) is list and len(val) == 2 and val[0] == 'link':
+            val = ['link', keymap.get(val[1], val[1])]
+        newdesc.append(val)
+    return (newdesc, newtargets)
+
+
+# Late imports, to avoid circularity
+from two.evalctx import EvalPropContext, LEVEL_DISPLAY
@@ -2,12 +2,14 @@ import types
 import itertools
 import random
 import datetime
+import functools
 
 import tornado.gen
 from bson.objectid import ObjectId
 import motor
 
 from twcommon.excepts import SymbolError
+import two.propcache
 
 class ScriptNamespace(object):
     """A container for user-accessible items in a script. This is basically
@@ -33,7 +35,7 @@ class ScriptNamespace(object):
     def __repr__(self):
         ls = []
         for (key, val) in itertools.chain(self.map.items(), self.propmap.items()):
-            if type(val) is dict:
+            if isinstance(val, dict):
                 val = '{...}'
             elif isinstance(val, types.SimpleNamespace):
                 val = 'namespace(...)'
@@ -89,12 +91,20 @@ class ScriptFunc:
     # stuffed into a dict in this master dict.
     funcgroups = {}
     
-    def __init__(self, name, func, group=None, yieldy=False):
+    def __init__(self, name, func, group=None, yieldy=False, volatile=False):
         self.name = name
         if group == '_':
             group = None
         self.groupname = group
         self.yieldy = yieldy
+        self.volatile = volatile
+
+        if volatile:
+            # A volatile function's result depends on something that
+            # isn't tracked as a dependency (the clock, the random number
+            # generator, the database). Calling one makes the current
+            # evaluation uncacheable.
+            func = volatile_wrapper(func)
 
         if not yieldy:
             self.func = func
@@ -107,6 +117,13 @@ class ScriptFunc:
             prefix = self.groupname + '.'
         return '<ScriptFunc "%s%s">' % (prefix, self.name,)
 
+def volatile_wrapper(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        EvalPropContext.set_current_uncacheable()
+        return func(*args, **kwargs)
+    return wrapper
+
 def scriptfunc(name, group=None, **kwargs):
     """Decorator for scriptfunc functions.
     """
@@ -210,7 +227,7 @@ def define_globals():
         ctx = EvalPropContext.get_current_context()
         return ctx.frame.locals
         
-    @scriptfunc('log', group='_')
+    @scriptfunc('log', group='_', volatile=True)
     def global_log(*ls):
         """Log a message to the server log. Only works if debug is set
         in the server config file.
@@ -276,7 +293,7 @@ def define_globals():
             return isinstance(object, datetime.datetime)
         return isinstance(object, typ)
 
-    @scriptfunc('ObjectId', group='_')
+    @scriptfunc('ObjectId', group='_', volatile=True)
     def global_objectid(oid=None):
         """The ObjectId constructor. We extend this to handle player and
         location objects.
@@ -288,7 +305,7 @@ def define_globals():
         ### RealmProxy? (wid or iid?)
         return ObjectId(oid)
 
-    @scriptfunc('setfocus', group='_', yieldy=True)
+    @scriptfunc('setfocus', group='_', yieldy=True, volatile=True)
     def global_setfocus(symbol, player=None):
         """Set the given player's focus to this symbol. (If player is None,
         the current player; if a location, then every player in it; if
@@ -343,7 +360,7 @@ def define_globals():
                                {'$set':{'focus':symbol}}, multi=True)
                 ctx.task.set_dirty(uids, DIRTY_FOCUS)
         
-    @scriptfunc('unfocus', group='_', yieldy=True)
+    @scriptfunc('unfocus', group='_', yieldy=True, volatile=True)
     def global_unfocus(symbol=None, player=None):
         """Defocus the given player. (If player is None,
         the current player; if a location, then every player in it; if
@@ -415,7 +432,7 @@ def define_globals():
                                {'$set':{'focus':None}}, multi=True)
                 ctx.task.set_dirty(uids, DIRTY_FOCUS)
 
-    @scriptfunc('event', group='_', yieldy=True)
+    @scriptfunc('event', group='_', yieldy=True, volatile=True)
     def global_event(you, others=None, player=None):
         """Send an event message to the current player, like {event}.
         The argument(s) must be string or {text}. The optional second
@@ -457,7 +474,7 @@ def define_globals():
             raise TypeError('event: must be player or None')
             
 
-    @scriptfunc('eventloc', group='_', yieldy=True)
+    @scriptfunc('eventloc', group='_', yieldy=True, volatile=True)
     def global_eventloc(loc, all):
         """Send an event message to all players in the given location.
         (Location or key, or the entire realm.)
@@ -494,7 +511,7 @@ def define_globals():
         others = yield ctx.task.find_location_players(iid, locid)
         ctx.task.write_event(others, val)
         
-    @scriptfunc('move', group='_', yieldy=True)
+    @scriptfunc('move', group='_', yieldy=True, volatile=True)
     def global_move(dest, you=None, oleave=None, oarrive=None):
         """Move the player to another location in the same world, like {move}.
         The first argument must be a location or location key. The rest
@@ -542,7 +559,7 @@ def define_globals():
                 
         yield ctx.perform_move(locid, you, youeval, oleave, oleaveeval, oarrive, oarriveeval)
         
-    @scriptfunc('location', group='_', yieldy=True)
+    @scriptfunc('location', group='_', yieldy=True, volatile=True)
     def global_location(obj=None):
         """Create a LocationProxy.
         - No argument: the current player's location
@@ -594,7 +611,7 @@ def define_globals():
             raise KeyError('No such location: %s' % (obj,))
         return two.execute.LocationProxy(res['_id'])
 
-    @scriptfunc('sched', group='_')
+    @scriptfunc('sched', group='_', volatile=True)
     def global_sched(delta, func, repeat=False, cancel=None):
         """Schedule an event to occur in the future. The delta argument
         must be a timedelta or a number of seconds. The func should be
@@ -617,7 +634,7 @@ def define_globals():
             delta = datetime.timedelta(seconds=delta)
         instance.add_timer_event(delta, func, repeat=repeat, cancel=cancel)
 
-    @scriptfunc('unsched', group='_')
+    @scriptfunc('unsched', group='_', volatile=True)
     def global_unsched(cancel=None):
         """Cancel all upcoming scheduled events for this instance.
         If the cancel argument is given, this only cancels events that
@@ -645,7 +662,7 @@ def define_globals():
             raise Exception('No current player')
         return two.execute.PlayerProxy(ctx.uid)
 
-    @scriptfunc('lastlocation', group='_propmap', yieldy=True)
+    @scriptfunc('lastlocation', group='_propmap', yieldy=True, volatile=True)
     def global_lastlocation():
         """A LocationProxy for the last location (in this world) that
         the player visited.
@@ -754,7 +771,7 @@ def define_globals():
         kwargs['tzinfo'] = datetime.timezone.utc
         return datetime.datetime(year, month, day, **kwargs)
         
-    @scriptfunc('now', group='datetime_propmap')
+    @scriptfunc('now', group='datetime_propmap', volatile=True)
     def global_datetime_now():
         """Return the current task's start time.
         This goes in a propmap group, meaning that the user will invoke
@@ -798,14 +815,12 @@ def define_globals():
             uid = player.uid
         else:
             raise TypeError('players.name: must be player or None')
-        res = yield motor.Op(ctx.app.mongodb.players.find_one,
-                             {'_id':uid},
-                             {'name':1})
+        res = yield ctx.app.playercache.get(uid)
         if not res:
             raise Exception('No such player')
         return res.get('name', '???')
 
-    @scriptfunc('pronoun', group='players', yieldy=True)
+    @scriptfunc('pronoun', group='players', yieldy=True, volatile=True)
     def global_players_pronoun(player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -816,15 +831,13 @@ def define_globals():
             uid = player.uid
         else:
             raise TypeError('players.focus: must be player or None')
-        res = yield motor.Op(ctx.app.mongodb.players.find_one,
-                             {'_id':uid},
-                             {'pronoun':1})
+        res = yield ctx.app.playercache.get(uid)
         if not res:
             raise Exception('No such player')
         # Could set up a pronoun dependency here.
         return res['pronoun']
         
-    @scriptfunc('ishere', group='players', yieldy=True)
+    @scriptfunc('ishere', group='players', yieldy=True, volatile=True)
     def global_players_ishere(player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -845,7 +858,7 @@ def define_globals():
         else:
             return False
 
-    @scriptfunc('focus', group='players', yieldy=True)
+    @scriptfunc('focus', group='players', yieldy=True, volatile=True)
     def global_players_focus(player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -872,21 +885,19 @@ def define_globals():
         if not iid:
             raise Exception('No current instance')
         if isinstance(loc, two.execute.RealmProxy):
-            cursor = ctx.app.mongodb.playstate.find({'iid':iid},
-                                                    {'_id':1})
+            uids = yield ctx.app.occupancy.players_at(iid)
             # Could have a dependency on ('populace', iid, None). But then
             # we'd have to ping it whenever a player moved in the instance,
-            # and I'm not sure it's worth the effort.
+            # and I'm not sure it's worth the effort. So this result can't
+            # be cached, either.
+            ctx.cacheable = False
         elif isinstance(loc, two.execute.LocationProxy):
-            cursor = ctx.app.mongodb.playstate.find({'iid':iid, 'locid':loc.locid},
-                                                    {'_id':1})
+            uids = yield ctx.app.occupancy.players_at(iid, loc.locid)
             if ctx.dependencies is not None:
                 ctx.dependencies.add( ('populace', iid, loc.locid) )
         else:
             raise TypeError('players.count: must be location or realm')
-        res = yield motor.Op(cursor.count)
-        # cursor autoclose
-        return res
+        return len(uids)
 
     @scriptfunc('list', group='players', yieldy=True)
     def global_players_list(loc):
@@ -897,26 +908,21 @@ def define_globals():
         if not iid:
             raise Exception('No current instance')
         if isinstance(loc, two.execute.RealmProxy):
-            cursor = ctx.app.mongodb.playstate.find({'iid':iid},
-                                                    {'_id':1})
+            uids = yield ctx.app.occupancy.players_at(iid)
             # Could have a dependency on ('populace', iid, None). But then
             # we'd have to ping it whenever a player moved in the instance,
-            # and I'm not sure it's worth the effort.
+            # and I'm not sure it's worth the effort. So this result can't
+            # be cached, either.
+            ctx.cacheable = False
         elif isinstance(loc, two.execute.LocationProxy):
-            cursor = ctx.app.mongodb.playstate.find({'iid':iid, 'locid':loc.locid},
-                                                    {'_id':1})
+            uids = yield ctx.app.occupancy.players_at(iid, loc.locid)
             if ctx.dependencies is not None:
                 ctx.dependencies.add( ('populace', iid, loc.locid) )
         else:
             raise TypeError('players.count: must be location or realm')
-        res = []
-        while (yield cursor.fetch_next):
-            player = cursor.next_object()
-            res.append(two.execute.PlayerProxy(player['_id']))
-        # cursor autoclose
-        return res
+        return [ two.execute.PlayerProxy(uid) for uid in uids ]
 
-    @scriptfunc('resolve', group='pronoun', yieldy=True)
+    @scriptfunc('resolve', group='pronoun', yieldy=True, volatile=True)
     def global_pronoun_resolve(pronoun, player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -927,9 +933,7 @@ def define_globals():
             uid = player.uid
         else:
             raise TypeError('players.focus: must be player or None')
-        res = yield motor.Op(ctx.app.mongodb.players.find_one,
-                             {'_id':uid},
-                             {'pronoun':1, 'name':1})
+        res = yield ctx.app.playercache.get(uid)
         if not res:
             raise Exception('No such player')
         # Could set up a pronoun dependency here.
@@ -1016,26 +1020,26 @@ def define_globals():
         res = yield global_pronoun_resolve.yieldfunc('ourself', player)
         return res
         
-    @scriptfunc('choice', group='random')
+    @scriptfunc('choice', group='random', volatile=True)
     def global_random_choice(seq):
         """Choose a random member of a list.
         """
         return random.choice(seq)
 
-    @scriptfunc('randint', group='random')
+    @scriptfunc('randint', group='random', volatile=True)
     def global_random_randint(a, b):
         """Return a random integer in range [a, b], including both end
         points.
         """
         return random.randint(a, b)
 
-    @scriptfunc('randrange', group='random')
+    @scriptfunc('randrange', group='random', volatile=True)
     def global_random_randrange(start, stop=None, step=1):
         """Return a random integer from range(start, stop[, step]).
         """
         return random.randrange(start, stop=stop, step=1)
     
-    @scriptfunc('level', group='access', yieldy=True)
+    @scriptfunc('level', group='access', yieldy=True, volatile=True)
     def global_access_level(player=None, level=None):
         """Return the access level of the given player (or the current player)
         in the given scope.
@@ -1114,6 +1118,11 @@ type_getattr_table = {
     dict: set(['clear', 'copy', 'fromkeys', 'get', 'items', 'keys', 'pop', 'popitem', 'setdefault', 'update', 'values']),
     }
 
+# Property values read from the database are tracked subclasses of list and
+# dict. Script code gets the same access to those.
+type_getattr_table[two.propcache.TrackedList] = type_getattr_table[list]
+type_getattr_table[two.propcache.TrackedDict] = type_getattr_table[dict]
+
 def type_getattr_allowed(typ, key):
     """Given a type, what attributes do we permit script code to read?
     This is important because unfettered access to foo.__dict__, for
@@ -1168,29 +1177,20 @@ def find_symbol(app, loctx, key, locals=None, dependencies=None):
     iid = loctx.iid
     locid = loctx.locid
     
+    # Check all four property tables at once. (The lookups happen
+    # concurrently, but the first hit in this order wins.)
+    tups = []
     if (locid is not None) and (iid is not None):
-        res = yield app.propcache.get(('instanceprop', iid, locid, key),
-                                      dependencies=dependencies)
-        if res:
-            return res.val
-    
+        tups.append(('instanceprop', iid, locid, key))
     if locid is not None:
-        res = yield app.propcache.get(('worldprop', wid, locid, key),
-                                      dependencies=dependencies)
-        if res:
-            return res.val
-
+        tups.append(('worldprop', wid, locid, key))
     if iid is not None:
-        res = yield app.propcache.get(('instanceprop', iid, None, key),
-                                      dependencies=dependencies)
-        if res:
-            return res.val
-
-    if True:
-        res = yield app.propcache.get(('worldprop', wid, None, key),
-                                      dependencies=dependencies)
-        if res:
-            return res.val
+        tups.append(('instanceprop', iid, None, key))
+    tups.append(('worldprop', wid, None, key))
+    
+    res = yield app.propcache.get_first(tups, dependencies=dependencies)
+    if res:
+        return res.val
 
     if app.global_symbol_table.has(key):
         (res, yieldy) = app.global_symbol_table.getyieldy(key)
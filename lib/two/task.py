@@ -1,8 +1,11 @@
+import time
 import datetime
+import contextlib
+import functools
 
 import tornado.gen
+import tornado.stack_context
 from bson.objectid import ObjectId
-import motor
 
 import two.execute
 from two.playconn import PlayerConnection
@@ -45,6 +48,16 @@ class LocContext(object):
         val = ' '.join([ ('%s=%s' % (key, val)) for (key, val) in ls ])
         return '<LocContext %s>' % (val,)
 
+class UpdateSlot(object):
+    """
+    Pure-data class. The state for one generate_update() call during
+    Task.resolve(). Updates for different players run concurrently, so
+    each gets its own tick count and clock. (See Task.activate_slot.)
+    """
+    def __init__(self):
+        self.cputicks = 0
+        self.phasestart = time.monotonic()
+
 class Task(object):
     """
     Context for the execution of one command in the command queue. This
@@ -60,8 +73,28 @@ class Task(object):
     # per phase.)
     CPU_TICK_LIMIT = 500
 
+    # Most operations cost one tick, but some are a lot more expensive
+    # than others. A database query (made on behalf of script code)
+    # costs TICK_COST_FETCH. Building a string or list costs an extra
+    # tick per TICK_SIZE_UNIT elements. Each pass through a comprehension
+    # costs TICK_COST_ITERATION, on top of whatever the body costs.
+    TICK_COST_FETCH = 4
+    TICK_SIZE_UNIT = 1000
+    TICK_COST_ITERATION = 1
+
+    # Limit on how long (in wall-clock seconds) a phase can run. Ticks
+    # don't count time spent waiting for the database, so we also check
+    # the clock: whenever script code resumes after waiting, and every
+    # CLOCK_CHECK_TICKS ticks. (The app replaces the limit with the
+    # script_time_limit option.)
+    WALL_TIME_LIMIT = 2.0
+    CLOCK_CHECK_TICKS = 32
+
     # Limit on how deep the eval stack can get.
     STACK_DEPTH_LIMIT = 10
+
+    # Limit on how many connection updates resolve() runs at once.
+    UPDATE_CONCURRENCY_LIMIT = 8
     
     def __init__(self, app, cmdobj, connid, twwcid, queuetime):
         self.app = app
@@ -84,9 +117,29 @@ class Task(object):
         self.totalcputicks = 0
         # Maximum cputicks for a phase.
         self.maxcputicks = 0
-
-        # Maps uids to LocContexts.
-        #self.loctxmap = {}
+        # Limit on the wall-clock time of a phase, and when the current
+        # phase started (a time.monotonic() value).
+        self.timelimit = self.WALL_TIME_LIMIT
+        self.phasestart = time.monotonic()
+        # tick() does nothing but count until cputicks passes this.
+        self.tickcheck = 0
+
+        # The property cache for this task. (The app installs this
+        # when the task starts.)
+        self.propcache = None
+        # The RenderCache counter value when the task started. (The app
+        # sets this too.)
+        self.renderstamp = 0
+        # The RenderCache counter value for this task's own changes, once
+        # resolve() has noted them. See RenderCache.stamp_for().
+        self.renderversion = None
+        # Maps uids to LocContexts. This is filled in by get_loctx();
+        # any code that moves a player must call clear_loctx().
+        self.loctxmap = {}
+        # Maps render keys to Futures, for renders in progress (or done)
+        # that other players in the same location may be able to share.
+        # See RenderCache.eval().
+        self.sharedrenders = {}
 
         # This will be a set of change keys.
         self.changeset = None
@@ -102,20 +155,90 @@ class Task(object):
         self.app = None
         self.log = None
         self.cmdobj = None
-        #self.loctxmap = None
+        self.propcache = None
+        self.loctxmap = None
+        self.sharedrenders = None
         self.updateconns = None
         self.changeset = None
 
+    @contextlib.contextmanager
+    def activate(self):
+        """Context manager which makes this task's state current: the
+        app's propcache. Tasks for different instances can be interleaved
+        on the ioloop, so the app wraps each task in a tornado StackContext
+        built from this. Every time one of the task's callbacks runs, its
+        state is swapped in; when the callback yields, the previous state
+        is swapped back.
+
+        (The current EvalPropContext follows the same rules, on its own;
+        see EvalPropContext.current_context.)
+
+        (A stray callback can outlive the task -- a timeout set up by
+        task code, say. Once the task is closed, this does nothing.)
+        """
+        if self.app is None:
+            yield
+            return
+        app = self.app
+        oldpropcache = app.propcache
+        app.propcache = self.propcache
+        try:
+            yield
+        finally:
+            app.propcache = oldpropcache
+
+    @contextlib.contextmanager
+    def activate_slot(self, slot):
+        """Context manager which makes an UpdateSlot's state current, on
+        top of the task's (see activate). The slot's tick count is swapped
+        in while its callbacks run. (So is its phase start time.)
+        """
+        if self.app is None:
+            yield
+            return
+        oldticks = self.cputicks
+        oldphasestart = self.phasestart
+        self.cputicks = slot.cputicks
+        self.phasestart = slot.phasestart
+        self.tickcheck = 0
+        try:
+            yield
+        finally:
+            slot.cputicks = self.cputicks
+            self.cputicks = oldticks
+            self.phasestart = oldphasestart
+            self.tickcheck = 0
+
     def tick(self, val=1):
-        self.cputicks = self.cputicks + 1
-        if (self.cputicks > self.CPU_TICK_LIMIT):
-            self.log.error('ExecRunawayException: User script exceeded tick limit!')
+        """Charge val ticks to the current phase. Raises ExecRunawayException
+        if the phase has used up its ticks or its time.
+        """
+        self.cputicks = self.cputicks + val
+        if (self.cputicks > self.tickcheck):
+            # Time for a closer look.
+            if (self.cputicks > self.CPU_TICK_LIMIT):
+                self.log.error('ExecRunawayException: User script exceeded tick limit!')
+                raise ExecRunawayException('Script ran too long; aborting!')
+            self.check_deadline()
+            self.tickcheck = min(self.CPU_TICK_LIMIT, self.cputicks + self.CLOCK_CHECK_TICKS)
+
+    def check_deadline(self):
+        """Raise ExecRunawayException if the current phase has run past
+        its wall-clock limit. Script code calls this whenever it ticks,
+        and whenever it resumes after waiting for something.
+        """
+        if (time.monotonic() - self.phasestart > self.timelimit):
+            self.log.error('ExecRunawayException: User script exceeded time limit!')
             raise ExecRunawayException('Script ran too long; aborting!')
 
     def resetticks(self):
+        """Start a new phase, with a fresh tick budget and clock.
+        """
         self.totalcputicks = self.totalcputicks + self.cputicks
         self.maxcputicks = max(self.maxcputicks, self.cputicks)
         self.cputicks = 0
+        self.phasestart = time.monotonic()
+        self.tickcheck = 0
 
     def is_writable(self):
         return (self.updateconns is not None)
@@ -136,7 +259,7 @@ class Task(object):
         if ls is None:
             return
 
-        if type(ls) not in (tuple, list):
+        if not isinstance(ls, (tuple, list)):
             ls = ( ls, )
 
         for obj in ls:
@@ -158,7 +281,7 @@ class Task(object):
         if ls is None:
             return
 
-        if type(ls) not in (tuple, list):
+        if not isinstance(ls, (tuple, list)):
             ls = ( ls, )
 
         for obj in ls:
@@ -173,31 +296,36 @@ class Task(object):
                 self.log.warning('write_event: unrecognized %s', obj)
 
     def clear_loctx(self, uid):
-        #if uid in self.loctxmap:
-        #    del self.loctxmap[uid]
-        pass
+        """Forget the cached LocContext for a player. This must be called
+        whenever the player's iid or locid changes.
+        """
+        self.loctxmap.pop(uid, None)
 
     @tornado.gen.coroutine
     def get_loctx(self, uid):
-        #loctx = self.loctxmap.get(uid, None)
-        #if loctx:
-        #    return loctx
+        """Return a LocContext for the player's current location. This
+        is cached for the duration of the task. (The iid and locid come
+        from the occupancy index, so the cache miss is cheap too.)
+        The result is shared, so don't modify it.
+        """
+        loctx = self.loctxmap.get(uid, None)
+        if loctx:
+            return loctx
 
-        playstate = yield motor.Op(self.app.mongodb.playstate.find_one,
-                                   {'_id':uid},
-                                   {'iid':1, 'locid':1, 'focus':1})
-    
-        iid = playstate['iid']
-        if not iid:
+        res = yield self.app.occupancy.location_of(uid)
+        if not res:
             loctx = LocContext(uid, None)
-            #self.loctxmap[uid] = loctx
+            self.loctxmap[uid] = loctx
             return loctx
+        (iid, locid) = res
         
-        instance = yield motor.Op(self.app.mongodb.instances.find_one,
-                              {'_id':iid})
+        instance = yield self.app.entitycache.get('instances', iid)
         loctx = LocContext(uid, instance['wid'], instance['scid'],
-                           iid, playstate['locid'])
-        #self.loctxmap[uid] = loctx
+                           iid, locid)
+        # The player may have moved while we were looking up the instance.
+        # In that case, don't cache.
+        if (yield self.app.occupancy.location_of(uid)) == res:
+            self.loctxmap[uid] = loctx
         return loctx
             
     @tornado.gen.coroutine
@@ -214,27 +342,16 @@ class Task(object):
                 return None
             uid = conn.uid
         
-        playstate = yield motor.Op(self.app.mongodb.playstate.find_one,
-                                   {'_id':uid},
-                                   {'iid':1, 'locid':1})
-        if not playstate:
+        res = yield self.app.occupancy.location_of(uid)
+        if not res:
             return None
-        iid = playstate['iid']
-        if not iid:
-            return None
-        locid = playstate['locid']
+        (iid, locid) = res
         if not locid:
             return None
         
-        cursor = self.app.mongodb.playstate.find({'iid':iid, 'locid':locid},
-                                                 {'_id':1})
-        people = []
-        while (yield cursor.fetch_next):
-            ostate = cursor.next_object()
-            if notself and ostate['_id'] == uid:
-                continue
-            people.append(ostate['_id'])
-        # cursor autoclose
+        people = yield self.app.occupancy.players_at(iid, locid)
+        if notself and uid in people:
+            people.remove(uid)
             
         return people
         
@@ -243,18 +360,7 @@ class Task(object):
         """Generates a list of players in a given location. If locid
         is None, generates a list of players in the entire instance.
         """
-        if locid:
-            cursor = self.app.mongodb.playstate.find({'iid':iid, 'locid':locid},
-                                                     {'_id':1})
-        else:
-            cursor = self.app.mongodb.playstate.find({'iid':iid},
-                                                     {'_id':1})
-        people = []
-        while (yield cursor.fetch_next):
-            ostate = cursor.next_object()
-            people.append(ostate['_id'])
-        # cursor autoclose
-            
+        people = yield self.app.occupancy.players_at(iid, locid)
         return people
         
     @tornado.gen.coroutine
@@ -335,9 +441,7 @@ class Task(object):
                 raise ErrorMessageException('Command may not be invoked by a player: "%s"' % (cmdname,))
 
             if cmd.restrict == 'admin':
-                player = yield motor.Op(self.app.mongodb.players.find_one,
-                                        {'_id':conn.uid},
-                                        {'admin':1})
+                player = yield self.app.playercache.get(conn.uid)
                 if not (player and player.get('admin', False)):
                     raise ErrorMessageException('Command may only be invoked by an administrator: "%s"' % (cmdname,))
 
@@ -345,9 +449,7 @@ class Task(object):
                 # Player must be the creator of the world he is in.
                 ### And it must be an unstable version.
                 # (Or an admin, anywhere.)
-                player = yield motor.Op(self.app.mongodb.players.find_one,
-                                        {'_id':conn.uid},
-                                        {'admin':1, 'build':1})
+                player = yield self.app.playercache.get(conn.uid)
                 if not player:
                     raise ErrorMessageException('Player not found!')
                 if (player.get('admin', False)):
@@ -356,13 +458,12 @@ class Task(object):
                 elif (not player.get('build', False)):
                     raise ErrorMessageException('Command requires build permission: "%s"' % (cmdname,))
                 else:
-                    playstate = yield motor.Op(self.app.mongodb.playstate.find_one,
-                                               {'_id':conn.uid},
-                                               {'iid':1})
-                    instance = yield motor.Op(self.app.mongodb.instances.find_one,
-                                              {'_id':playstate['iid']})
-                    world = yield motor.Op(self.app.mongodb.worlds.find_one,
-                                           {'_id':instance['wid']})
+                    # The command will probably want the loctx too, so
+                    # this isn't wasted.
+                    loctx = yield self.get_loctx(conn.uid)
+                    if not loctx.wid:
+                        raise ErrorMessageException('Command may only be invoked by this world\'s creator: "%s"' % (cmdname,))
+                    world = yield self.app.entitycache.get('worlds', loctx.wid)
                     if world.get('creator', None) != conn.uid:
                         raise ErrorMessageException('Command may only be invoked by this world\'s creator: "%s"' % (cmdname,))
 
@@ -450,39 +551,63 @@ class Task(object):
         if not (changeset or updateconns):
             return
 
-        connections = self.app.playconns.all()
-
         # Go through the data changes, setting dirty bits as needed.
-        # (But we try to do as little work as possible.)
+        # The connection table indexes connections by their dependencies,
+        # so this only costs as much as the changeset.
         if changeset:
-            for conn in connections:
-                dirty = updateconns.get(conn.connid, 0)
-                if not (dirty & DIRTY_LOCALE):
-                    if not conn.localedependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_LOCALE
-                if not (dirty & DIRTY_POPULACE):
-                    if not conn.populacedependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_POPULACE
-                if not (dirty & DIRTY_FOCUS):
-                    if not conn.focusdependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_FOCUS
-                if dirty:
-                    updateconns[conn.connid] = dirty
+            self.app.rendercache.note_changes(changeset)
+            self.renderversion = self.app.rendercache.counter
+            changedirty = self.app.playconns.dirty_for_changes(changeset)
+            for (connid, dirty) in changedirty.items():
+                updateconns[connid] = updateconns.get(connid, 0) | dirty
 
         # Again, we might be done.
         if not updateconns:
             return
 
         # self.log.info('Must resolve updates: %s', updateconns)
-        
-        # If two connections are on the same player, this won't be
-        # as efficient as it might be -- we'll generate text twice.
-        # But that's a rare case.
+
+        # If two connections are on the same player, we only want to
+        # generate text once. So group the connections by uid. (The dirty
+        # bits are merged; updating a section that wasn't dirty is
+        # harmless.)
+        uidmap = {}
         for (connid, dirty) in updateconns.items():
+            conn = self.app.playconns.get(connid)
+            if conn is None:
+                continue
+            if conn.uid in uidmap:
+                (olddirty, conns) = uidmap[conn.uid]
+                conns.append(conn)
+                uidmap[conn.uid] = (olddirty | dirty, conns)
+            else:
+                uidmap[conn.uid] = (dirty, [conn])
+
+        # Run the updates concurrently, but only so many at a time. Each
+        # update gets its own slot, which means its own tick budget (so
+        # that a crowded room doesn't wipe out the task).
+        self.resetticks()
+        jobs = list(uidmap.values())
+        jobs.reverse()
+        workers = [ self.resolve_worker(jobs)
+                    for ix in range(min(len(jobs), self.UPDATE_CONCURRENCY_LIMIT)) ]
+        yield workers
+
+    @tornado.gen.coroutine
+    def resolve_worker(self, jobs):
+        """Generate updates for (dirty, conns) pairs popped off the jobs
+        list, one at a time, until the list is empty. (The conns all
+        belong to one player.) Errors are logged and do not affect other
+        players.
+        """
+        while jobs:
+            (dirty, conns) = jobs.pop()
+            slot = UpdateSlot()
             try:
-                self.resetticks()
-                conn = self.app.playconns.get(connid)
-                yield two.execute.generate_update(self, conn, dirty)
+                with tornado.stack_context.StackContext(functools.partial(self.activate_slot, slot)):
+                    future = two.execute.generate_update(self, conns[0], dirty, others=conns[1:])
+                yield future
             except Exception as ex:
                 self.log.error('Error updating while resolving task: %s', self.cmdobj, exc_info=True)
-        
+            self.totalcputicks = self.totalcputicks + slot.cputicks
+            self.maxcputicks = max(self.maxcputicks, slot.cputicks)
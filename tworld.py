@@ -38,6 +38,12 @@ tornado.options.define(
 tornado.options.define(
     'show_stack_traces', type=bool,
     help='show stack traces for errors that are probably a player\'s fault')
+tornado.options.define(
+    'script_profile', type=bool,
+    help='profile script evaluation in every world (see the /profile command)')
+tornado.options.define(
+    'script_time_limit', type=float, default=None,
+    help='wall-clock limit (in seconds) on each phase of a command\'s script execution (default 2.0)')
 tornado.options.define(
     'log_level', type=str, default=None,
     help='logging threshold (default usually WARNING)')